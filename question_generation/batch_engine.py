@@ -0,0 +1,298 @@
+"""
+Batched execution of one program over many scenes with NumPy.
+
+question_engine.answer_question runs a program on a single scene. When the same
+program has to be answered on thousands of scenes (validating a dataset,
+evaluating predicted programs) it is much faster to encode the scenes once as
+padded arrays and evaluate every node for all scenes at the same time:
+
+- an ObjectSet is a bool array of shape (N, max_objects), a PartSet a bool
+  array of shape (N, max_objects * part_stride) indexed by packed part id
+- an Object or Part is an int array of shape (N,)
+- attribute values are int codes into a per-attribute vocabulary, with code 0
+  reserved for padding
+
+Scenes in which some node is invalid (e.g. a unique node that does not see
+exactly one object) answer '__INVALID__', like answer_question does.
+
+Typical use:
+
+batch = SceneBatch(scenes, metadata)
+answers = answer_question_batch(question, metadata, batch)
+"""
+
+import numpy as np
+
+import question_engine as qeng
+from scene_index import get_part_stride, get_scene_index, get_attribute_matches, \
+                        _index_key, _filter_matches
+
+
+class SceneBatch(object):
+    """
+    N scenes encoded as padded attribute-code arrays. Attribute, relationship
+    and part arrays are built lazily, the first time a program needs them, and
+    are then reused for every program answered on the batch.
+    """
+
+    def __init__(self, scenes, metadata):
+        self.scenes = scenes
+        self.metadata = metadata
+        self.num_scenes = len(scenes)
+        self.max_objects = max([len(s['objects']) for s in scenes] + [1])
+        self.part_stride = get_part_stride(metadata)
+        self.shape_hier = metadata.get('_shape_hier', {})
+
+        self.valid = np.zeros((self.num_scenes, self.max_objects), dtype=bool)
+        for n, scene in enumerate(scenes):
+            self.valid[n, :len(scene['objects'])] = True
+
+        self.vocabs = {}
+        self._object_codes = {}
+        self._part_codes = {}
+        self._relations = {}
+        self._match_tables = {}
+        self.part_valid = None
+
+    def _encode(self, attribute, value):
+        vocab, codes = self.vocabs.setdefault(attribute, ([None], {}))
+        key = _index_key(value)
+        if key not in codes:
+            codes[key] = len(vocab)
+            vocab.append(value)
+        return codes[key]
+
+    def object_codes(self, attribute):
+        """
+        int array (N, max_objects) of attribute codes; 0 for padding.
+        """
+        if attribute not in self._object_codes:
+            codes = np.zeros((self.num_scenes, self.max_objects), dtype=np.int32)
+            for n, scene in enumerate(self.scenes):
+                for i, obj in enumerate(scene['objects']):
+                    codes[n, i] = self._encode(attribute, obj[attribute])
+            self._object_codes[attribute] = codes
+        return self._object_codes[attribute]
+
+    def _build_parts(self):
+        # The part tables of the scene indexes, laid out by packed part id
+        num_parts = self.max_objects * self.part_stride
+        self.part_valid = np.zeros((self.num_scenes, num_parts), dtype=bool)
+        self._part_values = []
+        for n, scene in enumerate(self.scenes):
+            index = get_scene_index(scene, self.metadata)
+            parts = index.parts
+            self.part_valid[n, index.part_ids] = True
+            self._part_values.append(parts)
+
+    def part_codes(self, attribute):
+        """
+        int array (N, max_objects * part_stride) of part attribute codes.
+        """
+        if attribute not in self._part_codes:
+            codes = np.zeros(self.get_part_valid().shape, dtype=np.int32)
+            for n, parts in enumerate(self._part_values):
+                for part_id, part in parts.items():
+                    codes[n, part_id] = self._encode(attribute, part[attribute])
+            self._part_codes[attribute] = codes
+        return self._part_codes[attribute]
+
+    def relation(self, relation):
+        """
+        bool array (N, max_objects, max_objects); [n, i, j] is True if object j
+        is related to object i in scene n.
+        """
+        if relation not in self._relations:
+            rel = np.zeros((self.num_scenes, self.max_objects, self.max_objects),
+                           dtype=bool)
+            for n, scene in enumerate(self.scenes):
+                for i, related in enumerate(scene['relationships'][relation]):
+                    rel[n, i, related] = True
+            self._relations[relation] = rel
+        return self._relations[relation]
+
+    def match_table(self, attribute, value):
+        """
+        bool array over the codes of attribute, True for the codes that a
+        filter on value keeps (same attribute tables as the filter handlers).
+        """
+        vocab = self.vocabs.get(attribute, ([None], {}))[0]
+        key = (attribute, value)
+        table = self._match_tables.get(key)
+        if table is None or len(table) != len(vocab):
+            known, matches = get_attribute_matches(self.metadata, attribute, value)
+            table = np.zeros(len(vocab), dtype=bool)
+            for code, atr in enumerate(vocab):
+                if code == 0:
+                    continue
+                atr = _index_key(atr)
+                if atr in matches or (atr not in known and
+                                      _filter_matches(atr, value, self.shape_hier)):
+                    table[code] = True
+            self._match_tables[key] = table
+        return table
+
+    def query_table(self, attribute):
+        """
+        int array mapping each code of attribute to the code of the value a
+        query returns: lists with one value are unwrapped, other lists map to
+        0 (invalid).
+        """
+        vocab = self.vocabs[attribute][0]
+        table = np.arange(len(vocab), dtype=np.int32)
+        for code, val in enumerate(vocab):
+            if type(val) == list:
+                table[code] = self._encode(attribute, val[0]) if len(val) == 1 else 0
+        return table
+
+    def get_part_valid(self):
+        """
+        bool array (N, max_objects * part_stride), True for existing parts.
+        """
+        if self.part_valid is None:
+            self._build_parts()
+        return self.part_valid
+
+
+def _onehot(idxs, width):
+    out = np.zeros((len(idxs), width), dtype=bool)
+    out[np.arange(len(idxs)), idxs] = True
+    return out
+
+
+class BatchProgram(object):
+    """
+    A program compiled for batched execution. Node kinds are worked out the
+    same way as in question_engine.CompiledProgram.
+    """
+
+    def __init__(self, nodes, metadata):
+        self.nodes = nodes
+        self.metadata = metadata
+        self.kinds = qeng.compile_program(nodes, metadata).kinds
+
+    def execute(self, batch, scene_idxs=None, all_outputs=False):
+        """
+        Answer the program on the scenes of batch (or only on the scenes at
+        scene_idxs). Returns a list with one answer per scene, or with
+        all_outputs a list of per-node output lists.
+        """
+        if scene_idxs is None:
+            N = batch.num_scenes
+            take = lambda array: array
+        else:
+            rows = np.asarray(scene_idxs, dtype=np.int64)
+            N = len(rows)
+            take = lambda array: array[rows]
+        arange = np.arange(N)
+        invalid = np.zeros(N, dtype=bool)
+        stride = batch.part_stride
+        # Each value is an array; vocab_attrs holds the attribute whose codes a
+        # query output holds, or None for ints, bools, objects and sets
+        values, vocab_attrs, invalids = [], [], []
+
+        for node in self.nodes:
+            node_type = node['type']
+            inputs = [values[idx] for idx in node['inputs']]
+            side_inputs = node.get('side_inputs', [])
+            vocab_attr = None
+
+            if node_type == 'scene':
+                out = take(batch.valid)
+            elif node_type.startswith('filter_'):
+                attr = node_type[len('filter_'):]
+                codes = take(batch.object_codes(attr))
+                out = inputs[0] & batch.match_table(attr, side_inputs[0])[codes]
+            elif node_type.startswith('partfilter_'):
+                attr = node_type[len('partfilter_'):]
+                codes = take(batch.part_codes(attr))
+                out = inputs[0] & batch.match_table(attr, side_inputs[0])[codes]
+            elif node_type == 'unique':
+                counts = inputs[0].sum(axis=1)
+                invalid |= counts != 1
+                out = inputs[0].argmax(axis=1)
+            elif node_type == 'relate':
+                out = take(batch.relation(side_inputs[0]))[arange, inputs[0]]
+            elif node_type.startswith('same_'):
+                attr = node_type[len('same_'):]
+                codes = take(batch.object_codes(attr))
+                out = (codes == codes[arange, inputs[0]][:, None]) & take(batch.valid)
+                out[arange, inputs[0]] = False
+            elif node_type == 'union':
+                out = inputs[0] | inputs[1]
+            elif node_type == 'intersect':
+                out = inputs[0] & inputs[1]
+            elif node_type == 'count':
+                out = inputs[0].sum(axis=1)
+            elif node_type == 'exist':
+                out = inputs[0].any(axis=1)
+            elif node_type.startswith('query_'):
+                vocab_attr = node_type[len('query_'):]
+                codes = take(batch.object_codes(vocab_attr))[arange, inputs[0]]
+                out = batch.query_table(vocab_attr)[codes]
+                invalid |= out == 0
+            elif node_type.startswith('partquery_'):
+                vocab_attr = node_type[len('partquery_'):]
+                codes = take(batch.part_codes(vocab_attr))[arange, inputs[0]]
+                out = batch.query_table(vocab_attr)[codes]
+                invalid |= out == 0
+            elif node_type.startswith('equal_'):
+                out = inputs[0] == inputs[1]
+            elif node_type == 'less_than':
+                out = inputs[0] < inputs[1]
+            elif node_type == 'greater_than':
+                out = inputs[0] > inputs[1]
+            elif node_type == 'object2part':
+                objs = inputs[0]
+                if objs.ndim == 1:
+                    objs = _onehot(objs, batch.max_objects)
+                out = np.repeat(objs, stride, axis=1) & take(batch.get_part_valid())
+            elif node_type == 'part2object':
+                parts = inputs[0]
+                if parts.ndim == 1:
+                    parts = _onehot(parts, batch.max_objects * stride)
+                out = parts.reshape(N, batch.max_objects, stride).any(axis=2)
+            else:
+                raise ValueError('Node type "%s" cannot be batched' % node_type)
+
+            values.append(out)
+            vocab_attrs.append(vocab_attr)
+            invalids.append(invalid.copy())
+
+        if not all_outputs:
+            return self._decode(batch, self.kinds[-1], values[-1],
+                                vocab_attrs[-1], invalid)
+        return [self._decode(batch, *args) for args in
+                zip(self.kinds, values, vocab_attrs, invalids)]
+
+    def _decode(self, batch, kind, out, vocab_attr, invalid):
+        stride = batch.part_stride
+        answers = []
+        for n in range(len(out)):
+            if invalid[n]:
+                answers.append('__INVALID__')
+            elif kind == 'ObjectSet':
+                answers.append(np.nonzero(out[n])[0].tolist())
+            elif kind == 'PartSet':
+                answers.append([qeng.part_id_to_str(p, stride)
+                                for p in np.nonzero(out[n])[0].tolist()])
+            elif kind == 'Part':
+                answers.append(qeng.part_id_to_str(int(out[n]), stride))
+            elif vocab_attr is not None:
+                answers.append(batch.vocabs[vocab_attr][0][out[n]])
+            else:
+                answers.append(out[n].item())
+        return answers
+
+
+def answer_question_batch(question, metadata, batch, scene_idxs=None,
+                          all_outputs=False):
+    """
+    Batched counterpart of question_engine.answer_question: answer question on
+    every scene of a SceneBatch (or on the scenes at scene_idxs) and return the
+    list of answers.
+    """
+    if isinstance(question, dict):
+        question = question['nodes']
+    program = BatchProgram(question, metadata)
+    return program.execute(batch, scene_idxs=scene_idxs, all_outputs=all_outputs)
@@ -0,0 +1,266 @@
+"""
+Benchmark the question engine on the bundled templates and example scenes.
+
+Programs are first instantiated from every template on every scene (exactly
+as generate_questions.py would), and then answered repeatedly with the
+different execution paths of question_engine.py and with the list-based
+handlers in reference_engine.py. Run it from the question_generation
+directory, like generate_questions.py:
+
+python benchmark_engine.py --template_dir CLEVR_1.0_templates
+"""
+
+from __future__ import print_function
+import argparse, json, os, random, time
+import numpy as np
+
+import question_engine as qeng
+import reference_engine
+import batch_engine
+import generate_questions as gen
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_scene_file', default=None,
+        help="JSON file containing ground-truth scene information; if not " +
+                 "given then the scenes in --scene_dir are used")
+parser.add_argument('--scene_dir', default='../output/scenes',
+        help="Directory of per-image scene JSON files")
+parser.add_argument('--metadata_file', default='metadata_part.json',
+        help="JSON file containing metadata about functions")
+parser.add_argument('--synonyms_json', default='synonyms.json',
+        help="JSON file defining synonyms for parameter values")
+parser.add_argument('--template_dir', default=None, action='append',
+        help="Directory containing JSON templates; may be given more than " +
+                 "once. Defaults to all of the bundled template directories")
+parser.add_argument('--instances_per_template', default=1, type=int,
+        help="The number of programs to instantiate per template and scene")
+parser.add_argument('--repeats', default=20, type=int,
+        help="How many times each program is answered for timing")
+parser.add_argument('--batch_scenes', default=1000, type=int,
+        help="Number of scenes (the loaded scenes, repeated) that each " +
+                 "program is answered on by the batched NumPy engine")
+parser.add_argument('--output_file', default=None,
+        help="If given, also write the results to this JSON file")
+
+
+def load_scenes(args):
+    if args.input_scene_file is not None:
+        with open(args.input_scene_file, 'r') as f:
+            return json.load(f)['scenes']
+    scenes = []
+    for fn in sorted(os.listdir(args.scene_dir)):
+        if not fn.endswith('.json'): continue
+        with open(os.path.join(args.scene_dir, fn), 'r') as f:
+            scenes.append(json.load(f))
+    return scenes
+
+
+def instantiate_programs(scenes, templates, metadata, synonyms, instances_per_template):
+    """
+    Returns a list of (template_filename, scene_idx, nodes, answer) tuples. The
+    nodes are stripped of cached outputs so they can be executed from scratch.
+    """
+    programs = []
+    for scene_idx, scene_struct in enumerate(scenes):
+        # Fresh answer counts for every scene; otherwise rejection sampling
+        # makes the DFS on later scenes take a very long time
+        _, template_answer_counts = gen.reset_counts(templates, metadata)
+        gen.complete_parts(scene_struct, metadata)
+        for (fn, idx), template in sorted(templates.items()):
+            random.seed(len(programs))
+            np.random.seed(len(programs))
+            _, qs, ans, _ = gen.instantiate_templates_dfs(
+                                scene_struct, template, metadata,
+                                template_answer_counts[(fn, idx)], synonyms,
+                                max_instances=instances_per_template)
+            for q in qs:
+                nodes = [gen.node_shallow_copy(n) for n in q]
+                answer = qeng.answer_question({'nodes': nodes}, metadata,
+                                              scene_struct, cache_outputs=False)
+                programs.append((fn, scene_idx, nodes, answer))
+    return programs
+
+
+def time_per_question(fn, programs, scenes, repeats):
+    tic = time.time()
+    for _ in range(repeats):
+        for _, scene_idx, nodes, _ in programs:
+            fn(nodes, scenes[scene_idx])
+    toc = time.time()
+    return 1e6 * (toc - tic) / (repeats * max(len(programs), 1))
+
+
+def bench_compiled(programs, scenes, metadata, repeats):
+    def reference(nodes, scene_struct):
+        return reference_engine.answer_question({'nodes': nodes}, metadata,
+                                                scene_struct)
+    def compiled(nodes, scene_struct):
+        return qeng.answer_question({'nodes': nodes}, metadata, scene_struct,
+                                    cache_outputs=False)
+    precompiled_programs = {id(p[2]): qeng.CompiledProgram(p[2], metadata)
+                            for p in programs}
+    def precompiled(nodes, scene_struct):
+        return precompiled_programs[id(nodes)].execute(scene_struct,
+                                                       cache_outputs=False)
+
+    for _, scene_idx, nodes, answer in programs:
+        assert reference(nodes, scenes[scene_idx]) == answer
+        assert precompiled(nodes, scenes[scene_idx]) == answer
+
+    return {
+        'reference_us': time_per_question(reference, programs, scenes, repeats),
+        'compiled_us': time_per_question(compiled, programs, scenes, repeats),
+        'precompiled_us': time_per_question(precompiled, programs, scenes, repeats),
+    }
+
+
+def bench_degenerate(programs, scenes, metadata, repeats):
+    """
+    Time the degeneracy check of the programs that contain relate nodes, as
+    done when accepting a question in the DFS: the program has just been run
+    on the scene, so its outputs are in the cache.
+    """
+    programs = [p for p in programs if any(n['type'] == 'relate' for n in p[2])]
+    compiled = [qeng.CompiledProgram(p[2], metadata) for p in programs]
+
+    def check(program, scene_struct, answer, incremental):
+        cache = qeng.SubprogramCache()
+        if incremental:
+            program.execute(scene_struct, cache=cache)
+        else:
+            program.execute(scene_struct, cache_outputs=False)
+        return qeng.is_degenerate(program, metadata, scene_struct, answer=answer,
+                                  cache=cache, incremental=incremental)
+
+    def run(fn):
+        tic = time.time()
+        for _ in range(repeats):
+            for p, program in zip(programs, compiled):
+                fn(p, program)
+        return 1e6 * (time.time() - tic) / (repeats * max(len(programs), 1))
+
+    # All three checks must agree, also on the scenes the programs were not
+    # instantiated on
+    for (_, _, nodes, _), program in zip(programs, compiled):
+        for scene_struct in scenes:
+            answer = reference_engine.answer_question({'nodes': nodes}, metadata,
+                                                      scene_struct)
+            expected = reference_engine.is_degenerate({'nodes': nodes}, metadata,
+                                                      scene_struct, answer=answer)
+            assert check(program, scene_struct, answer, False) == expected
+            assert check(program, scene_struct, answer, True) == expected
+
+    return {
+        'num_programs': len(programs),
+        # The reference answers the program itself, like the checks below
+        'reference_us': run(lambda p, program: reference_engine.is_degenerate(
+            {'nodes': p[2]}, metadata, scenes[p[1]])),
+        'truncated_us': run(lambda p, program: check(program, scenes[p[1]], p[3], False)),
+        'incremental_us': run(lambda p, program: check(program, scenes[p[1]], p[3], True)),
+    }
+
+
+def bench_batched(programs, scenes, metadata, num_scenes):
+    """
+    Answer every program on num_scenes scenes, one scene at a time with a
+    precompiled program and all at once with batch_engine.
+    """
+    batch_scenes = [scenes[i % len(scenes)] for i in range(num_scenes)]
+    # The scene arrays are built lazily; build all of them before timing
+    tic = time.time()
+    batch = batch_engine.SceneBatch(batch_scenes, metadata)
+    for _, _, nodes, _ in programs:
+        batch_engine.BatchProgram(nodes, metadata).execute(batch)
+    encode_s = time.time() - tic
+
+    tic = time.time()
+    expected = []
+    for _, _, nodes, _ in programs:
+        program = qeng.CompiledProgram(nodes, metadata)
+        expected.append([program.execute(s, cache_outputs=False)
+                         for s in batch_scenes])
+    loop_s = time.time() - tic
+
+    tic = time.time()
+    answers = [batch_engine.BatchProgram(nodes, metadata).execute(batch)
+               for _, _, nodes, _ in programs]
+    batched_s = time.time() - tic
+    assert answers == expected
+
+    num = max(len(programs) * num_scenes, 1)
+    return {
+        'num_scenes': num_scenes,
+        'encode_s': encode_s,
+        'loop_us': 1e6 * loop_s / num,
+        'batched_us': 1e6 * batched_s / num,
+    }
+
+
+def main(args):
+    metadata = gen.load_metadata(args.metadata_file)
+    with open(args.synonyms_json, 'r') as f:
+        synonyms = json.load(f)
+    scenes = load_scenes(args)
+    template_dirs = args.template_dir
+    if template_dirs is None:
+        template_dirs = ['CLEVR_1.0_templates', 'super_clevr_templates']
+
+    results = {}
+    for template_dir in template_dirs:
+        templates = gen.load_templates(template_dir)
+        programs = instantiate_programs(scenes, templates, metadata, synonyms,
+                                        args.instances_per_template)
+        by_file = {}
+        for p in programs:
+            by_file.setdefault(p[0], []).append(p)
+
+        print('\n%s: %d programs on %d scenes' % (template_dir, len(programs), len(scenes)))
+        # Speedups are relative to the reference engine: compiling and
+        # answering a fresh program once, and answering a precompiled one
+        print('%-22s %6s %14s %14s %16s %9s %9s' % ('templates', 'n', 'reference us/q',
+              'compiled us/q', 'precompiled us/q', 'compiled', 'precomp.'))
+        for fn, file_programs in sorted(by_file.items()):
+            res = bench_compiled(file_programs, scenes, metadata, args.repeats)
+            res['num_programs'] = len(file_programs)
+            res['compiled_speedup'] = res['reference_us'] / res['compiled_us']
+            res['speedup'] = res['reference_us'] / res['precompiled_us']
+            results['%s/%s' % (template_dir, fn)] = res
+            print('%-22s %6d %14.1f %14.1f %16.1f %8.1fx %8.1fx' % (fn,
+                  len(file_programs), res['reference_us'], res['compiled_us'],
+                  res['precompiled_us'], res['compiled_speedup'], res['speedup']))
+
+        degenerate = {}
+        for fn, file_programs in sorted(by_file.items()):
+            res = bench_degenerate(file_programs, scenes, metadata, args.repeats)
+            if res['num_programs'] > 0:
+                res['truncated_speedup'] = res['reference_us'] / res['truncated_us']
+                res['speedup'] = res['reference_us'] / res['incremental_us']
+                degenerate[fn] = res
+        if degenerate:
+            print('\ndegeneracy checks (including running the program once), ' \
+                  'speedups relative to the reference')
+            print('%-22s %6s %14s %14s %16s %9s %9s' % ('templates', 'n', 'reference us/q',
+                  'truncated us/q', 'incremental us/q', 'truncated', 'increm.'))
+        for fn, res in sorted(degenerate.items()):
+            results['%s/%s/is_degenerate' % (template_dir, fn)] = res
+            print('%-22s %6d %14.1f %14.1f %16.1f %8.1fx %8.1fx' % (fn, res['num_programs'],
+                  res['reference_us'], res['truncated_us'], res['incremental_us'],
+                  res['truncated_speedup'], res['speedup']))
+
+        if args.batch_scenes > 0:
+            res = bench_batched(programs, scenes, metadata, args.batch_scenes)
+            res['speedup'] = res['loop_us'] / res['batched_us']
+            results['%s/batched' % template_dir] = res
+            print('batched on %d scenes (warm-up %.2fs): %.2f us/q/scene ' \
+                  'looping, %.2f us/q/scene batched, %.1fx' % (res['num_scenes'],
+                  res['encode_s'], res['loop_us'], res['batched_us'], res['speedup']))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,143 @@
+"""
+Checkpoints of generate_questions.py runs, so that a run that crashed or was
+preempted can continue with --resume instead of starting over.
+
+A checkpoint is taken between two scenes (between two shards with --workers)
+and holds everything the rest of the run depends on: the next scene, the
+template and answer counts, the next question_index, --seed and the position
+of the question and trace files. No random state is saved: the choices made
+for an image come from streams of --seed and the image (see make_rng). It is a JSON file, written
+atomically next to the output (<output>.checkpoint by default); with traces,
+the trace index is appended to <checkpoint>.traces as it grows rather than
+rewritten every time. A resumed run truncates the outputs to the recorded
+positions and writes the same files as an uninterrupted run.
+"""
+
+import json, os, struct
+
+
+VERSION = 2
+
+# Arguments that may change between a run and its resumption
+RESUMABLE_ARGS = ['resume', 'checkpoint_every', 'checkpoint_file', 'verbose',
+                  'time_dfs', 'profile', 'profile_handlers']
+
+
+def checkpoint_path(args):
+    if args.checkpoint_file is not None:
+        return args.checkpoint_file
+    return args.output_questions_file + '.checkpoint'
+
+
+def _run_args(args):
+    return {k: v for k, v in sorted(vars(args).items()) if k not in RESUMABLE_ARGS}
+
+
+def _encode_counts(template_counts, template_answer_counts):
+    # Template keys are (filename, index) tuples and answers may be strings,
+    # ints or bools, so the counts are stored as lists (in dict order)
+    return ([[fn, idx, count] for (fn, idx), count in template_counts.items()],
+            [[fn, idx, list(map(list, counts.items()))]
+             for (fn, idx), counts in template_answer_counts.items()])
+
+
+def _decode_counts(template_counts, template_answer_counts):
+    return ({(fn, idx): count for fn, idx, count in template_counts},
+            {(fn, idx): {answer: count for answer, count in counts}
+             for fn, idx, counts in template_answer_counts})
+
+
+class Checkpointer(object):
+    """
+    Saves checkpoints of a run to path; load() returns the last one.
+    """
+
+    def __init__(self, path, args):
+        self.path = path
+        self.traces_path = path + '.traces'
+        self.args = _run_args(args)
+        self.seed = args.seed
+        self._num_traces_saved = 0
+
+    def load(self):
+        """
+        Return the saved state, or None if there is no checkpoint. The state is
+        a dict with 'next_scene', 'progress' (see
+        generate_questions.iter_questions_for_scenes), 'output' and 'traces'
+        (None, or (offset, index) for TraceWriter).
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            state = json.load(f)
+        if state.get('version') != VERSION:
+            raise ValueError('Unsupported checkpoint version in "%s"' % self.path)
+        if state['seed'] != self.seed:
+            raise ValueError('Cannot resume from "%s": it was taken with --seed %d' % (
+                             self.path, state['seed']))
+        changed = sorted(k for k in set(state['args']) | set(self.args)
+                         if state['args'].get(k) != self.args.get(k))
+        if changed:
+            raise ValueError('Cannot resume from "%s": arguments changed: %s' % (
+                             self.path, ', '.join(changed)))
+
+        progress = state['progress']
+        if 'template_counts' in progress:
+            progress['template_counts'], progress['template_answer_counts'] = \
+                _decode_counts(progress['template_counts'],
+                               progress['template_answer_counts'])
+
+        traces = None
+        if state['traces'] is not None:
+            offset, num_records = state['traces']
+            with open(self.traces_path, 'r+b') as f:
+                data = f.read(24 * num_records)
+                # Drop the entries saved after the checkpoint
+                f.truncate(24 * num_records)
+            entries = struct.unpack('<%dQ' % (3 * num_records), data)
+            index = list(zip(entries[0::3], entries[1::3], entries[2::3]))
+            traces = (offset, index)
+            self._num_traces_saved = num_records
+        return {'next_scene': state['next_scene'], 'progress': progress,
+                'output': tuple(state['output']), 'traces': traces}
+
+    def save(self, next_scene, progress, writer, traces=None):
+        """
+        Record that the scenes before next_scene are done, with the progress
+        of iter_questions_for_scenes after them (or just 'num_questions'
+        between shards) and the question writer and trace writer they were
+        written to.
+        """
+        progress = dict(progress)
+        if 'template_counts' in progress:
+            progress['template_counts'], progress['template_answer_counts'] = \
+                _encode_counts(progress['template_counts'],
+                               progress['template_answer_counts'])
+        trace_state = None
+        if traces is not None:
+            offset = traces.position()
+            new = traces.index[self._num_traces_saved:]
+            mode = 'ab' if self._num_traces_saved > 0 else 'wb'
+            with open(self.traces_path, mode) as f:
+                for entry in new:
+                    f.write(struct.pack('<QQQ', *entry))
+            self._num_traces_saved = len(traces.index)
+            trace_state = [offset, len(traces.index)]
+        state = {
+            'version': VERSION,
+            'args': self.args,
+            'next_scene': next_scene,
+            'progress': progress,
+            'seed': self.seed,
+            'output': list(writer.position()),
+            'traces': trace_state,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        for path in [self.path, self.traces_path]:
+            if os.path.exists(path):
+                os.remove(path)
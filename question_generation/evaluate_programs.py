@@ -0,0 +1,291 @@
+"""
+Answer the questions of a dataset by program rather than by image, and score
+the answers against the ground truth.
+
+Many questions about different images share the same program. Questions are
+grouped by their exact program and every distinct program is compiled once.
+Scenes are then read --scenes_per_chunk at a time, and every program is
+answered on the scenes of the chunk that its questions are about, together
+with batch_engine.py (programs that cannot be batched fall back to
+question_engine.answer_question, scene by scene). The canonical form of
+program_index.py is not used for grouping: it leaves out nodes that the answer
+does not depend on, but that can still make a program invalid. Answers are the same as those of answer_question: a
+program that is invalid on a scene answers '__INVALID__', which is never
+correct.
+
+With --predicted_programs_file the programs come from that file (e.g. the
+programs predicted by a model, matched to the questions by question_index) and
+the answers are scored against the answers in --input_questions_file;
+otherwise the questions are re-answered with their own programs, e.g. after a
+change to the scenes. Accuracy is reported overall and per question family
+(template file and family index). Run it from the question_generation
+directory:
+
+python evaluate_programs.py --input_scene_file ../output/superCLEVR_scenes.json \
+    --input_questions_file ../output/superCLEVR_questions.json \
+    --predicted_programs_file predicted.jsonl --output_file eval.json
+"""
+
+from __future__ import print_function
+import argparse, collections, itertools, json, time
+
+import question_engine as qeng
+import generate_questions as gen
+import verify_questions
+from batch_engine import SceneBatch, BatchProgram
+from scene_stream import SceneMap
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_scene_file', default='../output/superCLEVR_scenes.json',
+        help="JSON file containing ground-truth scene information for all images")
+parser.add_argument('--input_questions_file', default='../output/superCLEVR_questions.json',
+        help="Questions with ground-truth answers; a JSON file with a 'questions' " +
+                 "list or a JSON-lines file with one question per line")
+parser.add_argument('--predicted_programs_file', default=None,
+        help="If given, answer the programs in this file (JSON or JSON lines, " +
+                 "records with 'question_index' and 'program') instead of the " +
+                 "programs of the questions")
+parser.add_argument('--metadata_file', default='metadata_part.json',
+        help="JSON file containing metadata about functions")
+parser.add_argument('--backend', default='batch', choices=['batch', 'compiled'],
+        help="Answer each program on its scenes with batch_engine, or with " +
+                 "question_engine one scene at a time")
+parser.add_argument('--scenes_per_chunk', default=2000, type=int,
+        help="Scenes read (and encoded for batch_engine) at a time; every program " +
+                 "is answered on a chunk of scenes before the next one is read")
+parser.add_argument('--output_file', default=None,
+        help="If given, write a JSON report with overall and per-family accuracy")
+parser.add_argument('--output_answers_file', default=None,
+        help="If given, write the predicted answer of every question to this " +
+                 "JSON-lines file")
+
+
+def question_family(q):
+    # Question families are numbered within their template file
+    if 'template_filename' not in q:
+        return str(q.get('question_family_index', 'unknown'))
+    return '%s:%s' % (q['template_filename'], q.get('question_family_index'))
+
+
+def load_predicted_programs(path):
+    programs = {}
+    for record in verify_questions.iter_questions(path):
+        programs[record['question_index']] = record['program']
+    return programs
+
+
+def group_by_program(questions, metadata, predicted_programs=None):
+    """
+    Group questions by their program. Returns (groups, failed): groups maps
+    the JSON of each distinct program (as engine nodes) to
+    (engine nodes, [question, ...]) and failed lists (question, error) for the
+    questions whose program is missing or malformed. Only the fields needed
+    for scoring are kept.
+    """
+    groups, failed = collections.OrderedDict(), []
+    for i, q in enumerate(questions):
+        info = {
+            'question_index': q.get('question_index', i),
+            'image_index': q['image_index'],
+            'family': question_family(q),
+            'answer': q['answer'],
+        }
+        if predicted_programs is None:
+            program = q['program']
+        elif info['question_index'] in predicted_programs:
+            program = predicted_programs[info['question_index']]
+        else:
+            failed.append((info, 'no predicted program'))
+            continue
+        try:
+            nodes = verify_questions.to_engine_nodes(program)
+            error = verify_questions.check_program(nodes, metadata)
+        except (KeyError, TypeError) as e:
+            error = 'malformed program: %s: %s' % (type(e).__name__, e)
+        if error is not None:
+            failed.append((info, error))
+            continue
+        key = json.dumps(nodes, sort_keys=True)
+        if key not in groups:
+            groups[key] = (nodes, [])
+        groups[key][1].append(info)
+    return groups, failed
+
+
+class ProgramEvaluator(object):
+    """
+    Answers groups of questions by program. Scenes are read chunk_size at a
+    time, in the order of the scene file, and every program is answered on
+    the scenes of the chunk that its questions are about: in batch with
+    batch_engine (the chunk is encoded once for all the programs), or scene by
+    scene with question_engine. Memory is bounded by a chunk of scenes rather
+    than by the scene file.
+    """
+
+    def __init__(self, scenes, metadata, backend='batch', chunk_size=2000):
+        self.scenes = scenes
+        self.metadata = metadata
+        self.backend = backend
+        self.chunk_size = chunk_size
+
+    def _iter_chunks(self, image_idxs):
+        # Lists of (image_index, scene) of the scenes of image_idxs
+        if isinstance(self.scenes, SceneMap):
+            # One pass over the scene file instead of a lookup per scene
+            scenes = self.scenes.iter_scenes(image_idxs)
+        else:
+            scenes = ((i, self.scenes[i]) for i in sorted(image_idxs) if i in self.scenes)
+        chunk = []
+        for image_index, scene in scenes:
+            chunk.append((image_index, scene))
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def answer_groups(self, groups):
+        """
+        Answer a list of (nodes, [question, ...]) groups, where nodes is a
+        program that passed verify_questions.check_program and the questions
+        are about scenes that exist. Yields (question, answer) for every
+        question, a chunk of scenes at a time.
+        """
+        programs = []
+        for nodes, _ in groups:
+            if self.backend == 'batch':
+                programs.append(BatchProgram(nodes, self.metadata))
+            else:
+                programs.append(qeng.CompiledProgram(nodes, self.metadata))
+        by_image = collections.defaultdict(list)
+        for g, (_, infos) in enumerate(groups):
+            for info in infos:
+                by_image[info['image_index']].append((g, info))
+
+        for chunk in self._iter_chunks(by_image):
+            # Rows of the chunk that the questions of each program are about
+            by_group = collections.defaultdict(list)
+            for row, (image_index, _) in enumerate(chunk):
+                for g, info in by_image[image_index]:
+                    by_group[g].append((row, info))
+            batch, cache = None, qeng.SubprogramCache()
+            for g in sorted(by_group):
+                rows = [row for row, _ in by_group[g]]
+                answers = None
+                if isinstance(programs[g], BatchProgram):
+                    if batch is None:
+                        batch = SceneBatch([scene for _, scene in chunk], self.metadata)
+                    try:
+                        answers = programs[g].execute(batch, scene_idxs=rows)
+                    except ValueError:
+                        # Node types that batch_engine does not support
+                        programs[g] = qeng.CompiledProgram(groups[g][0], self.metadata)
+                if answers is None:
+                    answers = []
+                    for row in rows:
+                        try:
+                            answers.append(qeng.answer_question(
+                                programs[g], self.metadata, chunk[row][1], cache=cache))
+                        except Exception:
+                            answers.append('__INVALID__')
+                for (_, info), answer in zip(by_group[g], answers):
+                    yield info, answer
+
+
+def evaluate(groups, evaluator):
+    """
+    Answer every group of questions. Yields (info, predicted, error) for every
+    question, where predicted is the formatted answer.
+    """
+    found_groups = []
+    for nodes, infos in groups.values():
+        found = []
+        for info in infos:
+            if info['image_index'] in evaluator.scenes:
+                found.append(info)
+            else:
+                yield info, '__INVALID__', 'no scene with this image_index'
+        if found:
+            found_groups.append((nodes, found))
+    for info, predicted in evaluator.answer_groups(found_groups):
+        # Programs that end in a set of objects or parts never match
+        if predicted != '__INVALID__' and not isinstance(predicted, list):
+            predicted = gen.format_answer(predicted, evaluator.metadata)
+        yield info, predicted, None
+
+
+def main(args):
+    tic = time.time()
+    print('Loading scenes from "%s"' % args.input_scene_file)
+    scenes = verify_questions.load_scenes(args.input_scene_file)
+    metadata = gen.load_metadata(args.metadata_file)
+    predicted_programs = None
+    if args.predicted_programs_file is not None:
+        predicted_programs = load_predicted_programs(args.predicted_programs_file)
+    questions = verify_questions.iter_questions(args.input_questions_file)
+    groups, failed = group_by_program(questions, metadata, predicted_programs)
+    num_questions = len(failed) + sum(len(infos) for _, infos in groups.values())
+    print('Loaded %d questions with %d distinct programs in %.1fs' % (
+          num_questions, len(groups), time.time() - tic))
+
+    out = None
+    if args.output_answers_file is not None:
+        out = open(args.output_answers_file, 'w')
+
+    # family -> [num_questions, num_correct, num_invalid]
+    stats = collections.defaultdict(lambda: [0, 0, 0])
+    results = [(info, '__INVALID__', error) for info, error in failed]
+    tic = time.time()
+    evaluator = ProgramEvaluator(scenes, metadata, backend=args.backend,
+                                 chunk_size=args.scenes_per_chunk)
+    num_answered = 0
+    for info, predicted, error in itertools.chain(results, evaluate(groups, evaluator)):
+        num_answered += 1
+        counts = stats[info['family']]
+        counts[0] += 1
+        counts[1] += predicted == info['answer'] and predicted != '__INVALID__'
+        counts[2] += predicted == '__INVALID__'
+        if out is not None:
+            record = {'question_index': info['question_index'],
+                      'image_index': info['image_index'], 'predicted': predicted}
+            if error is not None:
+                record['error'] = error
+            out.write(json.dumps(record) + '\n')
+        if num_answered % 10000 == 0:
+            print('answered %d questions (%.0f questions/s)' % (
+                  num_answered, num_answered / max(time.time() - tic, 1e-6)), end='\r')
+    elapsed = time.time() - tic
+    if out is not None:
+        out.close()
+
+    total = [sum(counts[i] for counts in stats.values()) for i in range(3)]
+    for family in sorted(stats):
+        n, correct, invalid = stats[family]
+        print('%-40s %6d questions  %6.2f%% correct  %d invalid' % (
+              family, n, 100.0 * correct / n, invalid))
+    print('%d questions, %d distinct programs, %.2f%% correct, %d invalid, ' \
+          '%.1fs (%.0f questions/s)' % (
+          total[0], len(groups), 100.0 * total[1] / max(total[0], 1), total[2],
+          elapsed, total[0] / max(elapsed, 1e-6)))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump({
+                'num_questions': total[0],
+                'num_programs': len(groups),
+                'seconds': elapsed,
+                'questions_per_second': total[0] / max(elapsed, 1e-6),
+                'accuracy': float(total[1]) / max(total[0], 1),
+                'num_invalid': total[2],
+                'families': {family: {
+                    'num_questions': n,
+                    'accuracy': float(correct) / n,
+                    'num_invalid': invalid,
+                } for family, (n, correct, invalid) in stats.items()},
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,119 @@
+"""
+Side-effect-free execution of programs, for answering questions from several
+threads at once (e.g. scoring model predictions in a long-running process).
+
+answer_question keeps its caches in the scenes it is given (the SceneIndex in
+scene_struct['_index'], the scene key of the subprogram cache), in the
+metadata (the handler table, attribute tables) and in the programs (the last
+run of a CompiledProgram). An Executor prepares everything it needs from the
+metadata up front and then keeps all per-scene state in explicit
+question_engine.SceneContext objects, so answering never modifies the scenes
+or the programs it is given. The only exception is the metadata: a filter on
+a value that is not in the metadata (e.g. in a predicted program) memoizes
+the attribute values it keeps in the attribute tables, a single dict
+assignment of an immutable value that is safe from several threads:
+
+executor = Executor(metadata, scenes)   # scenes: list, or dict by image_index
+answers = executor.evaluate(programs, scene_ids)
+answers = executor.evaluate(programs, scene_ids, pool=ThreadPool(8))
+
+Answers are the same as those of answer_question.
+"""
+
+import threading
+from collections import OrderedDict
+
+import question_engine as qeng
+from scene_index import get_part_stride, get_attribute_tables
+
+
+class Executor(object):
+    """
+    Answers programs on the scenes it was given, identified by image_index.
+    The contexts of the max_contexts most recently used scenes are kept.
+    """
+
+    def __init__(self, metadata, scenes=None, max_contexts=1000):
+        self.metadata = metadata
+        # Build the caches that are otherwise stashed in the metadata on first
+        # use, so that nothing is added to it while answering
+        qeng.get_execute_handlers(metadata)
+        get_part_stride(metadata)
+        get_attribute_tables(metadata)
+        if isinstance(scenes, list):
+            scenes = {scene['image_index']: scene for scene in scenes}
+        self.scenes = scenes if scenes is not None else {}
+        self.max_contexts = max_contexts
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def context(self, scene_id):
+        """
+        The SceneContext of a scene, created on first use.
+        """
+        with self._lock:
+            context = self._contexts.get(scene_id)
+            if context is not None:
+                self._contexts.move_to_end(scene_id)
+                return context
+        # Build the context outside the lock; if two threads race, one of the
+        # two equivalent contexts wins
+        context = qeng.SceneContext(self.scenes[scene_id], self.metadata)
+        with self._lock:
+            context = self._contexts.setdefault(scene_id, context)
+            self._contexts.move_to_end(scene_id)
+            while len(self._contexts) > self.max_contexts:
+                self._contexts.popitem(last=False)
+        return context
+
+    def compile(self, program):
+        """
+        Compile a program (a list of nodes, a dict with 'nodes' or a
+        CompiledProgram) for execute_in. Programs are compiled and keyed
+        from scratch, so the CompiledProgram is not shared with the caller.
+        """
+        if isinstance(program, qeng.CompiledProgram):
+            program = program.nodes
+        program = qeng.compile_program(program, self.metadata)
+        program.keys
+        return program
+
+    def answer(self, program, scene_id, all_outputs=False):
+        """
+        Answer one program (nodes, a dict with 'nodes' or a CompiledProgram)
+        on one scene. The program is compiled for every call; to answer the
+        same program many times, use evaluate.
+        """
+        program = self.compile(program)
+        return program.execute_in(self.context(scene_id), all_outputs=all_outputs)
+
+    def _answer_group(self, task):
+        scene_id, items = task
+        context = self.context(scene_id)
+        return [(i, program.execute_in(context, all_outputs=all_outputs))
+                for i, program, all_outputs in items]
+
+    def evaluate(self, programs, scene_ids, all_outputs=False, pool=None):
+        """
+        Answer programs[i] on scene scene_ids[i] for every i and return the
+        list of answers. Programs are compiled once each, and the pairs are
+        answered grouped by scene; with a pool (anything with a map method,
+        such as multiprocessing.pool.ThreadPool or a
+        concurrent.futures.ThreadPoolExecutor) the scenes are answered in
+        parallel.
+        """
+        assert len(programs) == len(scene_ids)
+        compiled = {}
+        groups = OrderedDict()
+        for i, (program, scene_id) in enumerate(zip(programs, scene_ids)):
+            if id(program) not in compiled:
+                compiled[id(program)] = (program, self.compile(program))
+            groups.setdefault(scene_id, []).append(
+                (i, compiled[id(program)][1], all_outputs))
+
+        answers = [None] * len(programs)
+        map_fn = map if pool is None else pool.map
+        for results in map_fn(self._answer_group, list(groups.items())):
+            for i, answer in results:
+                answers[i] = answer
+        return answers
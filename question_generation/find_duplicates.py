@@ -0,0 +1,113 @@
+"""
+Find duplicate questions in a question file: questions about the same image
+whose programs have the same canonical form (see program_index.py). With
+--input_scene_file, programs that only differ in filters that change nothing on
+the image (e.g. redundant filters added with --remove_redundant < 0) are
+reported as semantic duplicates as well.
+
+Questions are streamed from the file (JSON or JSON lines, as for
+verify_questions.py) and only the hashes of the current image are kept, so the
+questions of an image are expected to be consecutive, as generate_questions.py
+writes them. Run it from the question_generation directory:
+
+python find_duplicates.py --input_questions_file ../output/superCLEVR_questions.json \
+    --input_scene_file ../output/superCLEVR_scenes.json \
+    --output_questions_file ../output/superCLEVR_questions_dedup.jsonl
+"""
+
+from __future__ import print_function
+import argparse, itertools, json, time
+
+import generate_questions as gen
+import verify_questions
+from program_index import DuplicateIndex
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_questions_file', default='../output/superCLEVR_questions.json',
+        help="Questions to check; a JSON file with a 'questions' list or a " +
+                 "JSON-lines file with one question per line")
+parser.add_argument('--input_scene_file', default=None,
+        help="If given, also find semantic duplicates on the scenes in this file")
+parser.add_argument('--metadata_file', default='metadata_part.json',
+        help="JSON file containing metadata about functions")
+parser.add_argument('--output_file', default=None,
+        help="If given, write a JSON report with all duplicates to this file")
+parser.add_argument('--output_questions_file', default=None,
+        help="If given, write the questions that are not duplicates to this " +
+                 "JSON-lines file")
+parser.add_argument('--max_reported', default=20, type=int,
+        help="How many duplicates to print")
+
+
+def find_duplicates(questions, scenes=None, metadata=None):
+    """
+    Yield (question, duplicate) for every question, where duplicate is None or
+    a dict describing which earlier question it duplicates.
+    """
+    seen_images = set()
+    for image_index, group in itertools.groupby(questions, key=lambda q: q['image_index']):
+        if image_index in seen_images:
+            print('warning: questions about image %s are not consecutive; ' \
+                  'duplicates across the gap are not found' % image_index)
+        seen_images.add(image_index)
+        scene_struct = scenes.get(image_index) if scenes is not None else None
+        index = DuplicateIndex(scene_struct, metadata)
+        for i, q in enumerate(group):
+            question_index = q.get('question_index', i)
+            semantic = scene_struct is not None and verify_questions.check_program(
+                verify_questions.to_engine_nodes(q['program']), metadata) is None
+            found = index.add(question_index, q['program'], semantic=semantic)
+            if found is None:
+                yield q, None
+            else:
+                yield q, {'image_index': image_index, 'question_index': question_index,
+                          'kind': found[0], 'duplicate_of': found[1]}
+
+
+def main(args):
+    scenes, metadata = None, None
+    if args.input_scene_file is not None:
+        print('Loading scenes from "%s"' % args.input_scene_file)
+        scenes = verify_questions.load_scenes(args.input_scene_file)
+        metadata = gen.load_metadata(args.metadata_file)
+
+    out = None
+    if args.output_questions_file is not None:
+        out = open(args.output_questions_file, 'w')
+
+    tic = time.time()
+    num_questions, duplicates = 0, []
+    questions = verify_questions.iter_questions(args.input_questions_file)
+    for q, duplicate in find_duplicates(questions, scenes, metadata):
+        num_questions += 1
+        if duplicate is not None:
+            duplicates.append(duplicate)
+        elif out is not None:
+            out.write(json.dumps(q) + '\n')
+        if num_questions % 10000 == 0:
+            print('checked %d questions, %d duplicates' % (num_questions,
+                  len(duplicates)), end='\r')
+    if out is not None:
+        out.close()
+
+    for duplicate in duplicates[:args.max_reported]:
+        print('duplicate', duplicate)
+    if len(duplicates) > args.max_reported:
+        print('... and %d more duplicates' % (len(duplicates) - args.max_reported))
+    num_semantic = sum(1 for d in duplicates if d['kind'] == 'semantic')
+    print('%d questions, %d exact and %d semantic duplicates, %.1fs' % (
+          num_questions, len(duplicates) - num_semantic, num_semantic,
+          time.time() - tic))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump({
+                'num_questions': num_questions,
+                'duplicates': duplicates,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
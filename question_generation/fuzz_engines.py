@@ -0,0 +1,377 @@
+"""
+Check the execution paths of the question engine against the reference
+handlers on random programs and random synthetic scenes, and time them.
+
+Programs are built at random from the function signatures in the metadata
+(inputs, side inputs and output types), so they cover combinations of nodes
+that the templates never produce. Every program is answered on every scene by
+each backend and the outputs are compared node by node with
+reference_engine.py:
+
+- compiled: question_engine without a cache
+- cached: question_engine with a SubprogramCache, answered twice
+- batched: batch_engine, all scenes at once
+- executor: executor.Executor, with its own per-scene contexts
+
+Run it from the question_generation directory:
+
+python fuzz_engines.py --num_programs 2000 --output_file fuzz_report.json
+
+With --function_file metadata.json only the CLEVR functions are used.
+"""
+
+from __future__ import print_function
+import argparse, json, random, time
+
+import question_engine as qeng
+import reference_engine
+import batch_engine
+import generate_questions as gen
+from executor import Executor
+from scene_index import get_super_partname
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--metadata_file', default='metadata_part.json',
+        help="JSON file containing metadata about functions and attribute values")
+parser.add_argument('--function_file', default=None,
+        help="If given, only use the functions of this metadata file (e.g. " +
+                 "metadata.json) in the random programs")
+parser.add_argument('--num_scenes', default=20, type=int,
+        help="Number of random scenes")
+parser.add_argument('--max_objects', default=10, type=int,
+        help="Maximum number of objects in a random scene")
+parser.add_argument('--num_programs', default=500, type=int,
+        help="Number of random programs")
+parser.add_argument('--max_depth', default=6, type=int,
+        help="Maximum depth of the random programs")
+parser.add_argument('--repeats', default=3, type=int,
+        help="How many times the programs are answered for timing")
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--max_reported', default=10, type=int,
+        help="How many mismatches to print")
+parser.add_argument('--output_file', default=None,
+        help="If given, write the mismatches and timings to this JSON file")
+
+
+def random_scene(metadata, max_objects, rng):
+    """
+    A scene with random objects, parts and left/right/front/behind relations
+    computed from random positions.
+    """
+    types = metadata['types']
+    # complete_parts needs the part list of every shape
+    shapes = [s for s in types['Shape'] if s in types['Partname']]
+    objects = []
+    for _ in range(rng.randint(1, max_objects)):
+        shape = rng.choice(shapes)
+        obj = {
+            'shape': shape,
+            'color': rng.choice(types['Color']),
+            'size': rng.choice(types['Size']),
+            'material': rng.choice(types['Material']),
+            '3d_coords': [rng.uniform(-3, 3), rng.uniform(-3, 3), 0.0],
+            'parts': {},
+        }
+        for part_name in types['Partname'].get(shape, []):
+            if rng.random() < 0.3:
+                obj['parts'][part_name] = {
+                    'color': rng.choice(types['Color']),
+                    'size': rng.choice(types['Size']),
+                    'material': rng.choice(types['Material']),
+                }
+        objects.append(obj)
+
+    relationships = {}
+    for relation, axis, sign in [('left', 0, -1), ('right', 0, 1),
+                                 ('front', 1, 1), ('behind', 1, -1)]:
+        relationships[relation] = [
+            [j for j, other in enumerate(objects) if j != i and
+             sign * (other['3d_coords'][axis] - obj['3d_coords'][axis]) > 0]
+            for i, obj in enumerate(objects)]
+    scene = {'objects': objects, 'relationships': relationships}
+    gen.complete_parts(scene, metadata) # the reference handlers use '_parts'
+    return scene
+
+
+def get_signatures(metadata, function_file=None):
+    """
+    Dict mapping each output type to the (name, input types, side input types)
+    of the functions that produce it; only functions that every backend can
+    answer are kept.
+    """
+    functions = metadata['functions']
+    if function_file is not None:
+        with open(function_file, 'r') as f:
+            functions = json.load(f)['functions']
+    handlers = qeng.get_execute_handlers(metadata)
+    signatures = {}
+    for f in functions:
+        if f.get('template_only') or f['name'] not in handlers:
+            continue
+        signature = (f['name'], f['inputs'], f.get('side_inputs', []))
+        signatures.setdefault(f['output'], []).append(signature)
+    if 'PartSet' in signatures:
+        # The engine answers unique on parts too (metadata calls it uniquepart)
+        signatures.setdefault('Part', []).append(('unique', ['PartSet'], []))
+    return signatures
+
+
+def _min_depths(signatures):
+    # Smallest depth of a program producing each type
+    depths, changed = {}, True
+    while changed:
+        changed = False
+        for output, funcs in signatures.items():
+            for name, inputs, _ in funcs:
+                if all(t in depths for t in inputs):
+                    d = 1 + max([depths[t] for t in inputs] + [0])
+                    if d < depths.get(output, float('inf')):
+                        depths[output] = d
+                        changed = True
+    return depths
+
+
+def side_input_values(metadata, scene, value_type, rng):
+    # Values from the scene most of the time, so that filters are not always
+    # empty; hypershapes and super-partnames exercise the attribute tables
+    types = metadata['types']
+    if value_type == 'Relation':
+        return types['Relation']
+    objects = scene['objects']
+    parts = [part for obj in objects for part in obj['_parts'].values()]
+    if value_type == 'Shape':
+        values = sorted(metadata['_attribute_tables']['shape'][1])
+        in_scene = [obj['shape'] for obj in objects]
+        in_scene += [metadata['_shape_hier'][s] for s in in_scene]
+    elif value_type == 'PartName':
+        values = sorted(metadata['_attribute_tables']['partname'][0])
+        in_scene = [part['partname'] for part in parts]
+        in_scene += [get_super_partname(p) for p in in_scene]
+    else:
+        attribute = value_type.lower()
+        values = types[value_type]
+        in_scene = [obj[attribute] for obj in objects] + [part[attribute] for part in parts]
+    if in_scene and rng.random() < 0.8:
+        return in_scene
+    return values
+
+
+def random_program(signatures, metadata, scene, max_depth, rng):
+    """
+    A random program; its output type is chosen at random among the types
+    that can be produced within max_depth.
+    """
+    depths = _min_depths(signatures)
+    nodes = []
+
+    def build(output_type, depth):
+        candidates = [f for f in signatures[output_type]
+                      if all(depths[t] <= depth - 1 for t in f[1])]
+        name, inputs, side_inputs = rng.choice(candidates)
+        node = {'type': name, 'inputs': [build(t, depth - 1) for t in inputs]}
+        if side_inputs:
+            node['side_inputs'] = [
+                rng.choice(side_input_values(metadata, scene, t, rng))
+                for t in side_inputs]
+        nodes.append(node)
+        return len(nodes) - 1
+
+    output_types = [t for t in signatures if depths.get(t, max_depth + 1) <= max_depth]
+    build(rng.choice(output_types), max_depth)
+    return nodes
+
+
+def _normalize(kind, output):
+    # Sets are compared regardless of order (the reference part2object is not
+    # sorted)
+    if kind in ('ObjectSet', 'PartSet') and type(output) == list:
+        return sorted(output)
+    return output
+
+
+def run_backends(programs, scenes, metadata):
+    """
+    Answer every program on every scene with every backend. Returns a dict
+    mapping backend names to lists (per program) of lists (per scene) of node
+    outputs.
+    """
+    batch = batch_engine.SceneBatch(scenes, metadata)
+    executor = Executor(metadata, dict(enumerate(scenes)))
+    results = {name: [] for name in ['reference', 'compiled', 'cached', 'batched',
+                                     'executor']}
+    for nodes in programs:
+        program = qeng.CompiledProgram(nodes, metadata)
+        cache = qeng.SubprogramCache()
+        results['reference'].append([
+            reference_engine.answer_question({'nodes': nodes}, metadata, s, all_outputs=True)
+            for s in scenes])
+        results['compiled'].append([
+            program.execute(s, all_outputs=True, cache_outputs=False) for s in scenes])
+        for s in scenes:
+            program.execute(s, cache=cache)
+        results['cached'].append([
+            qeng.CompiledProgram(nodes, metadata).execute(s, all_outputs=True, cache=cache)
+            for s in scenes])
+        by_node = batch_engine.BatchProgram(nodes, metadata).execute(batch, all_outputs=True)
+        results['batched'].append([[outputs[n] for outputs in by_node]
+                                   for n in range(len(scenes))])
+        results['executor'].append(executor.evaluate(
+            [nodes] * len(scenes), list(range(len(scenes))), all_outputs=True))
+    return results
+
+
+def compare(programs, scenes, metadata, results):
+    """
+    List of mismatches between each backend and the reference.
+    """
+    mismatches = []
+    for p, nodes in enumerate(programs):
+        kinds = qeng.CompiledProgram(nodes, metadata).kinds
+        for n in range(len(scenes)):
+            expected = results['reference'][p][n]
+            for name, backend in results.items():
+                if name == 'reference':
+                    continue
+                got = backend[p][n]
+                # the engine stops at the first invalid node, the batched
+                # engine marks all following nodes invalid
+                pairs = list(enumerate(got[:len(expected)]))
+                if len(got) < len(expected):
+                    pairs.append((len(got), None))
+                for i, output in pairs:
+                    if _normalize(kinds[i], output) != _normalize(kinds[i], expected[i]):
+                        mismatches.append({
+                            'backend': name, 'program': p, 'scene': n, 'node': i,
+                            'node_type': nodes[i]['type'], 'expected': expected[i],
+                            'got': output, 'nodes': nodes,
+                        })
+                        break
+    return mismatches
+
+
+def time_backends(programs, scenes, metadata, repeats):
+    """
+    Seconds per program and scene of each backend, and per node type
+    timings of the reference and compiled backends.
+    """
+    num = max(len(programs) * len(scenes) * repeats, 1)
+    report = {}
+
+    # Reference: the loop of reference_engine.answer_question, timing each
+    # handler call
+    handlers = reference_engine.make_execute_handlers(metadata)
+    per_type = {}
+    tic = time.time()
+    for _ in range(repeats):
+        for nodes in programs:
+            for s in scenes:
+                outputs = []
+                for node in nodes:
+                    t = time.time()
+                    out = handlers[node['type']](s, [outputs[idx] for idx in node['inputs']],
+                                                 node.get('side_inputs', []))
+                    stats = per_type.setdefault(node['type'], [0, 0.0])
+                    stats[0] += 1
+                    stats[1] += time.time() - t
+                    outputs.append(out)
+                    if out == '__INVALID__':
+                        break
+    report['reference'] = {'us_per_program': 1e6 * (time.time() - tic) / num,
+                           'node_types': _node_type_report(per_type)}
+
+    # Compiled: per node type timings from the engine profiler, which wraps
+    # the handlers of the programs compiled while it is enabled
+    qeng.enable_profiling()
+    compiled = [qeng.CompiledProgram(nodes, metadata) for nodes in programs]
+    tic = time.time()
+    for _ in range(repeats):
+        for program in compiled:
+            for s in scenes:
+                program.execute(s, cache_outputs=False)
+    elapsed = time.time() - tic
+    profile = qeng.disable_profiling()
+    report['compiled'] = {'us_per_program': 1e6 * elapsed / num,
+                          'node_types': _node_type_report(
+                              {t: (st['calls'], st['seconds'])
+                               for t, st in profile.stats.items()})}
+    # The profiler adds overhead to the handlers; time the programs without it
+    compiled = [qeng.CompiledProgram(nodes, metadata) for nodes in programs]
+    tic = time.time()
+    for _ in range(repeats):
+        for program in compiled:
+            for s in scenes:
+                program.execute(s, cache_outputs=False)
+    report['compiled']['us_per_program'] = 1e6 * (time.time() - tic) / num
+
+    batch = batch_engine.SceneBatch(scenes, metadata)
+    for nodes in programs: # build the scene arrays before timing
+        batch_engine.BatchProgram(nodes, metadata).execute(batch)
+    tic = time.time()
+    for _ in range(repeats):
+        for nodes in programs:
+            batch_engine.BatchProgram(nodes, metadata).execute(batch)
+    report['batched'] = {'us_per_program': 1e6 * (time.time() - tic) / num}
+    return report
+
+
+def _node_type_report(per_type):
+    return {t: {'calls': calls, 'us_per_call': 1e6 * seconds / max(calls, 1)}
+            for t, (calls, seconds) in sorted(per_type.items())}
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    metadata = gen.load_metadata(args.metadata_file)
+    signatures = get_signatures(metadata, args.function_file)
+    scenes = [random_scene(metadata, args.max_objects, rng)
+              for _ in range(args.num_scenes)]
+    # Side inputs are drawn from one of the scenes; most random programs have
+    # a unique node that fails, so a few tries are made to find one that is
+    # valid on that scene
+    programs = []
+    for _ in range(args.num_programs):
+        scene = rng.choice(scenes)
+        for _ in range(20):
+            nodes = random_program(signatures, metadata, scene, args.max_depth, rng)
+            if reference_engine.answer_question({'nodes': nodes}, metadata,
+                                                scene) != '__INVALID__':
+                break
+        programs.append(nodes)
+    print('%d random programs on %d random scenes' % (len(programs), len(scenes)))
+
+    results = run_backends(programs, scenes, metadata)
+    mismatches = compare(programs, scenes, metadata, results)
+    num_invalid = sum(1 for per_scene in results['reference'] for outputs in per_scene
+                      if outputs[-1] == '__INVALID__')
+    print('%d of %d answers are invalid' % (num_invalid, len(programs) * len(scenes)))
+    for m in mismatches[:args.max_reported]:
+        print('mismatch', m)
+    print('%d mismatches' % len(mismatches))
+
+    timings = time_backends(programs, scenes, metadata, args.repeats)
+    print('%-12s %14s' % ('backend', 'us/program'))
+    for name, res in timings.items():
+        print('%-12s %14.1f' % (name, res['us_per_program']))
+    print('\n%-22s %10s %18s %18s' % ('node type', 'calls', 'reference us/call',
+          'compiled us/call'))
+    for t, res in timings['reference']['node_types'].items():
+        compiled = timings['compiled']['node_types'].get(t, {'us_per_call': float('nan')})
+        print('%-22s %10d %18.2f %18.2f' % (t, res['calls'], res['us_per_call'],
+              compiled['us_per_call']))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump({
+                'num_programs': len(programs),
+                'num_scenes': len(scenes),
+                'num_invalid': num_invalid,
+                'mismatches': mismatches,
+                'timings': timings,
+            }, f, indent=2)
+    return mismatches
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
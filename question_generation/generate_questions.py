@@ -6,16 +6,20 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import argparse, json, os, itertools, random, shutil
+import argparse, json, os, itertools, random, shutil, multiprocessing, zlib
 import time
 import re
 import pdb
 import copy
 from pprint import pprint
 import numpy as np
-from sqlalchemy import null 
 
 import question_engine as qeng
+from program_index import DuplicateIndex
+from question_traces import TraceRecorder, TraceWriter
+from scene_stream import SceneFile
+from question_writer import QuestionWriter
+from checkpoint import Checkpointer, checkpoint_path
 
 """
 Generate synthetic questions and answers for CLEVR images. Input is a single
@@ -64,6 +68,11 @@ parser.add_argument('--template_dir', default='CLEVR_1.0_templates',
 parser.add_argument('--output_questions_file',
         default='../output/CLEVR_questions.json',
         help="The output file to write containing generated questions")
+parser.add_argument('--output_format', default=None, choices=['jsonl', 'json', 'legacy'],
+        help="Layout of the output file: one question per line, a JSON array of " +
+                 "questions, or the legacy {'info': ..., 'questions': [...]} object. " +
+                 "Defaults to jsonl for a .jsonl file and legacy otherwise; questions " +
+                 "are written as they are generated in all three")
 
 # Control which and how many images to process
 parser.add_argument('--scene_start_idx', default=0, type=int,
@@ -85,6 +94,37 @@ parser.add_argument('--instances_per_template', default=1, type=int,
 # Misc
 parser.add_argument("--remove_redundant", type = float, default = 0.0, 
         help="-1.0 ~ +1.0. Filter out (>0) or add (<0) redundant filters in the question generation prodecure. Will filter out with probability, default is 0, no filtering.")
+parser.add_argument('--output_traces_file', default=None,
+        help="If given, also write the output of every program node of every question " +
+                 "to this binary file, indexed by question_index (see question_traces.py)")
+parser.add_argument('--drop_duplicates', default='none', choices=['none', 'exact', 'semantic'],
+        help="Drop questions whose program has the same canonical form as an earlier " +
+                 "question about the same image ('exact'), or also the same form after " +
+                 "removing filters that change nothing on the image ('semantic'); " +
+                 "see program_index.py")
+parser.add_argument('--workers', default=1, type=int,
+        help="Number of worker processes; with more than 1 the scenes are split " +
+                 "into shards of --scenes_per_shard scenes that are generated in " +
+                 "parallel and merged into one output file")
+parser.add_argument('--scenes_per_shard', default=0, type=int,
+        help="Scenes per shard with --workers; each shard starts with fresh " +
+                 "template and answer counts, like a separate run. 0 uses " +
+                 "--reset_counts_every, where counts are reset anyway; with a " +
+                 "multiple of it the output is the same as with --workers 1")
+parser.add_argument('--seed', default=0, type=int,
+        help="Root seed of the random streams; the questions of an image depend on " +
+                 "the seed, the image index and the template and answer counts, but " +
+                 "not on the other images or on --workers")
+parser.add_argument('--checkpoint_every', default=100, type=int,
+        help="Save a checkpoint of the run every this many scenes (rounded up to " +
+                 "whole shards with --workers), so that it can be continued with " +
+                 "--resume; 0 disables checkpoints")
+parser.add_argument('--checkpoint_file', default=None,
+        help="Where to save checkpoints; defaults to the output file with a " +
+                 ".checkpoint suffix. It is removed when the run completes")
+parser.add_argument('--resume', action='store_true',
+        help="Continue the run from its last checkpoint, with the same arguments; " +
+                 "the output is the same as that of an uninterrupted run")
 parser.add_argument('--reset_counts_every', default=250, type=int,
         help="How often to reset template and answer counts. Higher values will " +
                  "result in flatter distributions over templates and answers, but " +
@@ -95,12 +135,52 @@ parser.add_argument('--time_dfs', action='store_true',
         help="Time each depth-first search; must be given with --verbose")
 parser.add_argument('--profile', action='store_true',
         help="If given then run inside cProfile")
+parser.add_argument('--profile_handlers', default=None,
+        help="If given, record per node type call counts, timings, cache hits " +
+                 "and output sizes of the question engine and write them to this JSON file")
 # args = parser.parse_args()
 
 
+def make_rng(seed, *keys):
+    """
+    A random.Random for the stream of (seed, *keys), where keys are ints or
+    strings. Streams are derived with numpy.random.SeedSequence, so that they
+    are independent of each other and of the order in which they are used.
+    SeedSequence only takes non-negative entropy, so negative seeds (and keys)
+    are taken modulo 2**64.
+    """
+    entropy = [k & 0xFFFFFFFFFFFFFFFF if isinstance(k, int)
+               else zlib.crc32(k.encode('utf-8')) for k in (seed,) + keys]
+    state = np.random.SeedSequence(entropy).generate_state(4)
+    return random.Random(int.from_bytes(state.tobytes(), 'little'))
+
+
+def scene_rng(scene_struct, *keys):
+    # Stream for the random choices made once per scene and cached in it (which
+    # redundant filters are dropped); the random module for scenes that were
+    # not given a '_rng_seed' by generate_questions_for_scenes
+    if '_rng_seed' not in scene_struct:
+        return random
+    return make_rng(*(tuple(scene_struct['_rng_seed']) + keys))
+
+
+def filter_option_mask(index, attr_keys, key, mask, is_part=False):
+    # Narrow mask down to the objects (or parts) that the filters in key keep,
+    # using the same scene index lookups as the filter handlers
+    for attr, value in zip(attr_keys, key):
+        if value is None:
+            continue
+        if is_part:
+            mask &= index.part_filter_mask(attr, value)
+        else:
+            mask &= index.filter_mask(attr, value)
+    return mask
+
+
 def precompute_filter_options(scene_struct, metadata, remove_redundant=False):
-    # Keys are tuples (size, color, shape, material) (where some may be None)
-    # and values are lists of object idxs that match the filter criterion
+    # Keys are tuples (size, color, material, shape) (where some may be None)
+    # and values are masks of the objects that match the filter criterion
+    index = qeng.get_scene_index(scene_struct, metadata)
     attribute_map = {}
 
     if metadata['dataset'] == 'CLEVR-v1.0':
@@ -116,9 +196,9 @@ def precompute_filter_options(scene_struct, metadata, remove_redundant=False):
             mask.append((i // (2 ** j)) % 2)
         masks.append(mask)
 
-    for object_idx, obj in enumerate(scene_struct['objects']):
+    for object_idx in range(index.num_objects):
         if metadata['dataset'] == 'CLEVR-v1.0':
-            keys = [tuple(obj[k] for k in attr_keys)]
+            keys = [tuple(index.object_values(k)[object_idx] for k in attr_keys)]
 
 
         for mask in masks:
@@ -135,26 +215,29 @@ def precompute_filter_options(scene_struct, metadata, remove_redundant=False):
                         masked_key.append(None)
                 masked_key = tuple(masked_key)
                 if masked_key not in attribute_map:
-                    attribute_map[masked_key] = set()
-                attribute_map[masked_key].add(object_idx)
+                    attribute_map[masked_key] = filter_option_mask(
+                        index, attr_keys, masked_key, index.all_objects)
 
                 # add hierarchy here
                 if masked_key[-1] is not None:
                     hypershape = metadata['_shape_hier'][masked_key[-1]]
                     masked_key = (masked_key[0], masked_key[1], masked_key[2], hypershape)
                     if masked_key not in attribute_map:
-                        attribute_map[masked_key] = set()
-                    attribute_map[masked_key].add(object_idx)
+                        attribute_map[masked_key] = filter_option_mask(
+                            index, attr_keys, masked_key, index.all_objects)
 
 
 
     if remove_redundant > 0.0:
-        attribute_map = drop_redundant_filters(attribute_map, remove_redundant)
+        attribute_map = drop_redundant_filters(attribute_map, remove_redundant,
+                                               rng=scene_rng(scene_struct, 'filter_options'))
 
     scene_struct['_filter_options'] = attribute_map
 
 
 def complete_parts(scene_struct, metadata):
+    # Adds the '_parts' dicts used by reference_engine.py; question_engine
+    # uses the part table of the scene index instead
     attr_keys = ['size', 'color', 'material']#, 'Partname']
     for object_idx, obj in enumerate(scene_struct['objects']):
         obj['_parts'] = {}
@@ -176,9 +259,12 @@ def precompute_partfilter_options(scene_struct, metadata, obj_idx, remove_redund
     for each object (given obj_idx) in scene_struct['objects'], 
     add a ['_partfilter_options'] field that stores the part filtering info. 
     
-    # Keys are tuples (size, color, shape, material) (where some may be None)
-    # and values are lists of object idxs that match the filter criterion
+    # Keys are tuples (size, color, material, partname) (where some may be None)
+    # and values are masks of the parts (packed part ids) of this object that
+    # match the filter criterion
     '''
+    index = qeng.get_scene_index(scene_struct, metadata)
+    object_parts = index.parts_of(1 << obj_idx)
     attribute_map = {}
 
     if metadata['dataset'] == 'CLEVR-v1.0':
@@ -194,8 +280,8 @@ def precompute_partfilter_options(scene_struct, metadata, obj_idx, remove_redund
             mask.append((i // (2 ** j)) % 2)
         masks.append(mask)
     
-    assert '_parts' in scene_struct['objects'][obj_idx]
-    for part_idx, part in scene_struct['objects'][obj_idx]['_parts'].items():
+    for part_id in qeng.mask_to_list(object_parts):
+        part = index.parts[part_id]
         keys = [tuple(part[k] for k in attr_keys)]
 
         for mask in masks:
@@ -212,107 +298,176 @@ def precompute_partfilter_options(scene_struct, metadata, obj_idx, remove_redund
                         masked_key.append(None)
                 masked_key = tuple(masked_key)
                 if masked_key not in attribute_map:
-                    attribute_map[masked_key] = set()
-                attribute_map[masked_key].add(part_idx)
+                    attribute_map[masked_key] = filter_option_mask(
+                        index, attr_keys, masked_key, object_parts, is_part=True)
                 # add hierarchy here
                 if masked_key[-1] is not None:
-                    special_words = ['right', 'left', 'front', 'back', 'center', 'mid', 's']
-                    super_partname = '_'.join([a for a in masked_key[-1].split('_') if a not in special_words])
+                    super_partname = qeng.get_super_partname(masked_key[-1])
                     if super_partname != masked_key[-1]:
                         masked_key = (masked_key[0], masked_key[1], masked_key[2], super_partname)
                         if masked_key not in attribute_map:
-                            attribute_map[masked_key] = set()
-                        attribute_map[masked_key].add(part_idx)
+                            attribute_map[masked_key] = filter_option_mask(
+                                index, attr_keys, masked_key, object_parts, is_part=True)
                 
 
     attribute_map.pop((None, None, None, None)) # does not allow empty filter for parts
-    if remove_redundant:
-        attribute_map = drop_redundant_filters(attribute_map, remove_redundant)
+    if remove_redundant > 0.0:
+        attribute_map = drop_redundant_filters(
+            attribute_map, remove_redundant,
+            rng=scene_rng(scene_struct, 'partfilter_options', obj_idx))
 
     scene_struct['objects'][obj_idx]['_partfilter_options'] = attribute_map
     
-def subsumes(k1, k2):
+def generalizations(key):
     """
-    Let k1 subsume k2 if 2 conditions are met:
-    1. for all indices in k2 that are not None, k1 is equal to k2
-    2. for some index in k2 that is None, k1 is not None
-    i.e. k1 is more restrictive than k2 
+    All keys that key subsumes: key with one or more of its filters set to None
     """
-    assert(len(k1) == len(k2))
-    any_different = False
-    # go up to the last element, which is the object type 
-    for i in range(len(k2)):
-        # condition 1 
-        if k2[i] is not None and k1[i] != k2[i]:
-            return False
-        # condition 2 
-        if k2[i] is None and k1[i] is not None:
-            any_different = True
-    return any_different 
-
-def drop_redundant_filters(attribute_map, p_remove):            
-    to_drop = []
+    idxs = [i for i, v in enumerate(key) if v is not None]
+    for n in range(1, 2 ** len(idxs)):
+        k = list(key)
+        for j, i in enumerate(idxs):
+            if (n >> j) & 1:
+                k[i] = None
+        yield tuple(k)
+
+def drop_redundant_filters(attribute_map, p_remove, rng=random):            
+    # For every pair (k1, k2) where k1 subsumes k2 without keeping fewer
+    # objects, drop k1 with probability p_remove. The keys that k1 subsumes are
+    # looked up directly instead of comparing all pairs of keys, but pairs are
+    # visited in the same order so the same random draws are made.
+    keys = list(attribute_map.keys())
+    ranks = {k: i for i, k in enumerate(keys)}
+    to_drop = set()
     for k1, denot1 in attribute_map.items():
-        for k2, denot2 in attribute_map.items(): 
-            if k1 == k2:
-                continue
-            if subsumes(k1, k2):
-                # sanity check 
-                assert(len(denot1) <= len(denot2)) 
-                if len(denot1) == len(denot2):
-                    do_remove = np.random.choice([True, False], p=[p_remove, 1-p_remove])
-                    if do_remove:
-                        to_drop.append(k1)
+        size1 = qeng.popcount(denot1)
+        for r in sorted(ranks[k2] for k2 in generalizations(k1) if k2 in ranks):
+            # sanity check 
+            size2 = qeng.popcount(attribute_map[keys[r]])
+            assert(size1 <= size2) 
+            if size1 == size2:
+                do_remove = rng.random() < p_remove
+                if do_remove:
+                    to_drop.add(k1)
 
     # use None as sentinel for later 
     # new_attribute_map = {k:v if k not in to_drop else None for k, v in attribute_map.items()}
     new_attribute_map = {k:v for k, v in attribute_map.items() if k not in to_drop}
     return new_attribute_map
-    
-def find_partfilter_options(objectpart_idxs, scene_struct, metadata, remove_redundant=0.0):
-    # objectpart_idxs: dicts{obj_id: [part_ids]}
-    # Keys are tuples (size, color, Partname, material) (where some may be None)
-    # and values are dicts{obj_id: [part_ids]} that match the filter criterion
 
+
+def precompute_filter_options_by_object(scene_struct):
+    '''
+    Index the filter options of a scene by object, so that the filters that
+    pick out a single object are found without going through all of them.
+
+    '_filter_options_by_object' maps each object idx to the (rank, key, mask) of
+    the filter options that keep it, rank being the position of key in
+    '_filter_options'; key picks out only the object from an input mask if
+    mask & input is the object alone.
+    '''
+    object_options = {}
+    for rank, (k, vs) in enumerate(scene_struct['_filter_options'].items()):
+        for object_idx in qeng.mask_to_list(vs):
+            object_options.setdefault(object_idx, []).append((rank, k, vs))
+    scene_struct['_filter_options_by_object'] = object_options
+
+
+def precompute_partfilter_options_by_part(scene_struct, obj_idx):
+    # Same as precompute_filter_options_by_object for the '_partfilter_options'
+    # of one object, by packed part id
+    obj = scene_struct['objects'][obj_idx]
+    part_options = {}
+    for rank, (k, vs) in enumerate(obj['_partfilter_options'].items()):
+        for part_id in qeng.mask_to_list(vs):
+            part_options.setdefault(part_id, []).append((rank, k, vs))
+    obj['_partfilter_options_by_part'] = part_options
+
+
+def group_parts_by_object(part_mask, index):
+    # {obj_idx: mask of the packed part ids of part_mask in that object}
     part_idxs = {}
-    for idx in objectpart_idxs:
-        
-        obj_idx, part_idx = [int(a) for a in idx.split('_')]
-        if obj_idx not in part_idxs:
-            part_idxs[obj_idx] = set()
-        part_idxs[obj_idx].add(part_idx)
+    for part_id in qeng.mask_to_list(part_mask):
+        obj_idx = part_id // index.part_stride
+        part_idxs[obj_idx] = part_idxs.get(obj_idx, 0) | (1 << part_id)
+    return part_idxs
+
+def find_partfilter_options(part_mask, scene_struct, metadata, remove_redundant=0.0):
+    # part_mask: mask of packed part ids
+    # Keys are tuples (size, color, material, Partname) (where some may be None)
+    # and values are dicts{obj_id: mask of part ids} that match the filter criterion
+    index = qeng.get_scene_index(scene_struct, metadata)
+    part_idxs = group_parts_by_object(part_mask, index)
         
     attribute_map = {}
     for obj_idx in part_idxs:
         if '_partfilter_options' not in scene_struct['objects'][obj_idx]:
             precompute_partfilter_options(scene_struct, metadata, obj_idx, remove_redundant=remove_redundant)
 
-        part_idx_list = set(part_idxs[obj_idx])
+        part_mask = part_idxs[obj_idx]
         for k, vs in scene_struct['objects'][obj_idx]['_partfilter_options'].items():
-            res = list(part_idx_list & vs)
             if k not in attribute_map:
                 attribute_map[k] = {}
-            if obj_idx not in attribute_map[k]:
-                attribute_map[k][obj_idx] = set()
-            attribute_map[k][obj_idx].update(res)
+            attribute_map[k][obj_idx] = attribute_map[k].get(obj_idx, 0) | (part_mask & vs)
 
     return attribute_map
 
-def find_filter_options(object_idxs, scene_struct, metadata, remove_redundant=0.0):
-    # Keys are tuples (size, color, shape, material) (where some may be None)
+def find_unique_partfilter_options(part_mask, scene_struct, metadata, remove_redundant=0.0):
+    # The options of find_partfilter_options that keep a single part: the key
+    # is an option of only one of the objects and keeps one of its parts
+    index = qeng.get_scene_index(scene_struct, metadata)
+    part_idxs = group_parts_by_object(part_mask, index)
+    objects = scene_struct['objects']
+    for obj_idx in part_idxs:
+        if '_partfilter_options' not in objects[obj_idx]:
+            precompute_partfilter_options(scene_struct, metadata, obj_idx, remove_redundant=remove_redundant)
+        if '_partfilter_options_by_part' not in objects[obj_idx]:
+            precompute_partfilter_options_by_part(scene_struct, obj_idx)
+
+    options = []
+    for obj_idx, obj_parts in part_idxs.items():
+        others = [objects[o]['_partfilter_options'] for o in part_idxs if o != obj_idx]
+        part_options = objects[obj_idx]['_partfilter_options_by_part']
+        for part_id in qeng.mask_to_list(obj_parts):
+            bit = 1 << part_id
+            for rank, k, vs in part_options[part_id]:
+                if vs & obj_parts == bit and not any(k in o for o in others):
+                    options.append((obj_idx, rank, k, bit))
+    # Same order as find_partfilter_options
+    options.sort(key=lambda x: x[:2])
+    return {k: {obj_idx: bit} for obj_idx, _, k, bit in options}
+
+def find_filter_options(object_mask, scene_struct, metadata, remove_redundant=0.0):
+    # object_mask: mask of object idxs
+    # Keys are tuples (size, color, material, shape) (where some may be None)
     # and values are lists of object idxs that match the filter criterion
 
     if '_filter_options' not in scene_struct:
         precompute_filter_options(scene_struct, metadata, remove_redundant=remove_redundant)
 
     attribute_map = {}
-    object_idxs = set(object_idxs)
     for k, vs in scene_struct['_filter_options'].items():
-        attribute_map[k] = list(object_idxs & vs)
+        attribute_map[k] = qeng.mask_to_list(object_mask & vs)
     return attribute_map
 
+def find_unique_filter_options(object_mask, scene_struct, metadata, remove_redundant=0.0):
+    # The options of find_filter_options that keep a single object of object_mask
+    if '_filter_options' not in scene_struct:
+        precompute_filter_options(scene_struct, metadata, remove_redundant=remove_redundant)
+    if '_filter_options_by_object' not in scene_struct:
+        precompute_filter_options_by_object(scene_struct)
+
+    options = []
+    object_options = scene_struct['_filter_options_by_object']
+    for object_idx in qeng.mask_to_list(object_mask):
+        bit = 1 << object_idx
+        for rank, k, vs in object_options.get(object_idx, []):
+            if vs & object_mask == bit:
+                options.append((rank, k, object_idx))
+    options.sort(key=lambda x: x[0])
+    return {k: [object_idx] for _, k, object_idx in options}
+
 
-def add_empty_filter_options(attribute_map, metadata, num_to_add):
+def add_empty_filter_options(attribute_map, metadata, num_to_add, rng=random):
     # Add some filtering criterion that do NOT correspond to objects
 
     if metadata['dataset'] == 'CLEVR-v1.0':
@@ -327,13 +482,14 @@ def add_empty_filter_options(attribute_map, metadata, num_to_add):
 
     target_size = len(attribute_map) + num_to_add
     while len(attribute_map) < target_size:
-        k = tuple([random.choice(v) for v in attr_vals])
+        k = tuple([rng.choice(v) for v in attr_vals])
         if k not in attribute_map:
             attribute_map[k] = []
 
 
 def find_relate_filter_options(object_idx, scene_struct, metadata,
-        unique=False, include_zero=False, trivial_frac=0.1, remove_redundant=0.0):
+        unique=False, include_zero=False, trivial_frac=0.1, remove_redundant=0.0,
+        rng=random):
     options = {}
     if '_filter_options' not in scene_struct:
         precompute_filter_options(scene_struct, metadata, remove_redundant=remove_redundant)
@@ -341,24 +497,34 @@ def find_relate_filter_options(object_idx, scene_struct, metadata,
     # TODO: Right now this is only looking for nontrivial combinations; in some
     # cases I may want to add trivial combinations, either where the intersection
     # is empty or where the intersection is equal to the filtering output.
+    index = qeng.get_scene_index(scene_struct, metadata)
     trivial_options = {}
-    for relationship in scene_struct['relationships']:
-        related = set(scene_struct['relationships'][relationship][object_idx])
+    for relationship, relate_masks in index.relate_masks.items():
+        related = relate_masks[object_idx]
+        if unique:
+            # Look up the filters that keep a single related object
+            for filters, intersection in find_unique_filter_options(
+                    related, scene_struct, metadata).items():
+                if scene_struct['_filter_options'][filters] == 1 << intersection[0]:
+                    trivial_options[(relationship, filters)] = intersection
+                else:
+                    options[(relationship, filters)] = intersection
+            continue
         for filters, filtered in scene_struct['_filter_options'].items():
             intersection = related & filtered
             trivial = (intersection == filtered)
-            if unique and len(intersection) != 1: continue
-            if not include_zero and len(intersection) == 0: continue
+            size = qeng.popcount(intersection)
+            if not include_zero and size == 0: continue
             if trivial:
-                trivial_options[(relationship, filters)] = sorted(list(intersection))
+                trivial_options[(relationship, filters)] = qeng.mask_to_list(intersection)
             else:
-                options[(relationship, filters)] = sorted(list(intersection))
+                options[(relationship, filters)] = qeng.mask_to_list(intersection)
 
     N, f = len(options), trivial_frac
     num_trivial = int(round(N * f / (1 - f)))
     trivial_options = list(trivial_options.items())
     # trivial_options = sorted(trivial_options, key = lambda x: str(x))
-    random.shuffle(trivial_options)
+    rng.shuffle(trivial_options)
     for k, v in trivial_options[:num_trivial]:
         options[k] = v
 
@@ -410,7 +576,7 @@ def other_heuristic(text, param_vals):
     return text
 
 
-def get_question_hash(image_idx, scene_struct, _question, text):
+def get_question_hash(image_idx, scene_struct, question, text, metadata):
     """
     get a question hash that can be compared whether or not we have redundant 
     descriptions in referring expressions. Should be based on:
@@ -418,13 +584,17 @@ def get_question_hash(image_idx, scene_struct, _question, text):
     - the query part 
     - the query attribute 
     """
-    question = copy.deepcopy(_question)
     obj_name, part_name, query_name = None, None, None
     if question == "ERROR": 
         return "ERROR"
+    # The question was just answered on this scene, so its values come from
+    # the engine cache
+    program = qeng.CompiledProgram(question, metadata)
+    values = program.values(scene_struct)
+    index = qeng.get_scene_index(scene_struct, metadata)
     query_start = question[-1]
     query_type = query_start['type']
-    parents = query_start['inputs']
+    parents = list(query_start['inputs'])
 
     ops = []
     while len(parents) > 0:
@@ -432,18 +602,18 @@ def get_question_hash(image_idx, scene_struct, _question, text):
         filter_step = question[par_idx]
 
         if filter_step['type'] == 'unique': 
-            output = filter_step['_output']
-            if type(output) == str and "_" in output:
-                object_idx, part_idx = [int(x) for x in output.split("_")]
+            output = values[par_idx]
+            if program.kinds[par_idx] == 'Part':
+                object_idx, part_id = output // index.part_stride, output
             else:
-                object_idx, part_idx = output, None
+                object_idx, part_id = output, None
 
             obj = scene_struct['objects'][object_idx]
             obj_name = obj['shape']
             obj_name = f"{object_idx}_{obj_name}"
             ops.append(obj_name)
-            if part_idx is not None:
-                part_name = obj['_parts'][part_idx]['partname']
+            if part_id is not None:
+                part_name = index.parts[part_id]['partname']
                 ops.append(part_name)
             
             parents += filter_step['inputs']
@@ -466,7 +636,6 @@ def get_equivalent_filter(k, keys, options):
         return None
     return random.choice(equivalent_filters)
 
-
 def instantiate_templates_dfs(scene_struct, 
                               template, 
                               metadata, 
@@ -474,7 +643,15 @@ def instantiate_templates_dfs(scene_struct,
                               synonyms, 
                               max_instances=None, 
                               remove_redundant=0.0,
-                              verbose=False):
+                              verbose=False,
+                              rng=random,
+                              instance_rngs=None,
+                              is_duplicate=None):
+    # rng makes the random choices of the search; the text of the i-th
+    # instance found is chosen with instance_rngs(i) if given, and also with
+    # rng otherwise. is_duplicate(i, nodes), if given, tells whether the i-th
+    # instance found asks a question that was already asked about the scene;
+    # such states are rejected before they count towards answer_counts
 
     param_name_to_type = {p['name']: p['type'] for p in template['params']} 
     
@@ -484,8 +661,10 @@ def instantiate_templates_dfs(scene_struct,
             p = constraint['params'][0]
             null_params.append(p)
 
+    initial_nodes = [node_shallow_copy(template['nodes'][0])]
     initial_state = {
-        'nodes': [node_shallow_copy(template['nodes'][0])],
+        'nodes': initial_nodes,
+        'program': qeng.CompiledProgram(initial_nodes, metadata),
         'vals': {},
         'input_map': {0: 0},
         'next_template_node': 1,
@@ -497,9 +676,11 @@ def instantiate_templates_dfs(scene_struct,
         state = states.pop()
 
         # Check to make sure the current state is valid
-        q = {'nodes': state['nodes']}
-        outputs = qeng.answer_question(q, metadata, scene_struct, all_outputs=True)
-        answer = outputs[-1] #len(outputs) is equal to len(state['nodes'], outputs contain answers after each node)
+        program = state['program']
+        # values are the engine values of every node (masks, object idxs and
+        # packed part ids); only the answer is converted to the output format
+        values = program.values(scene_struct)
+        answer = program.execute(scene_struct)
 
         if answer == '__INVALID__': continue
 
@@ -536,11 +717,13 @@ def instantiate_templates_dfs(scene_struct,
                 i, j = constraint['params']
                 i = state['input_map'].get(i, None)
                 j = state['input_map'].get(j, None)
-                if i is not None and j is not None and outputs[i] == outputs[j]:
+                if i is not None and j is not None and \
+                        program.to_output(program.kinds[i], values[i]) == \
+                        program.to_output(program.kinds[j], values[j]):
                     if verbose:
                         print('skipping due to OUT_NEQ constraint')
-                        print(outputs[i])
-                        print(outputs[j])
+                        print(values[i])
+                        print(values[j])
                     skip_state = True
                     break
             else:
@@ -577,25 +760,32 @@ def instantiate_templates_dfs(scene_struct,
             # degeneracy at the end
             has_relate = any(n['type'] == 'relate' for n in template['nodes'])
             if has_relate:
-                degen = qeng.is_degenerate(q, metadata, scene_struct, answer=answer,
+                degen = qeng.is_degenerate(program, metadata, scene_struct, answer=answer,
                                                                      verbose=verbose)
                 # if remove_redundant < 0, then keep degenerated questions with prob=-remove_redundant
-                degen &= (np.random.random() >= -remove_redundant)
+                degen &= (rng.random() >= -remove_redundant)
                 if degen:
                     reject_count += 1
                     continue
 
+            if is_duplicate is not None and is_duplicate(len(final_states), state['nodes']):
+                reject_count += 1
+                continue
+
             answer_counts[answer] += 1
             state['answer'] = answer
+            # Record node outputs in the program (they are part of the output
+            # and are used by get_box_token_mapping for obj_map)
+            outputs = program.execute(scene_struct, all_outputs=True)
+            for node, output in zip(state['nodes'], outputs):
+                node['_output'] = output
             final_states.append(state)
             if max_instances is not None and len(final_states) == max_instances:
                 break
             continue
 
         # Otherwise fetch the next node from the template
-        # Make a shallow copy so cached _outputs don't leak ... this is very nasty
         next_node = template['nodes'][state['next_template_node']]
-        next_node = node_shallow_copy(next_node)
 
         special_nodes = {
                 'filter_unique', 'filter_count', 'filter_exist', 'filter',
@@ -610,32 +800,30 @@ def instantiate_templates_dfs(scene_struct,
                 unique = (next_node['type'] == 'relate_filter_unique')
                 include_zero = (next_node['type'] == 'relate_filter_count'
                                                 or next_node['type'] == 'relate_filter_exist')
-                filter_options = find_relate_filter_options(answer, scene_struct, metadata,
+                filter_options = find_relate_filter_options(values[-1], scene_struct, metadata,
                                                         unique=unique, include_zero=include_zero,
-                                                        remove_redundant=remove_redundant)
+                                                        remove_redundant=remove_redundant, rng=rng)
             else:
                 if next_node['type'].startswith('part'):
                     part_flag = 'part'
-                    filter_options = find_partfilter_options(answer, scene_struct, metadata, 
-                                                             remove_redundant=remove_redundant)       
                     unified_node_type = next_node['type'][4:]
+                    if unified_node_type == 'filter_unique':
+                        find_options = find_unique_partfilter_options
+                    else:
+                        find_options = find_partfilter_options
                 else:
-                    filter_options = find_filter_options(answer, scene_struct, metadata, 
-                                                         remove_redundant=remove_redundant)       
                     unified_node_type = next_node['type']
+                    if unified_node_type == 'filter_unique':
+                        find_options = find_unique_filter_options
+                    else:
+                        find_options = find_filter_options
+                filter_options = find_options(values[-1], scene_struct, metadata,
+                                              remove_redundant=remove_redundant)
             
                 if unified_node_type == 'filter':
                     # Remove null filter
                     filter_options.pop((None, None, None, None), None)
-                if unified_node_type == 'filter_unique':
-                    # Get rid of all filter options that don't result in a single object
-                    if part_flag == '':
-                        filter_options = {k: v for k, v in filter_options.items()
-                                                       if len(v) == 1}
-                    else:
-                        filter_options = {k: v for k, v in filter_options.items()
-                                                    if len(v) == 1 and len(list(v.values())[0]) == 1 }
-                else:
+                if unified_node_type != 'filter_unique':
                     # Add some filter options that do NOT correspond to the scene
                     if unified_node_type == 'filter_exist':
                         # For filter_exist we want an equal number that do and don't
@@ -643,11 +831,11 @@ def instantiate_templates_dfs(scene_struct,
                     elif unified_node_type == 'filter_count' or unified_node_type == 'filter':
                         # For filter_count add nulls equal to the number of singletons
                         num_to_add = sum(1 for k, v in filter_options.items() if len(v) == 1)
-                    add_empty_filter_options(filter_options, metadata, num_to_add)
+                    add_empty_filter_options(filter_options, metadata, num_to_add, rng=rng)
 
             filter_option_keys = list(filter_options.keys())
             # filter_option_keys = sorted(filter_option_keys, key=lambda x: [str(y) for y in x])
-            random.shuffle(filter_option_keys)
+            rng.shuffle(filter_option_keys)
 
             for k in filter_option_keys:
                 #if filter_options[k] is None:
@@ -705,18 +893,16 @@ def instantiate_templates_dfs(scene_struct,
                 to_add_redundant = [param_name for param_name, param_val in zip(filter_side_inputs, k) if param_val is None]
                 to_add_redundant = [a for a in to_add_redundant if a not in null_params]
                 # if remove_redundant < 0 (-1~0), then keep to_add_redundant with p=(-remove_redundant)
-                to_add_redundant = list(filter(lambda a: np.random.random() <= -remove_redundant, to_add_redundant))
-                _outputs = qeng.answer_question({'nodes':state['nodes']+new_nodes}, metadata, scene_struct, all_outputs=True)
-                def check_common_attr(objs, param_type):
+                to_add_redundant = list(filter(lambda a: rng.random() <= -remove_redundant, to_add_redundant))
+                new_program = program.extend(new_nodes)
+                def check_common_attr(mask, is_part, param_type):
+                    index = qeng.get_scene_index(scene_struct, metadata)
                     attrs = []
-                    for obj in objs:
-                        if type(obj)==int:
-                            attr = scene_struct['objects'][obj][param_type]
+                    for idx in qeng.mask_to_list(mask):
+                        if is_part:
+                            attr = index.parts[idx][param_type]
                         else:
-                            assert('_' in obj)
-                            obj_id, part_id = [int(a) for a in obj.split('_')]
-                            part_name = metadata['types']['Partname'][scene_struct['objects'][obj_id]["shape"]][part_id]
-                            attr = scene_struct['objects'][obj_id]['parts'][part_name][param_type]
+                            attr = index.objects[idx][param_type]
                         attrs.append(attr)  
                     if len(set(attrs)) == 1:
                         return attrs[0]
@@ -724,7 +910,9 @@ def instantiate_templates_dfs(scene_struct,
                         return None
                 for param_name in to_add_redundant:
                     param_type = param_name_to_type[param_name]
-                    param_val = check_common_attr(_outputs[-1], param_type.lower())
+                    param_val = check_common_attr(new_program.values(scene_struct)[-1],
+                                                  new_program.kinds[-1] == 'PartSet',
+                                                  param_type.lower())
                     if param_val is not None:
                         filter_type = part_flag + 'filter_%s' % param_type.lower()
                         if param_val is not None:
@@ -752,8 +940,10 @@ def instantiate_templates_dfs(scene_struct,
                 input_map[state['next_template_node']] = len(state['nodes']) + len(new_nodes) - 1
                 
                 
+                new_program = program.extend(new_nodes)
                 states.append({
-                    'nodes': state['nodes'] + new_nodes,
+                    'nodes': new_program.nodes,
+                    'program': new_program,
                     'vals': cur_next_vals,
                     'input_map': input_map,
                     'next_template_node': state['next_template_node'] + 1,
@@ -772,7 +962,7 @@ def instantiate_templates_dfs(scene_struct,
             param_type = param_name_to_type[param_name]
             param_vals = metadata['types'][param_type][:]
             # param_vals = sorted(param_vals, key= lambda x: str(x))
-            random.shuffle(param_vals)
+            rng.shuffle(param_vals)
             for val in param_vals:
                 input_map = {k: v for k, v in state['input_map'].items()}
                 input_map[state['next_template_node']] = len(state['nodes'])
@@ -784,15 +974,15 @@ def instantiate_templates_dfs(scene_struct,
                 cur_next_vals = {k: v for k, v in state['vals'].items()}
                 cur_next_vals[param_name] = val
 
+                new_program = program.extend([cur_next_node])
                 states.append({
-                    'nodes': state['nodes'] + [cur_next_node],
+                    'nodes': new_program.nodes,
+                    'program': new_program,
                     'vals': cur_next_vals,
                     'input_map': input_map,
                     'next_template_node': state['next_template_node'] + 1,
                 })
         else:
-            if next_node['type'] == 'object2part':
-                complete_parts(scene_struct, metadata)
             input_map = {k: v for k, v in state['input_map'].items()}
             input_map[state['next_template_node']] = len(state['nodes'])
             next_node = {
@@ -800,8 +990,10 @@ def instantiate_templates_dfs(scene_struct,
                 'inputs': [input_map[idx] for idx in next_node['inputs']],
             }
             
+            new_program = program.extend([next_node])
             states.append({
-                'nodes': state['nodes'] + [next_node],
+                'nodes': new_program.nodes,
+                'program': new_program,
                 'vals': state['vals'],
                 'input_map': input_map,
                 'next_template_node': state['next_template_node'] + 1,
@@ -810,13 +1002,11 @@ def instantiate_templates_dfs(scene_struct,
 
     # Actually instantiate the template with the solutions we've found
     text_questions, structured_questions, answers, box_token_mappings = [], [], [], []
-    for state in final_states:
+    for i, state in enumerate(final_states):
+        text_rng = rng if instance_rngs is None else instance_rngs(i)
         structured_questions.append(state['nodes'])
-        answer = post_process_part_name(state['answer'])
-        if answer in metadata['types']['Shapename']:
-            answer = metadata['types']['Shapename'][answer]
-        answers.append(answer)
-        text = random.choice(template['text'])
+        answers.append(format_answer(state['answer'], metadata))
+        text = text_rng.choice(template['text'])
         # for name, val in state['vals'].items():
         #     if val in synonyms:
         #         val = random.choice(synonyms[val])
@@ -826,10 +1016,11 @@ def instantiate_templates_dfs(scene_struct,
         #         val = post_process_part_name(val)
         #     text = text.replace(name, val)
         #     text = ' '.join(text.split())
-        text = replace_optionals(text)
+        text = replace_optionals(text, rng=text_rng)
         text = ' '.join(text.split())
         text = other_heuristic(text, state['vals'])
-        text, box_token_mapping = get_box_token_mapping(state, metadata, template, text, synonyms)
+        text, box_token_mapping = get_box_token_mapping(state, metadata, template, text, synonyms,
+                                                        rng=text_rng)
         text_questions.append(text)
         box_token_mappings.append(box_token_mapping)
 
@@ -838,7 +1029,7 @@ def instantiate_templates_dfs(scene_struct,
 PARAM_REG = re.compile(r"<.\d?>") 
 OTHER_QUES = re.compile(r"(?:Is|Are) there ((?:anything else|any other thing)s?) that")
 OTHER_COUNT_QUES = re.compile(r"(?:How many|What number of) (other (?:thing|object)s?)")       
-def get_box_token_mapping(state, metadata, template, text, synonyms):
+def get_box_token_mapping(state, metadata, template, text, synonyms, rng=random):
     box_token_mapping = {}
     # find the output objects (output_objs) for current node (super_node_idx, node_idx)
     node_outputs = {}
@@ -884,7 +1075,7 @@ def get_box_token_mapping(state, metadata, template, text, synonyms):
         # find the token idx for current node
         val = state['vals'][side_input]
         if val in synonyms:
-            val = random.choice(synonyms[val])
+            val = rng.choice(synonyms[val])
         elif val in metadata['types']['Shapename']:
             val = metadata['types']['Shapename'][val]
         else:
@@ -949,7 +1140,7 @@ def get_box_token_mapping(state, metadata, template, text, synonyms):
     
     return text, box_token_mapping
 
-def replace_optionals(s):
+def replace_optionals(s, rng=random):
     """
     Each substring of s that is surrounded in square brackets is treated as
     optional and is removed with probability 0.5. For example the string
@@ -973,7 +1164,7 @@ def replace_optionals(s):
             break
         i0 = match.start()
         i1 = match.end()
-        if random.random() > 0.5:
+        if rng.random() > 0.5:
             s = s[:i0] + match.groups()[0] + s[i1:]
         else:
             s = s[:i0] + s[i1:]
@@ -996,8 +1187,18 @@ def post_process_part_name(s):
     return s
 
 
-def main(args):
-    with open(args.metadata_file, 'r') as f:
+def format_answer(answer, metadata):
+    """
+    Turn an answer of the question engine into the answer that is written out
+    """
+    answer = post_process_part_name(answer)
+    if answer in metadata['types']['Shapename']:
+        answer = metadata['types']['Shapename'][answer]
+    return answer
+
+
+def load_metadata(metadata_file):
+    with open(metadata_file, 'r') as f:
         metadata = json.load(f)
         dataset = metadata['dataset']
         if dataset != 'CLEVR-v1.0':
@@ -1016,81 +1217,96 @@ def main(args):
     metadata['types']['Shape'] = list(metadata['_shape_hier'].keys())
     
     metadata['types']['Partname'] = json.load(open(metadata['types']['Partname'], 'r'))
+    qeng.get_attribute_tables(metadata)
+    return metadata
 
+
+def load_templates(template_dir):
     # Load templates from disk
     # Key is (filename, file_idx)
     num_loaded_templates = 0
     templates = {}
-    for fn in os.listdir(args.template_dir):
+    for fn in os.listdir(template_dir):
         if not fn.endswith('.json'): continue
-        with open(os.path.join(args.template_dir, fn), 'r') as f:
+        with open(os.path.join(template_dir, fn), 'r') as f:
             base = os.path.splitext(fn)[0]
             for i, template in enumerate(json.load(f)):
                 num_loaded_templates += 1
                 key = (fn, i)
                 templates[key] = template
     print('Read %d templates from disk' % num_loaded_templates)
-
-    def reset_counts():
-        # Maps a template (filename, index) to the number of questions we have
-        # so far using that template
-        template_counts = {}
-        # Maps a template (filename, index) to a dict mapping the answer to the
-        # number of questions so far of that template type with that answer
-        template_answer_counts = {}
-        node_type_to_dtype = {n['name']: n['output'] for n in metadata['functions']}
-        for key, template in templates.items():
-            template_counts[key[:2]] = 0
-            final_node_type = template['nodes'][-1]['type']
-            final_dtype = node_type_to_dtype[final_node_type]
-            answers = metadata['types'][final_dtype]
-            if type(answers) == dict: #Partname or Shape
-                res = []
-                for _parts in answers.values():
-                    res.extend(_parts)
-                answers = list(set(res))
-            if final_dtype == 'Bool':
-                answers = [True, False]
-            if final_dtype == 'Integer':
-                if metadata['dataset'] == 'CLEVR-v1.0':
-                    answers = list(range(0, 11))
-            template_answer_counts[key[:2]] = {}
-            for a in answers:
-                template_answer_counts[key[:2]][a] = 0
-        return template_counts, template_answer_counts
-
-    template_counts, template_answer_counts = reset_counts()
-
-    # Read file containing input scenes
-    all_scenes = []
-    with open(args.input_scene_file, 'r') as f:
-        scene_data = json.load(f)
-        all_scenes = scene_data['scenes']
-        scene_info = scene_data['info']
-    begin = args.scene_start_idx
-    
-    if args.num_scenes > 0:
-        end = args.scene_start_idx + args.num_scenes
-        all_scenes = all_scenes[begin:end]
+    return templates
+
+
+def reset_counts(templates, metadata):
+    # Maps a template (filename, index) to the number of questions we have
+    # so far using that template
+    template_counts = {}
+    # Maps a template (filename, index) to a dict mapping the answer to the
+    # number of questions so far of that template type with that answer
+    template_answer_counts = {}
+    node_type_to_dtype = {n['name']: n['output'] for n in metadata['functions']}
+    for key, template in templates.items():
+        template_counts[key[:2]] = 0
+        final_node_type = template['nodes'][-1]['type']
+        final_dtype = node_type_to_dtype[final_node_type]
+        answers = metadata['types'][final_dtype]
+        if type(answers) == dict: #Partname or Shape
+            res = []
+            for _parts in answers.values():
+                res.extend(_parts)
+            answers = list(set(res))
+        if final_dtype == 'Bool':
+            answers = [True, False]
+        if final_dtype == 'Integer':
+            if metadata['dataset'] == 'CLEVR-v1.0':
+                answers = list(range(0, 11))
+        template_answer_counts[key[:2]] = {}
+        for a in answers:
+            template_answer_counts[key[:2]][a] = 0
+    return template_counts, template_answer_counts
+
+
+def iter_questions_for_scenes(scenes, scene_info, templates, metadata, synonyms,
+                              args, traces=None, scene_offset=0, total_scenes=None,
+                              progress=None):
+    """
+    Instantiate templates on a sequence of scenes, yielding the list of
+    questions of each scene as soon as it is done. Template and answer counts
+    start from zero and are reset every args.reset_counts_every scenes;
+    question indexes start from zero. Random choices come from streams of
+    args.seed per image, template and instance, so the questions of an image
+    only depend on the counts.
+
+    progress is a dict that holds the state the following scenes depend on
+    ('scene_count', 'num_questions', 'template_counts' and
+    'template_answer_counts'), updated before each scene is yielded; to
+    continue an earlier run (see checkpoint.py), pass its progress.
+    """
+    if total_scenes is None and isinstance(scenes, list):
+        total_scenes = len(scenes)
+    if progress is None:
+        progress = {}
+    if 'template_counts' in progress:
+        template_counts = progress['template_counts']
+        template_answer_counts = progress['template_answer_counts']
     else:
-        all_scenes = all_scenes[begin:]
+        template_counts, template_answer_counts = reset_counts(templates, metadata)
 
-    # Read synonyms file
-    with open(args.synonyms_json, 'r') as f:
-        synonyms = json.load(f)
-        
-
-    questions = []
-    scene_count = 0
-    for i, scene in enumerate(all_scenes):
+    num_questions = progress.get('num_questions', 0)
+    scene_count = progress.get('scene_count', 0)
+    for i, scene in enumerate(scenes):
         scene_fn = scene['image_filename']
         scene_struct = scene
-        print('starting image %s (%d / %d)'
-                    % (scene_fn, i + 1, len(all_scenes)))
+        image_index = int(os.path.splitext(scene_fn)[0].split('_')[-1])
+        scene_struct['_rng_seed'] = (args.seed, image_index)
+        print('starting image %s (%d / %s)'
+                    % (scene_fn, scene_offset + i + 1,
+                       '?' if total_scenes is None else total_scenes))
 
         if scene_count % args.reset_counts_every == 0:
             print('resetting counts')
-            template_counts, template_answer_counts = reset_counts()
+            template_counts, template_answer_counts = reset_counts(templates, metadata)
         scene_count += 1
 
         # Order templates by the number of questions we have so far for those
@@ -1100,6 +1316,12 @@ def main(args):
         templates_items = sorted(templates_items,
                                                 key=lambda x: template_counts[x[0][:2]])
         num_instantiated = 0
+        questions = []
+        is_duplicate = None
+        if args.drop_duplicates != 'none':
+            duplicates = DuplicateIndex(
+                scene_struct if args.drop_duplicates == 'semantic' else None, metadata)
+            is_duplicate = lambda i, nodes: duplicates.add(len(questions) + i, nodes) is not None
         
         for (fn, idx), template in templates_items:
             if args.verbose:
@@ -1107,8 +1329,6 @@ def main(args):
             if args.time_dfs and args.verbose:
                 tic = time.time()
             
-            random.seed(len(questions))
-            np.random.seed(len(questions))
             ts, qs, ans, bmaps = instantiate_templates_dfs(
                                             scene_struct,
                                             template,
@@ -1117,13 +1337,18 @@ def main(args):
                                             synonyms,
                                             max_instances=args.instances_per_template,
                                             remove_redundant=args.remove_redundant,
-                                            verbose=False)
+                                            verbose=False,
+                                            rng=make_rng(args.seed, image_index, fn, idx),
+                                            instance_rngs=lambda i: make_rng(
+                                                args.seed, image_index, fn, idx, i),
+                                            is_duplicate=is_duplicate)
             if args.time_dfs and args.verbose:
                 toc = time.time()
                 print('that took ', toc - tic)
-            image_index = int(os.path.splitext(scene_fn)[0].split('_')[-1])
             for t, q, a, bmap in zip(ts, qs, ans, bmaps):
-                question_hash = get_question_hash(image_index, scene_struct, q, t)
+                question_hash = get_question_hash(image_index, scene_struct, q, t, metadata)
+                if traces is not None and question_hash != "ERROR":
+                    traces.add(num_questions + len(questions), q, scene_struct)
                 questions.append({
                     'split': scene_info['split'],
                     'image_filename': scene_fn,
@@ -1136,7 +1361,7 @@ def main(args):
                     'template_filename': fn,
                     'question_family_index': idx,
                     'question_hash': question_hash, 
-                    'question_index': len(questions),
+                    'question_index': num_questions + len(questions),
                 })
             if len(ts) > 0:
                 if args.verbose:
@@ -1147,42 +1372,167 @@ def main(args):
                 print('did not get any =(')
             if num_instantiated >= args.templates_per_image:
                 break
+        num_questions += len(questions)
+        # Scene keys are never reused, so the cached node values of this scene
+        # are dead; drop them to keep memory flat
+        qeng.get_default_cache().clear()
+        progress.update(scene_count=scene_count, num_questions=num_questions,
+                        template_counts=template_counts,
+                        template_answer_counts=template_answer_counts)
+        yield questions
 
-    # Change "side_inputs" to "value_inputs" in all functions of all functional
-    # programs. My original name for these was "side_inputs" but I decided to
-    # change the name to "value_inputs" for the public CLEVR release. I should
-    # probably go through all question generation code and templates and rename,
-    # but that could be tricky and take a while, so instead I'll just do it here.
-    # To further complicate things, originally functions without value inputs did
-    # not have a "side_inputs" field at all, and I'm pretty sure this fact is used
-    # in some of the code above; however in the public CLEVR release all functions
-    # have a "value_inputs" field, and it's an empty list for functions that take
-    # no value inputs. Again this should probably be refactored, but the quick and
-    # dirty solution is to keep the code above as-is, but here make "value_inputs"
-    # an empty list for those functions that do not have "side_inputs". Gross.
-    for q in questions:
-        if q['question_hash'] == "ERROR":
-            continue
-        for f in q['program']:
-            if 'side_inputs' in f:
-                f['value_inputs'] = f['side_inputs']
-                del f['side_inputs']
-            else:
-                f['value_inputs'] = []
 
+def generate_questions_for_scenes(*args, **kwargs):
+    """
+    The questions of iter_questions_for_scenes, as one list.
+    """
+    return [q for questions in iter_questions_for_scenes(*args, **kwargs)
+            for q in questions]
 
-    # sort by question hash 
-    # questions = sorted(questions, key=lambda x: x['question_hash'])
-    # filter out the Nones 
-    exclude = "(<Z>)|(<C>)|(<M>)|(<S>)"
-    questions = [x for x in questions if re.search(exclude, x['question']) is None]
 
-    with open(args.output_questions_file, 'w') as f:
-        print('Writing output to %s' % args.output_questions_file)
-        json.dump({
-                'info': scene_info,
-                'questions': questions,
-            }, f, indent=2)
+# Scene file, number of scenes, templates, metadata, synonyms and args of the
+# worker processes of --workers
+_shard_state = None
+
+
+def init_shard_worker(state):
+    global _shard_state
+    _shard_state = state
+
+
+def generate_shard(shard):
+    """
+    Generate the questions of the scenes [begin, end) of the scene file for a
+    shard, in a worker process. Returns the questions, their trace records
+    (with --output_traces_file; (index in the shard, record)) and the number
+    of scenes.
+    """
+    begin, end = shard
+    scene_file, num_scenes, scene_info, templates, metadata, synonyms, args = _shard_state
+    traces = None
+    if args.output_traces_file is not None:
+        traces = TraceRecorder(metadata)
+    questions = generate_questions_for_scenes(
+        scene_file.scenes(begin, end), scene_info, templates, metadata, synonyms, args,
+        traces=traces, scene_offset=begin - args.scene_start_idx,
+        total_scenes=num_scenes)
+    return questions, traces and traces.records, end - begin
+
+
+def main(args):
+    if args.profile_handlers is not None:
+        assert args.workers <= 1, '--profile_handlers needs --workers 1'
+        qeng.enable_profiling()
+    metadata = load_metadata(args.metadata_file)
+    templates = load_templates(args.template_dir)
+
+    # With --resume, continue from the last checkpoint of the run (if any)
+    checkpointer = None
+    resumed = None
+    if args.checkpoint_every > 0 or args.resume:
+        checkpointer = Checkpointer(checkpoint_path(args), args)
+    if args.resume:
+        resumed = checkpointer.load()
+        if resumed is None:
+            print('No checkpoint at %s, starting from scratch' % checkpointer.path)
+
+    # Scenes are read from the input file one at a time; the offset index of
+    # the file (see scene_stream.py) is only needed to start after the first
+    # scene or to shard the scenes
+    scene_file = SceneFile(args.input_scene_file)
+    scene_info = scene_file.info
+    begin = args.scene_start_idx
+    start = begin if resumed is None else resumed['next_scene']
+    end = begin + args.num_scenes if args.num_scenes > 0 else None
+    num_scenes = None
+    if start > 0 or args.workers > 1 or scene_file.has_index():
+        end = len(scene_file) if end is None else min(end, len(scene_file))
+        num_scenes = max(end - begin, 0)
+
+    # Read synonyms file
+    with open(args.synonyms_json, 'r') as f:
+        synonyms = json.load(f)
+        
+
+    traces = None
+    if args.output_traces_file is not None:
+        traces = TraceWriter(args.output_traces_file, metadata,
+                             resume=resumed and resumed['traces'])
+
+    # Questions are finalized and written as soon as their scene is done
+    print('Writing output to %s' % args.output_questions_file)
+    writer = QuestionWriter(args.output_questions_file, scene_info,
+                            format=args.output_format,
+                            resume=resumed and resumed['output'])
+    if resumed is not None:
+        print('Resuming at scene %d with %d questions written' % (
+              start, resumed['output'][1]))
+    if args.workers <= 1:
+        progress = {} if resumed is None else resumed['progress']
+        next_scene, last_checkpoint = start, start
+        for questions in iter_questions_for_scenes(
+                scene_file.scenes(start, end), scene_info, templates, metadata, synonyms,
+                args, traces=traces, scene_offset=start - begin,
+                total_scenes=num_scenes, progress=progress):
+            for q in questions:
+                writer.write(q)
+            next_scene += 1
+            if args.checkpoint_every > 0 and \
+                    next_scene - last_checkpoint >= args.checkpoint_every:
+                checkpointer.save(next_scene, progress, writer, traces)
+                last_checkpoint = next_scene
+    else:
+        # Shard the scenes into blocks of --scenes_per_shard scenes, each of
+        # which is generated like a separate run on its scenes (as with
+        # --scene_start_idx / --num_scenes), and merge the shards in order
+        state = (scene_file, num_scenes, scene_info, templates, metadata, synonyms, args)
+        shard_size = args.scenes_per_shard or args.reset_counts_every
+        shards = [(i, min(i + shard_size, end)) for i in range(start, end, shard_size)]
+        pool = multiprocessing.Pool(args.workers, initializer=init_shard_worker,
+                                    initargs=(state,))
+        num_questions = 0 if resumed is None else resumed['progress']['num_questions']
+        num_done, last_checkpoint = start - begin, start
+        try:
+            for (shard_begin, shard_end), (shard_questions, shard_traces, _) in zip(
+                    shards, pool.imap(generate_shard, shards)):
+                # The workers number questions and trace records from zero
+                # in each shard
+                if traces is not None:
+                    for i, data in shard_traces:
+                        traces.add_record(num_questions + i, data)
+                for q in shard_questions:
+                    q['question_index'] = num_questions
+                    writer.write(q)
+                    num_questions += 1
+                num_done += shard_end - shard_begin
+                print('finished %d / %d scenes' % (num_done, num_scenes))
+                # Shards start with fresh counts, so only the question index
+                # carries over
+                if args.checkpoint_every > 0 and \
+                        shard_end - last_checkpoint >= args.checkpoint_every:
+                    checkpointer.save(shard_end, {'num_questions': num_questions},
+                                      writer, traces)
+                    last_checkpoint = shard_end
+            pool.close()
+        except BaseException:
+            # Don't leave the workers running (or the run hanging) on an error
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    writer.close()
+
+    if traces is not None:
+        print('Writing node traces to %s' % args.output_traces_file)
+        traces.close()
+
+    if args.profile_handlers is not None:
+        print('Writing handler profile to %s' % args.profile_handlers)
+        qeng.disable_profiling().dump(args.profile_handlers)
+
+    # The run is complete, its checkpoint is no longer needed
+    if checkpointer is not None:
+        checkpointer.remove()
 
 
 if __name__ == '__main__':
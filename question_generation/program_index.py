@@ -0,0 +1,139 @@
+"""
+Canonical forms of programs, used to find duplicate questions about an image.
+
+Programs that differ only in the order of their filters, or in filters that do
+not change anything, ask the same question. The canonical form of a program is
+built like this:
+
+- only the nodes that the final node depends on are kept (dead nodes are
+  trimmed the same way insert_scene_node trims them)
+- consecutive filter nodes (filter_* or partfilter_*) commute, so every chain
+  of filters is sorted and repeated filters are dropped
+- the inputs of commutative nodes (union, intersect, equal_*) are sorted
+- identical subprograms are shared
+
+Programs with the same canonical form are exact duplicates: they have the same
+answer on every scene. Given the scene of the image, the filters that keep
+every object (or part) of their input on that scene are dropped as well, like
+the redundant filters added with --remove_redundant < 0; programs with the
+same such form are semantic duplicates, with the same answer on this image.
+"""
+
+import hashlib, json
+
+import question_engine as qeng
+
+
+def _is_filter(node_type):
+    return node_type.startswith('filter_') or node_type.startswith('partfilter_')
+
+
+def _is_commutative(node_type):
+    return node_type in ('union', 'intersect') or node_type.startswith('equal_')
+
+
+def _side_inputs(node):
+    # Programs as written out use "value_inputs" (and "function" instead of
+    # "type" in the public CLEVR release)
+    return node.get('side_inputs', node.get('value_inputs', []))
+
+
+def _node_type(node):
+    return node['type'] if 'type' in node else node['function']
+
+
+def canonical_program(nodes, scene_struct=None, metadata=None):
+    """
+    Return the canonical form of a program as a list of nodes. If scene_struct
+    is given, the filters that keep their whole input on this scene are
+    dropped (metadata is then needed to run the program).
+    """
+    if isinstance(nodes, dict):
+        nodes = nodes['nodes']
+    types = [_node_type(node) for node in nodes]
+
+    noop = set()
+    if scene_struct is not None:
+        engine_nodes = [{'type': t, 'inputs': node['inputs'],
+                         'side_inputs': _side_inputs(node)}
+                        for t, node in zip(types, nodes)]
+        values = qeng.CompiledProgram(engine_nodes, metadata).values(scene_struct)
+        for i, node in enumerate(nodes):
+            if i < len(values) and _is_filter(types[i]) and \
+                    values[i] == values[node['inputs'][0]]:
+                noop.add(i)
+
+    # Canonical subprograms are nested (type, side_inputs, inputs) tuples so
+    # that inputs can be sorted by their structure
+    trees = {}
+    def tree(i):
+        if i in trees:
+            return trees[i]
+        if _is_filter(types[i]):
+            filters, j = set(), i
+            while _is_filter(types[j]):
+                if j not in noop:
+                    filters.add((types[j], tuple(_side_inputs(nodes[j]))))
+                j = nodes[j]['inputs'][0]
+            out = tree(j)
+            for node_type, side_inputs in sorted(filters):
+                out = (node_type, side_inputs, (out,))
+        else:
+            inputs = [tree(j) for j in nodes[i]['inputs']]
+            if _is_commutative(types[i]):
+                inputs = sorted(inputs)
+            out = (types[i], tuple(_side_inputs(nodes[i])), tuple(inputs))
+        trees[i] = out
+        return out
+
+    canonical, idxs = [], {}
+    def emit(t):
+        if t not in idxs:
+            node = {'type': t[0], 'inputs': [emit(child) for child in t[2]]}
+            if t[1]:
+                node['side_inputs'] = list(t[1])
+            idxs[t] = len(canonical)
+            canonical.append(node)
+        return idxs[t]
+    if nodes:
+        emit(tree(len(nodes) - 1))
+    return canonical
+
+
+def program_hash(nodes, scene_struct=None, metadata=None):
+    """
+    Hex digest of the canonical form of a program (see canonical_program).
+    """
+    canonical = canonical_program(nodes, scene_struct, metadata)
+    return hashlib.sha1(json.dumps(canonical, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class DuplicateIndex(object):
+    """
+    Hashes of the canonical programs of the questions asked about one image.
+    """
+
+    def __init__(self, scene_struct=None, metadata=None):
+        self.scene_struct = scene_struct
+        self.metadata = metadata
+        self.exact = {}
+        self.semantic = {}
+
+    def add(self, question_index, nodes, semantic=True):
+        """
+        Record a question. Returns None for a new program, and otherwise a
+        ('exact' or 'semantic', question_index) pair with the kind of duplicate
+        and the index of the first question with the same program. Semantic
+        duplicates are only found if the index was given the scene (and not
+        for programs added with semantic=False, e.g. ones that cannot run).
+        """
+        key = program_hash(nodes)
+        if key in self.exact:
+            return 'exact', self.exact[key]
+        self.exact[key] = question_index
+        if semantic and self.scene_struct is not None:
+            key = program_hash(nodes, self.scene_struct, self.metadata)
+            if key in self.semantic:
+                return 'semantic', self.semantic[key]
+            self.semantic[key] = question_index
+        return None
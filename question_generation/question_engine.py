@@ -5,10 +5,13 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 
-import json, os, math
-from collections import defaultdict
+import json, os, math, itertools, time
+from collections import defaultdict, OrderedDict
 import pdb
 
+from scene_index import SceneIndex, get_scene_index, get_part_stride, \
+                        get_attribute_tables, get_super_partname
+
 """
 Utilities for working with function program representations of questions.
 
@@ -21,115 +24,142 @@ in a JSON metadata file.
 # that was output from Blender, the node, and a list of values that were output
 # from each of the node's inputs; the handler should return the computed output
 # value from this node.
+#
+# Inside the engine, sets of objects and parts are represented as integer
+# bitmasks: bit i of an ObjectSet is set if object i is in the set, and parts
+# are identified by the packed id obj_idx * part_stride + part_idx (see
+# get_part_stride), which is also their bit in a PartSet. Single objects and
+# parts are plain ints. CompiledProgram converts to the list / "obj_part" string
+# format used everywhere else only when outputs leave the engine.
+#
+# There is no separate lazy evaluation mode: exist is a mask test and count a
+# popcount, so programs ending in exist, count, equal_integer, less_than or
+# greater_than never build the lists of objects a short-circuit would avoid.
+#
+# Handlers look attributes, parts and relationships up in the SceneIndex of the
+# scene (see scene_index.py) rather than in the raw scene structure.
+
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+
+
+def mask_to_list(mask):
+    # Ascending list of the set bits of mask
+    output = []
+    while mask:
+        low = mask & -mask
+        output.append(low.bit_length() - 1)
+        mask ^= low
+    return output
+
+
+def list_to_mask(idxs):
+    mask = 0
+    for idx in idxs:
+        mask |= 1 << idx
+    return mask
+
+
+def part_id_to_str(part_id, part_stride):
+    return '%d_%d' % divmod(part_id, part_stride)
+
+
+def str_to_part_id(part_str, part_stride):
+    obj_idx, part_idx = part_str.split('_')
+    return int(obj_idx) * part_stride + int(part_idx)
 
 
 def scene_handler(scene_struct, inputs, side_inputs):
     # Just return all objects in the scene
-    return list(range(len(scene_struct['objects'])))
+    return (1 << len(scene_struct['objects'])) - 1
 
 
 def make_filter_handler(attribute, metadata=None, is_part=False):
     def filter_handler(scene_struct, inputs, side_inputs):
         assert len(inputs) == 1
         assert len(side_inputs) == 1
-        value = side_inputs[0]
-        output = []
-        for idx in inputs[0]:
-            if is_part:
-                obj_idx, part_idx = [int(a) for a in idx.split('_')]
-                part = scene_struct['objects'][obj_idx]['_parts'][part_idx]
-                atr = part[attribute]
-            else:
-                atr = scene_struct['objects'][idx][attribute]
-            if value == atr or value in atr:
-                output.append(idx)
-            elif atr in metadata['_shape_hier']: # shape hier
-                if metadata['_shape_hier'][atr] == value:
-                    output.append(idx)
-        return output
+        index = get_scene_index(scene_struct, metadata)
+        if is_part:
+            return inputs[0] & index.part_filter_mask(attribute, side_inputs[0])
+        return inputs[0] & index.filter_mask(attribute, side_inputs[0])
     return filter_handler
 
 
 def unique_handler(scene_struct, inputs, side_inputs):
     assert len(inputs) == 1
-    if len(inputs[0]) != 1:
+    mask = inputs[0]
+    if mask == 0 or mask & (mask - 1):
         return '__INVALID__'
-    return inputs[0][0]
+    return mask.bit_length() - 1
 
 
-def vg_relate_handler(scene_struct, inputs, side_inputs):
-    assert len(inputs) == 1
-    assert len(side_inputs) == 1
-    output = set()
-    for rel in scene_struct['relationships']:
-        if rel['predicate'] == side_inputs[0] and rel['subject_idx'] == inputs[0]:
-            output.add(rel['object_idx'])
-    return sorted(list(output))
+def make_vg_relate_handler(metadata=None):
+    def vg_relate_handler(scene_struct, inputs, side_inputs):
+        assert len(inputs) == 1
+        assert len(side_inputs) == 1
+        index = get_scene_index(scene_struct, metadata)
+        return index.vg_relate_mask(inputs[0], side_inputs[0])
+    return vg_relate_handler
 
 
+vg_relate_handler = make_vg_relate_handler()
 
-def relate_handler(scene_struct, inputs, side_inputs):
-    assert len(inputs) == 1
-    assert len(side_inputs) == 1
-    relation = side_inputs[0]
-    return scene_struct['relationships'][relation][inputs[0]]
+
+def make_relate_handler(metadata=None):
+    def relate_handler(scene_struct, inputs, side_inputs):
+        assert len(inputs) == 1
+        assert len(side_inputs) == 1
+        relation = side_inputs[0]
+        index = get_scene_index(scene_struct, metadata)
+        return index.relate_masks[relation][inputs[0]]
+    return relate_handler
         
 
 def union_handler(scene_struct, inputs, side_inputs):
     assert len(inputs) == 2
     assert len(side_inputs) == 0
-    return sorted(list(set(inputs[0]) | set(inputs[1])))
+    return inputs[0] | inputs[1]
 
 
 def intersect_handler(scene_struct, inputs, side_inputs):
     assert len(inputs) == 2
     assert len(side_inputs) == 0
-    return sorted(list(set(inputs[0]) & set(inputs[1])))
+    return inputs[0] & inputs[1]
 
 
 def count_handler(scene_struct, inputs, side_inputs):
     assert len(inputs) == 1
-    return len(inputs[0])
+    return popcount(inputs[0])
 
 
-def make_same_attr_handler(attribute):
+def make_same_attr_handler(attribute, metadata=None, is_part=False):
     def same_attr_handler(scene_struct, inputs, side_inputs):
-        cache_key = '_same_%s' % attribute
-        if cache_key not in scene_struct:
-            cache = {}
-            for i, obj1 in enumerate(scene_struct['objects']):
-                same = []
-                for j, obj2 in enumerate(scene_struct['objects']):
-                    if i != j and obj1[attribute] == obj2[attribute]:
-                        same.append(j)
-                cache[i] = same
-            scene_struct[cache_key] = cache
-
-        cache = scene_struct[cache_key]
         assert len(inputs) == 1
         assert len(side_inputs) == 0
-        return cache[inputs[0]]
+        index = get_scene_index(scene_struct, metadata)
+        if is_part:
+            return index.part_same_masks(attribute)[inputs[0]]
+        return index.same_masks(attribute)[inputs[0]]
     return same_attr_handler
 
 
-def make_query_handler(attribute, is_part=None):
+def make_query_handler(attribute, is_part=None, metadata=None):
     def query_handler(scene_struct, inputs, side_inputs):
         assert len(inputs) == 1
         assert len(side_inputs) == 0
         idx = inputs[0]
-        if type(idx) == int:
-            is_part = False
-        else:
-            assert '_' in idx
-            is_part = True
+        index = get_scene_index(scene_struct, metadata)
         if is_part:
-            obj_idx, part_idx = [int(a) for a in idx.split('_')]
-            part = scene_struct['objects'][obj_idx]['_parts'][part_idx] #part
-            obj = part
+            part = index.parts[idx]
+            assert attribute in part
+            val = part[attribute]
         else:
-            obj = scene_struct['objects'][idx]
-        assert attribute in obj
-        val = obj[attribute]
+            val = index.object_values(attribute)[idx]
         if type(val) == list and len(val) != 1:
             return '__INVALID__'
         elif type(val) == list and len(val) == 1:
@@ -142,7 +172,7 @@ def make_query_handler(attribute, is_part=None):
 def exist_handler(scene_struct, inputs, side_inputs):
     assert len(inputs) == 1
     assert len(side_inputs) == 0
-    return len(inputs[0]) > 0
+    return inputs[0] != 0
 
 
 def equal_handler(scene_struct, inputs, side_inputs):
@@ -163,41 +193,28 @@ def greater_than_handler(scene_struct, inputs, side_inputs):
     return inputs[0] > inputs[1]
 
 
-def object2part_handler(scene_struct, inputs, side_inputs):
-    assert len(inputs) == 1
-    assert len(side_inputs) == 0
-    outputs = []
-    if type(inputs[0]) == list:
-        objs = inputs[0]
-    else:
-        assert type(inputs[0]) == int
-        objs = [inputs[0]]
-    for obj_idx in objs:
-        part_idxs = list(scene_struct['objects'][obj_idx]['_parts'].keys())
-        outputs.extend([str(obj_idx)+'_'+str(part_idx) for part_idx in part_idxs])
-    return outputs
+def make_object2part_handler(metadata=None):
+    def object2part_handler(scene_struct, inputs, side_inputs):
+        # Takes an ObjectSet; CompiledProgram turns a single Object into a mask
+        assert len(inputs) == 1
+        assert len(side_inputs) == 0
+        return get_scene_index(scene_struct, metadata).parts_of(inputs[0])
+    return object2part_handler
         
 
-def part2object_handler(scene_struct, inputs, side_inputs):
-    assert len(inputs) == 1
-    assert len(side_inputs) == 0
-    outputs = set()
-    if type(inputs[0]) == list:
-        parts = inputs[0]
-    else:
-        assert '_' in inputs[0]
-        parts = [inputs[0]]
-    for idx in parts:
-        obj_idx, part_idx = [int(a) for a in idx.split('_')]
-        outputs.add(obj_idx)
-    outputs = list(outputs)
-    return outputs
+def make_part2object_handler(metadata=None):
+    def part2object_handler(scene_struct, inputs, side_inputs):
+        # Takes a PartSet; CompiledProgram turns a single Part into a mask
+        assert len(inputs) == 1
+        assert len(side_inputs) == 0
+        return get_scene_index(scene_struct, metadata).objects_of(inputs[0])
+    return part2object_handler
 
 # Register all of the answering handlers here.
 # TODO maybe this would be cleaner with a function decorator that takes
 # care of registration? Not sure. Also what if we want to reuse the same engine
 # for different sets of node types?
-def make_excetue_handlers(key, metadata=None):
+def make_execute_handlers(metadata=None):
     execute_handlers = {
         'scene': scene_handler,
         'filter_color': make_filter_handler('color', metadata=metadata),
@@ -210,18 +227,18 @@ def make_excetue_handlers(key, metadata=None):
         'partfilter_material': make_filter_handler('material', metadata=metadata, is_part=True),
         'partfilter_size': make_filter_handler('size', metadata=metadata, is_part=True),
         'unique': unique_handler,
-        'relate': relate_handler,
+        'relate': make_relate_handler(metadata),
         'union': union_handler,
         'intersect': intersect_handler,
         'count': count_handler,
-        'query_color': make_query_handler('color', is_part=False),
-        'query_material': make_query_handler('material', is_part=False),
-        'query_size': make_query_handler('size', is_part=False),
-        'query_shape': make_query_handler('shape', is_part=False),
-        'partquery_color': make_query_handler('color', is_part=True),
-        'partquery_partname': make_query_handler('partname', is_part=True),
-        'partquery_material': make_query_handler('material', is_part=True),
-        'partquery_size': make_query_handler('size', is_part=True),
+        'query_color': make_query_handler('color', is_part=False, metadata=metadata),
+        'query_material': make_query_handler('material', is_part=False, metadata=metadata),
+        'query_size': make_query_handler('size', is_part=False, metadata=metadata),
+        'query_shape': make_query_handler('shape', is_part=False, metadata=metadata),
+        'partquery_color': make_query_handler('color', is_part=True, metadata=metadata),
+        'partquery_partname': make_query_handler('partname', is_part=True, metadata=metadata),
+        'partquery_material': make_query_handler('material', is_part=True, metadata=metadata),
+        'partquery_size': make_query_handler('size', is_part=True, metadata=metadata),
         'exist': exist_handler,
         'equal_color': equal_handler,
         'equal_shape': equal_handler,
@@ -231,51 +248,596 @@ def make_excetue_handlers(key, metadata=None):
         'equal_object': equal_handler,
         'less_than': less_than_handler,
         'greater_than': greater_than_handler,
-        'same_color': make_same_attr_handler('color'),
-        'same_shape': make_same_attr_handler('shape'),
-        'same_size': make_same_attr_handler('size'),
-        'same_material': make_same_attr_handler('material'),
-        'object2part': object2part_handler,
-        'part2object': part2object_handler
+        'same_color': make_same_attr_handler('color', metadata),
+        'same_shape': make_same_attr_handler('shape', metadata),
+        'same_size': make_same_attr_handler('size', metadata),
+        'same_material': make_same_attr_handler('material', metadata),
+        'object2part': make_object2part_handler(metadata),
+        'part2object': make_part2object_handler(metadata)
     }
-    return execute_handlers[key]
+    return execute_handlers
+
+
+def get_execute_handlers(metadata):
+    """
+    Return the handler table for this metadata, building it only the first time.
+    Like '_functions_by_name' and '_shape_hier', the table is stashed in the
+    metadata itself so every program compiled against it shares the handlers.
+
+    While profiling is enabled (see enable_profiling) the handlers of the table
+    are wrapped to record their calls.
+    """
+    if metadata is None:
+        handlers = make_execute_handlers(metadata)
+    else:
+        if '_execute_handlers' not in metadata:
+            metadata['_execute_handlers'] = make_execute_handlers(metadata)
+        handlers = metadata['_execute_handlers']
+    if _profile is None:
+        return handlers
+    return _profile.wrap_handlers(handlers, metadata)
+
+
+class HandlerProfile(object):
+    """
+    Per node type call counts, cumulative time, subprogram cache hits, invalid
+    outputs and sizes of output sets, recorded while profiling is enabled.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self._wrapped = {}
+        self._cache_start = (_default_cache.hits, _default_cache.misses)
+
+    def _node_stats(self, node_type):
+        if node_type not in self.stats:
+            self.stats[node_type] = {
+                'calls': 0, 'seconds': 0.0, 'cache_hits': 0, 'invalid': 0,
+            }
+        return self.stats[node_type]
+
+    def wrap_handlers(self, handlers, metadata):
+        key = id(handlers)
+        if key not in self._wrapped:
+            functions = {} if metadata is None else metadata.get('_functions_by_name', {})
+            wrapped = {}
+            for node_type, handler in handlers.items():
+                output = functions.get(node_type, {}).get('output')
+                is_set = output in ('ObjectSet', 'PartSet')
+                wrapped[node_type] = self._wrap(node_type, handler, is_set)
+            self._wrapped[key] = (handlers, wrapped)
+        return self._wrapped[key][1]
+
+    def _wrap(self, node_type, handler, is_set):
+        stats = self._node_stats(node_type)
+        if is_set:
+            stats.update(output_size_sum=0, output_size_max=0)
+        def profiled_handler(scene_struct, inputs, side_inputs):
+            tic = time.perf_counter()
+            output = handler(scene_struct, inputs, side_inputs)
+            stats['seconds'] += time.perf_counter() - tic
+            stats['calls'] += 1
+            if output == '__INVALID__':
+                stats['invalid'] += 1
+            elif is_set:
+                size = popcount(output)
+                stats['output_size_sum'] += size
+                stats['output_size_max'] = max(stats['output_size_max'], size)
+            return output
+        return profiled_handler
+
+    def record_hit(self, node_type):
+        self._node_stats(node_type)['cache_hits'] += 1
+
+    def to_json(self):
+        node_types = {}
+        for node_type, stats in sorted(self.stats.items()):
+            if stats['calls'] == 0 and stats['cache_hits'] == 0:
+                continue
+            stats = dict(stats)
+            if 'output_size_sum' in stats:
+                size_sum = stats.pop('output_size_sum')
+                num_valid = stats['calls'] - stats['invalid']
+                stats['output_size_mean'] = size_sum / max(num_valid, 1)
+            node_types[node_type] = stats
+        return {
+            'node_types': node_types,
+            'default_cache': {
+                'hits': _default_cache.hits - self._cache_start[0],
+                'misses': _default_cache.misses - self._cache_start[1],
+            },
+        }
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+
+
+_profile = None
+
+
+def enable_profiling():
+    """
+    Start recording a HandlerProfile. Only programs compiled after this call
+    are profiled; when profiling is disabled the handlers are not wrapped and
+    nothing is recorded.
+    """
+    global _profile
+    _profile = HandlerProfile()
+    return _profile
+
+
+def disable_profiling():
+    """
+    Stop profiling and return the recorded HandlerProfile (or None).
+    """
+    global _profile
+    profile, _profile = _profile, None
+    return profile
+
+
+def get_profile():
+    return _profile
+
+
+def make_excetue_handlers(key, metadata=None):
+    # Kept for old callers; prefer get_execute_handlers or CompiledProgram,
+    # which do not rebuild the handler table on every lookup.
+    return get_execute_handlers(metadata)[key]
+
+
+# Kind of value output by each node type, for the node types whose output kind
+# does not depend on their inputs; see _output_kind.
+_OUTPUT_KINDS = {
+    'scene': 'ObjectSet',
+    'relate': 'ObjectSet',
+    'object2part': 'PartSet',
+    'part2object': 'ObjectSet',
+}
+
+
+_ENGINE_KINDS = ('ObjectSet', 'Object', 'PartSet', 'Part')
+
+# Input kinds the engine accepts besides those of the function signatures:
+# unique also takes a PartSet (the metadata calls it uniquepart), and
+# object2part / part2object also take a single Object / Part
+_EXTRA_INPUT_KINDS = {
+    ('unique', ('PartSet',)),
+    ('object2part', ('Object',)),
+    ('part2object', ('Part',)),
+}
+
+
+def _check_input_kinds(node_type, input_kinds, functions):
+    # Raise TypeError if the kinds of the inputs of a node do not match the
+    # signature of its function. Sets and single objects are all ints inside
+    # the engine, so e.g. a relate given an ObjectSet would read the mask as
+    # an object idx instead of failing.
+    function = functions.get(node_type)
+    if function is None or (node_type, input_kinds) in _EXTRA_INPUT_KINDS:
+        return
+    expected = tuple([t if t in _ENGINE_KINDS else None for t in function['inputs']])
+    if input_kinds != expected:
+        raise TypeError('"%s" takes inputs of kinds %s, got %s' % (
+                        node_type, list(function['inputs']), list(input_kinds)))
+
+
+def _output_kind(node_type, input_kinds):
+    """
+    Returns 'ObjectSet', 'Object', 'PartSet' or 'Part' for nodes that output
+    objects or parts, and None for nodes that output plain values.
+    """
+    if node_type in ('union', 'intersect'):
+        return input_kinds[0]
+    elif node_type == 'unique':
+        return {'ObjectSet': 'Object', 'PartSet': 'Part'}.get(input_kinds[0])
+    elif node_type.startswith('partfilter_'):
+        return 'PartSet'
+    elif node_type.startswith('filter_') or node_type.startswith('same_'):
+        return 'ObjectSet'
+    return _OUTPUT_KINDS.get(node_type)
+
+
+def get_output_kinds(metadata):
+    """
+    Cache of the output kind of each (node type, input kinds) pair that
+    compiled, stashed in the metadata like the handler table. Pairs are only
+    added once they passed the check against the function signatures of the
+    metadata, so the check runs once per pair.
+    """
+    if metadata is None:
+        return _output_kind_cache
+    if '_output_kinds' not in metadata:
+        metadata['_output_kinds'] = {}
+    return metadata['_output_kinds']
+_output_kind_cache = {}
+
+_NO_SIDE_INPUTS = []
+
+
+def _single_input_as_set(handler):
+    # object2part / part2object also accept a single Object / Part
+    def set_handler(scene_struct, inputs, side_inputs):
+        return handler(scene_struct, [1 << inputs[0]], side_inputs)
+    return set_handler
+
+
+class SubprogramCache(object):
+    """
+    Bounded LRU cache of node values, keyed by (scene key, structural key of
+    the subprogram that computes the node). Since the key describes the whole
+    subprogram rather than a node dict, the same cache can be shared by all
+    programs answered on a scene (and by all scenes): e.g. the prefix
+    scene -> filter_unique[...] is only computed once per scene, whichever DFS
+    state or template it appears in.
+    """
+
+    def __init__(self, max_size=200000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self._entries[key] = entry
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_scene_keys = itertools.count()
+_default_cache = SubprogramCache()
+
+
+def get_scene_key(scene_struct):
+    """
+    Key identifying scene_struct in a SubprogramCache; assigned on first use
+    and stashed in the scene.
+    """
+    if '_scene_key' not in scene_struct:
+        scene_struct['_scene_key'] = next(_scene_keys)
+    return scene_struct['_scene_key']
+
+
+def get_default_cache():
+    return _default_cache
+
+
+class SceneContext(object):
+    """
+    The state that executing programs derives from one scene, kept outside
+    of the scene: its SceneIndex and the values of the subprograms already
+    computed on it, keyed by structural key. CompiledProgram.execute_in
+    answers programs with a context without modifying the scene, the nodes
+    or the program, so a context can be shared by threads answering
+    questions about the same scene (see executor.py).
+    """
+
+    def __init__(self, scene_struct, metadata):
+        self.scene_struct = scene_struct
+        self.index = SceneIndex(scene_struct, metadata)
+        # What the handlers are given instead of the scene: they only use the
+        # objects and the index
+        self.scene = {'objects': scene_struct['objects'], '_index': self.index}
+        self.values = {}
+
+    def __len__(self):
+        return len(self.values)
+
+
+def _node_key(node, keys):
+    # Structural key of the subprogram computing node, given the keys of all
+    # previous nodes. Keys are strings so their hash is computed only once.
+    return '%s%r(%s)' % (node['type'], tuple(node.get('side_inputs', [])),
+                         ','.join([keys[idx] for idx in node['inputs']]))
+
+
+_MISSING = object()
+
+
+class CompiledProgram(object):
+    """
+    A program whose nodes have been resolved against the handler table once,
+    so that executing it is just a walk over (handler, inputs, side_inputs)
+    steps. Programs that grow one node at a time (as during the DFS in
+    generate_questions.py) can be extended without recompiling their prefix.
+
+    The kind of every node output is also worked out at compile time, which is
+    what lets the handlers pass around bitmasks and plain ints: execute converts
+    them to lists of object idxs and "obj_part" strings only for the outputs it
+    returns or caches. Nodes whose inputs have the wrong kinds for the function
+    signatures of the metadata raise TypeError when they are compiled, like
+    they do in reference_engine.py.
+    """
+
+    def __init__(self, nodes, metadata, _parent=None):
+        self.nodes = nodes
+        self.metadata = metadata
+        self.part_stride = get_part_stride(metadata)
+        # Extended programs are compiled lazily, on first use: most of the
+        # programs created during the DFS are never executed
+        self._prefix = _parent
+        self._steps = None
+        self._keys = None
+        self._last_run = None
+        self._suffixes = None
+        if _parent is None:
+            self._compile()
+
+    def _compile(self):
+        if self._prefix is None:
+            steps, kinds = [], []
+        else:
+            steps, kinds = list(self._prefix.steps), list(self._prefix.kinds)
+        # This runs for every program answered once (e.g. answer_question on
+        # a fresh program), so it is kept as cheap as the lookups allow
+        handlers = get_execute_handlers(self.metadata)
+        kind_cache = get_output_kinds(self.metadata)
+        add_step, add_kind = steps.append, kinds.append
+        for node in self.nodes[len(steps):]:
+            node_type = node['type']
+            handler = handlers.get(node_type)
+            assert handler is not None, 'Could not find handler for "%s"' % node_type
+            inputs = node['inputs']
+            if len(inputs) == 1:
+                input_kinds = (kinds[inputs[0]],)
+                if input_kinds[0] in ('Object', 'Part') and \
+                        node_type in ('object2part', 'part2object'):
+                    handler = _single_input_as_set(handler)
+            else:
+                input_kinds = tuple([kinds[idx] for idx in inputs])
+            add_step((handler, inputs, node.get('side_inputs', _NO_SIDE_INPUTS)))
+            kind = kind_cache.get((node_type, input_kinds), _MISSING)
+            if kind is _MISSING:
+                if self.metadata is not None:
+                    _check_input_kinds(node_type, input_kinds,
+                                       self.metadata.get('_functions_by_name', {}))
+                kind = _output_kind(node_type, input_kinds)
+                kind_cache[node_type, input_kinds] = kind
+            add_kind(kind)
+        self._steps, self._kinds = steps, kinds
+
+    @property
+    def steps(self):
+        if self._steps is None:
+            self._compile()
+        return self._steps
+
+    @property
+    def kinds(self):
+        if self._steps is None:
+            self._compile()
+        return self._kinds
+
+    @property
+    def keys(self):
+        # Only needed when a cache is used, so built separately from the steps
+        if self._keys is None:
+            keys = [] if self._prefix is None else list(self._prefix.keys)
+            for node in self.nodes[len(keys):]:
+                keys.append(_node_key(node, keys))
+            self._keys = keys
+        return self._keys
+
+    def extend(self, nodes):
+        """
+        Return a new CompiledProgram for self.nodes + nodes, reusing the steps
+        that were already compiled for this program.
+        """
+        return CompiledProgram(self.nodes + nodes, self.metadata, _parent=self)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def _relate_suffixes(self):
+        # For each relate node, the idxs of the nodes that have to be
+        # re-evaluated when it is replaced by a scene node: the nodes that
+        # depend on it and that the answer depends on (see is_degenerate)
+        if self._suffixes is None:
+            nodes = self.nodes
+            used = [False] * len(nodes)
+            used[-1] = True
+            for i in range(len(nodes) - 1, -1, -1):
+                if used[i]:
+                    for idx in nodes[i]['inputs']:
+                        used[idx] = True
+            self._suffixes = []
+            for idx, node in enumerate(nodes):
+                if node['type'] != 'relate':
+                    continue
+                changed, suffix = {idx}, []
+                if used[idx]:
+                    for i in range(idx + 1, len(nodes)):
+                        if used[i] and not changed.isdisjoint(nodes[i]['inputs']):
+                            changed.add(i)
+                            suffix.append(i)
+                self._suffixes.append((idx, suffix))
+        return self._suffixes
+
+    def to_output(self, kind, value):
+        """
+        Convert an engine value of the given kind to the format that is
+        returned from answer_question and stored in programs.
+        """
+        if kind is None or value == '__INVALID__' or kind == 'Object':
+            return value
+        if kind == 'ObjectSet':
+            return mask_to_list(value)
+        if kind == 'PartSet':
+            return [part_id_to_str(p, self.part_stride) for p in mask_to_list(value)]
+        return part_id_to_str(value, self.part_stride)
+
+    def to_value(self, kind, output):
+        """
+        Inverse of to_output.
+        """
+        if kind is None or output == '__INVALID__' or kind == 'Object':
+            return output
+        if kind == 'ObjectSet':
+            return list_to_mask(output)
+        if kind == 'PartSet':
+            return list_to_mask(str_to_part_id(p, self.part_stride) for p in output)
+        return str_to_part_id(output, self.part_stride)
+
+    def execute(self, scene_struct, all_outputs=False, cache_outputs=True,
+                cache=None):
+        """
+        Run the program on scene_struct. With cache_outputs, node values are
+        looked up in and added to cache (by default the module-wide
+        SubprogramCache); the nodes themselves are never modified.
+        """
+        kinds = self.kinds
+        if not cache_outputs:
+            values = self._run_uncached(scene_struct)
+            if all_outputs:
+                return [self.to_output(kinds[i], value) for i, value in enumerate(values)]
+            return self.to_output(kinds[len(values) - 1], values[-1])
+        if cache is None:
+            cache = _default_cache
+        entries = self._run(scene_struct, cache)
+
+        idxs = range(len(entries)) if all_outputs else [len(entries) - 1]
+        node_outputs = []
+        for i in idxs:
+            entry = entries[i]
+            if entry[1] is _MISSING:
+                entry[1] = self.to_output(kinds[i], entry[0])
+            node_outputs.append(entry[1])
+
+        if all_outputs:
+            return node_outputs
+        else:
+            return node_outputs[-1]
+
+    def execute_in(self, context, all_outputs=False):
+        """
+        Run the program on the scene of a SceneContext, looking node values up
+        in and adding them to the context. Unlike execute, nothing but the
+        context is modified, apart from compiling the program and building its
+        keys on first use (executor.Executor.compile does both up front).
+        """
+        steps, keys, cached = self.steps, self.keys, context.values
+        scene = context.scene
+        values = []
+        for i in range(len(steps)):
+            value = cached.get(keys[i], _MISSING)
+            if value is _MISSING:
+                handler, inputs, side_inputs = steps[i]
+                value = handler(scene, [values[idx] for idx in inputs], side_inputs)
+                cached[keys[i]] = value
+            values.append(value)
+            if value == '__INVALID__':
+                break
+
+        kinds = self.kinds
+        if all_outputs:
+            return [self.to_output(kinds[i], value) for i, value in enumerate(values)]
+        return self.to_output(kinds[len(values) - 1], values[-1])
+
+    def values(self, scene_struct, cache_outputs=True, cache=None):
+        """
+        Like execute with all_outputs, but returns the engine values (masks,
+        object idxs and packed part ids) instead of converted outputs.
+        """
+        if not cache_outputs:
+            return self._run_uncached(scene_struct)
+        if cache is None:
+            cache = _default_cache
+        entries = self._run(scene_struct, cache)
+        return [entry[0] for entry in entries]
+
+    def _run_uncached(self, scene_struct):
+        # The value of each node up to the first invalid one
+        values = []
+        add_value = values.append
+        for handler, inputs, side_inputs in self.steps:
+            value = handler(scene_struct, [values[idx] for idx in inputs], side_inputs)
+            add_value(value)
+            if value == '__INVALID__':
+                break
+        return values
+
+    def _run(self, scene_struct, cache):
+        # Returns an [value, output] entry for each node up to the first
+        # invalid one; outputs are converted lazily and are cached along with
+        # the value
+        steps = self.steps
+        entries = []
+        scene_key = get_scene_key(scene_struct)
+        last_run = self._last_run
+        if last_run is not None and last_run[0] is cache and \
+                last_run[1] == scene_key:
+            return last_run[2]
+        keys = self.keys
+        if self._prefix is not None:
+            # The program this one extends was usually just run on the same
+            # scene (e.g. the parent DFS state); start from its entries
+            last_run = self._prefix._last_run
+            if last_run is not None and last_run[0] is cache and \
+                    last_run[1] == scene_key and len(last_run[2]) == len(self._prefix.steps):
+                entries = list(last_run[2])
+        profile = _profile
+        for i in range(len(entries), len(steps)):
+            key = (scene_key, keys[i])
+            entry = cache.get(key)
+            if entry is None:
+                handler, inputs, side_inputs = steps[i]
+                node_inputs = [entries[idx][0] for idx in inputs]
+                entry = [handler(scene_struct, node_inputs, side_inputs), _MISSING]
+                cache.put(key, entry)
+            elif profile is not None:
+                profile.record_hit(self.nodes[i]['type'])
+            entries.append(entry)
+            if entry[0] == '__INVALID__':
+                break
+        self._last_run = (cache, scene_key, entries)
+        return entries
+
+
+def compile_program(question, metadata):
+    """
+    Compile a question (a dict with a 'nodes' list, or a bare list of nodes).
+    Already compiled programs are returned as-is.
+    """
+    if isinstance(question, CompiledProgram):
+        return question
+    if isinstance(question, dict):
+        question = question['nodes']
+    return CompiledProgram(question, metadata)
 
 
 def answer_question(question, metadata, scene_struct, all_outputs=False,
-                                        cache_outputs=True):
+                                        cache_outputs=True, cache=None):
     """
     Use structured scene information to answer a structured question. Most of the
     heavy lifting is done by the execute handlers defined above.
 
-    We cache node outputs in the node itself; this gives a nontrivial speedup
-    when we want to answer many questions that share nodes on the same scene
-    (such as during question-generation DFS). This will NOT work if the same
-    nodes are executed on different scenes.
+    The question may also be a CompiledProgram, in which case the handlers are
+    not looked up again.
+
+    We cache node outputs in a SubprogramCache keyed by the scene and by the
+    structure of the subprogram computing each node; this gives a nontrivial
+    speedup when we want to answer many questions that share nodes on the same
+    scene (such as during question-generation DFS), and is safe to use across
+    scenes.
     """
-    all_input_types, all_output_types = [], []
-    node_outputs = []
-    for node in question['nodes']:
-        if cache_outputs and '_output' in node:
-            node_output = node['_output']
-        else:
-            node_type = node['type']
-            # msg = 'Could not find handler for "%s"' % node_type
-            # assert node_type in execute_handlers, msg
-            # handler = execute_handlers[node_type]
-            handler = make_excetue_handlers(node_type, metadata)
-            node_inputs = [node_outputs[idx] for idx in node['inputs']]
-            side_inputs = node.get('side_inputs', [])
-            node_output = handler(scene_struct, node_inputs, side_inputs)
-            if cache_outputs:
-                node['_output'] = node_output
-        node_outputs.append(node_output)
-        if node_output == '__INVALID__':
-            break
-
-    if all_outputs:
-        return node_outputs
-    else:
-        return node_outputs[-1]
+    program = compile_program(question, metadata)
+    return program.execute(scene_struct, all_outputs=all_outputs,
+                           cache_outputs=cache_outputs, cache=cache)
 
 
 def insert_scene_node(nodes, idx):
@@ -321,31 +883,90 @@ def insert_scene_node(nodes, idx):
     return new_nodes_trimmed
 
 
-def is_degenerate(question, metadata, scene_struct, answer=None, verbose=False):
+def is_degenerate(question, metadata, scene_struct, answer=None, verbose=False,
+                  cache=None, incremental=True):
     """
     A question is degenerate if replacing any of its relate nodes with a scene
     node results in a question with the same answer.
+
+    Rather than building and running the truncated question for every relate
+    node (see insert_scene_node), the outputs of the full question are reused
+    and only the nodes downstream of the replaced relate are re-evaluated.
+    With incremental=False the truncated questions are run instead.
     """
+    program = compile_program(question, metadata)
+    if not incremental:
+        return _is_degenerate_truncated(program, metadata, scene_struct,
+                                        answer=answer, verbose=verbose)
+    if cache is None:
+        cache = _default_cache
+    entries = program._run(scene_struct, cache)
+    if len(entries) < len(program.steps):
+        # (when the question itself is invalid we also run the truncated ones)
+        return _is_degenerate_truncated(program, metadata, scene_struct,
+                                        answer=answer, verbose=verbose)
+    if answer is None:
+        answer = program.execute(scene_struct, cache=cache)
+
+    steps = program.steps
+    scene = get_execute_handlers(metadata)['scene']
+    for idx, suffix in program._relate_suffixes():
+        values = [entry[0] for entry in entries]
+        values[idx] = scene(scene_struct, [], [])
+        new_answer = None
+        for i in suffix:
+            handler, inputs, side_inputs = steps[i]
+            values[i] = handler(scene_struct, [values[j] for j in inputs], side_inputs)
+            if values[i] == '__INVALID__':
+                new_answer = '__INVALID__'
+                break
+        if new_answer is None:
+            if suffix:
+                new_answer = program.to_output(program.kinds[-1], values[-1])
+            else:
+                new_answer = answer # the answer does not depend on the relate
+        if verbose:
+            print('here is truncated question (node %d replaced by scene):' % idx)
+            for i in suffix:
+                n = program.nodes[i]
+                name = n['type']
+                if 'side_inputs' in n:
+                    name = '%s[%s]' % (name, n['side_inputs'][0])
+                print(i, name, program.to_output(program.kinds[i], values[i]))
+            print('new answer is: ', new_answer)
+
+        if new_answer == answer:
+            return True
+
+    return False
+
+
+def _is_degenerate_truncated(program, metadata, scene_struct, answer=None,
+                             verbose=False):
+    # Every program here is run once, so building cache keys for it would
+    # cost more than the cache saves
     if answer is None:
-        answer = answer_question(question, metadata, scene_struct)
+        answer = program.execute(scene_struct, cache_outputs=False)
 
-    for idx, node in enumerate(question['nodes']):
+    for idx, node in enumerate(program.nodes):
         if node['type'] == 'relate':
-            new_question = {
-                'nodes': insert_scene_node(question['nodes'], idx)
-            }
-            new_answer = answer_question(new_question, metadata, scene_struct)
-            if verbose:
+            new_program = CompiledProgram(insert_scene_node(program.nodes, idx),
+                                          metadata)
+            if not verbose:
+                new_answer = new_program.execute(scene_struct, cache_outputs=False)
+            else:
+                new_outputs = new_program.execute(scene_struct, all_outputs=True,
+                                                  cache_outputs=False)
+                new_answer = new_outputs[-1]
                 print('here is truncated question:')
-                for i, n in enumerate(new_question['nodes']):
+                for i, (n, output) in enumerate(zip(new_program.nodes, new_outputs)):
                     name = n['type']
                     if 'side_inputs' in n:
                         name = '%s[%s]' % (name, n['side_inputs'][0])
-                    print(i, name, n['_output'])
+                    print(i, name, output)
                 print('new answer is: ', new_answer)
 
             if new_answer == answer:
                 return True
 
     return False
-
@@ -0,0 +1,235 @@
+"""
+Compact binary traces of the output of every program node, for supervising
+models on intermediate steps without re-running answer_question offline.
+
+A trace file holds one record per question, keyed by question_index. Every
+node output is stored as the engine computes it: a bitmask for ObjectSet and
+PartSet outputs, an int for Object and Part outputs (parts as packed part ids)
+and a scalar for the rest. Layout:
+
+    magic, part_stride (uint32)
+    records: num_nodes (uint16), then per node a tag byte and its payload
+    index: num_records (uint64), then (question_index, offset, length) uint64s
+    index offset (uint64), magic
+
+The index at the end gives random access by question_index:
+
+reader = TraceReader('traces.bin')
+outputs = reader.outputs(question_index) # same format as all_outputs=True
+"""
+
+import bisect, struct
+
+import question_engine as qeng
+
+
+MAGIC = b'SCLVTRC1'
+
+_INVALID, _OBJECT_SET, _PART_SET, _OBJECT, _PART, _BOOL, _INT, _STR, _FLOAT = range(9)
+_SET_TAGS = {'ObjectSet': _OBJECT_SET, 'PartSet': _PART_SET}
+_ITEM_TAGS = {'Object': _OBJECT, 'Part': _PART}
+_KINDS = {_OBJECT_SET: 'ObjectSet', _PART_SET: 'PartSet', _OBJECT: 'Object',
+          _PART: 'Part'}
+
+
+def encode_values(kinds, values):
+    """
+    Encode the engine values of the nodes of a program (see
+    CompiledProgram.values) with their output kinds as one record.
+    """
+    out = [struct.pack('<H', len(values))]
+    for kind, value in zip(kinds, values):
+        if value == '__INVALID__':
+            out.append(struct.pack('<B', _INVALID))
+        elif kind in _SET_TAGS:
+            data = value.to_bytes((value.bit_length() + 7) // 8, 'little')
+            out.append(struct.pack('<BH', _SET_TAGS[kind], len(data)))
+            out.append(data)
+        elif kind in _ITEM_TAGS:
+            out.append(struct.pack('<BI', _ITEM_TAGS[kind], value))
+        elif type(value) == bool:
+            out.append(struct.pack('<BB', _BOOL, value))
+        elif type(value) == int:
+            out.append(struct.pack('<Bq', _INT, value))
+        elif type(value) == float:
+            out.append(struct.pack('<Bd', _FLOAT, value))
+        else:
+            data = str(value).encode('utf-8')
+            out.append(struct.pack('<BH', _STR, len(data)))
+            out.append(data)
+    return b''.join(out)
+
+
+def decode_values(data):
+    """
+    Inverse of encode_values: returns (kinds, values).
+    """
+    num_nodes, = struct.unpack_from('<H', data, 0)
+    pos = 2
+    kinds, values = [], []
+    for _ in range(num_nodes):
+        tag = data[pos]
+        pos += 1
+        kind = _KINDS.get(tag)
+        if tag == _INVALID:
+            value = '__INVALID__'
+        elif tag in (_OBJECT_SET, _PART_SET):
+            n, = struct.unpack_from('<H', data, pos)
+            value = int.from_bytes(data[pos + 2:pos + 2 + n], 'little')
+            pos += 2 + n
+        elif tag in (_OBJECT, _PART):
+            value, = struct.unpack_from('<I', data, pos)
+            pos += 4
+        elif tag == _BOOL:
+            value = bool(data[pos])
+            pos += 1
+        elif tag == _INT:
+            value, = struct.unpack_from('<q', data, pos)
+            pos += 8
+        elif tag == _FLOAT:
+            value, = struct.unpack_from('<d', data, pos)
+            pos += 8
+        else:
+            n, = struct.unpack_from('<H', data, pos)
+            value = data[pos + 2:pos + 2 + n].decode('utf-8')
+            pos += 2 + n
+        kinds.append(kind)
+        values.append(value)
+    return kinds, values
+
+
+def encode_trace(program, metadata, scene_struct):
+    """
+    The record of the node outputs of program (nodes or a CompiledProgram) on
+    scene_struct.
+    """
+    program = qeng.compile_program(program, metadata)
+    return encode_values(program.kinds, program.values(scene_struct))
+
+
+class TraceRecorder(object):
+    """
+    Keeps the trace records of questions in memory, as (question_index,
+    record), e.g. in a worker process that hands them to the TraceWriter of
+    the parent (see TraceWriter.add_record).
+    """
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.records = []
+
+    def add(self, question_index, program, scene_struct):
+        self.records.append((question_index,
+                             encode_trace(program, self.metadata, scene_struct)))
+
+
+class TraceWriter(object):
+    """
+    Writes trace records to a file as questions are generated; the index is
+    written by close(). With resume=(offset, index), continues a file whose
+    records up to offset are those of index.
+    """
+
+    def __init__(self, path, metadata, resume=None):
+        self.metadata = metadata
+        if resume is not None:
+            offset, index = resume
+            self.f = open(path, 'r+b')
+            self.f.seek(offset)
+            self.f.truncate()
+            self.index = list(index)
+            return
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC + struct.pack('<I', qeng.get_part_stride(metadata)))
+        self.index = []
+
+    def add(self, question_index, program, scene_struct):
+        """
+        Record the node outputs of program (nodes or a CompiledProgram) on
+        scene_struct under question_index.
+        """
+        self.add_record(question_index,
+                        encode_trace(program, self.metadata, scene_struct))
+
+    def add_record(self, question_index, data):
+        # Write a record from encode_trace under question_index
+        self.index.append((question_index, self.f.tell(), len(data)))
+        self.f.write(data)
+
+    def position(self):
+        # Flush and return the offset of the next record
+        self.f.flush()
+        return self.f.tell()
+
+    def close(self):
+        index_offset = self.f.tell()
+        self.index.sort()
+        self.f.write(struct.pack('<Q', len(self.index)))
+        for entry in self.index:
+            self.f.write(struct.pack('<QQQ', *entry))
+        self.f.write(struct.pack('<Q', index_offset) + MAGIC)
+        self.f.close()
+
+
+class TraceReader(object):
+    """
+    Random access to the records of a trace file by question_index.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        header = self.f.read(len(MAGIC) + 4)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError('"%s" is not a trace file' % path)
+        self.part_stride, = struct.unpack('<I', header[len(MAGIC):])
+        self.f.seek(-(8 + len(MAGIC)), 2)
+        trailer = self.f.read()
+        if trailer[8:] != MAGIC:
+            raise ValueError('"%s" is truncated (no index)' % path)
+        index_offset, = struct.unpack('<Q', trailer[:8])
+        self.f.seek(index_offset)
+        num_records, = struct.unpack('<Q', self.f.read(8))
+        entries = struct.unpack('<%dQ' % (3 * num_records), self.f.read(24 * num_records))
+        self.question_idxs = entries[0::3]
+        self.offsets = entries[1::3]
+        self.lengths = entries[2::3]
+
+    def __len__(self):
+        return len(self.question_idxs)
+
+    def __contains__(self, question_index):
+        i = bisect.bisect_left(self.question_idxs, question_index)
+        return i < len(self.question_idxs) and self.question_idxs[i] == question_index
+
+    def values(self, question_index):
+        """
+        (kinds, values) of the nodes of a question: masks, object idxs, packed
+        part ids and scalars.
+        """
+        i = bisect.bisect_left(self.question_idxs, question_index)
+        if i == len(self.question_idxs) or self.question_idxs[i] != question_index:
+            raise KeyError(question_index)
+        self.f.seek(self.offsets[i])
+        return decode_values(self.f.read(self.lengths[i]))
+
+    def outputs(self, question_index):
+        """
+        Node outputs of a question in the format of
+        answer_question(all_outputs=True).
+        """
+        kinds, values = self.values(question_index)
+        outputs = []
+        for kind, value in zip(kinds, values):
+            if value == '__INVALID__' or kind in (None, 'Object'):
+                outputs.append(value)
+            elif kind == 'ObjectSet':
+                outputs.append(qeng.mask_to_list(value))
+            elif kind == 'PartSet':
+                outputs.append([qeng.part_id_to_str(p, self.part_stride)
+                                for p in qeng.mask_to_list(value)])
+            else:
+                outputs.append(qeng.part_id_to_str(value, self.part_stride))
+        return outputs
+
+    def close(self):
+        self.f.close()
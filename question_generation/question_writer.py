@@ -0,0 +1,138 @@
+"""
+Incremental writing of generated questions, so that generate_questions.py
+never holds more than a chunk of finished questions in memory.
+
+Three layouts are supported:
+
+jsonl   one question per line
+json    a JSON array of questions
+legacy  {"info": ..., "questions": [...]}, byte for byte what json.dump with
+        indent=2 writes (the layout of the CLEVR release)
+
+Questions are buffered and written chunk_size at a time. verify_questions.py
+(and the tools built on its iter_questions) read all three layouts.
+
+writer = QuestionWriter('questions.jsonl', scene_info)
+for q in questions:
+    writer.write(q)
+writer.close()
+"""
+
+import json, re
+
+
+# Questions whose text still contains a placeholder are not written
+EXCLUDE = re.compile("(<Z>)|(<C>)|(<M>)|(<S>)")
+
+
+def finalize_question(q):
+    """
+    Return the question as it is written out, or None if it is excluded.
+
+    The nodes of a program are shared with the other instances of its
+    template (and with the DFS states), so the output nodes are copies.
+    My original name for the value inputs of a function was "side_inputs",
+    renamed to "value_inputs" for the public CLEVR release; functions without
+    value inputs have no "side_inputs" during generation but an empty
+    "value_inputs" in the output. Programs of questions whose hash is "ERROR"
+    are written as they are.
+    """
+    if EXCLUDE.search(q['question']) is not None:
+        return None
+    q = dict(q)
+    if q['question_hash'] == "ERROR":
+        q['program'] = [dict(node) for node in q['program']]
+        return q
+    program = []
+    for node in q['program']:
+        node = dict(node)
+        node['value_inputs'] = node.pop('side_inputs', [])
+        program.append(node)
+    q['program'] = program
+    return q
+
+
+def output_format(path):
+    return 'jsonl' if path.endswith('.jsonl') else 'legacy'
+
+
+def _indent(text, prefix):
+    # Indent all lines but the first of a JSON text (newlines in strings are
+    # escaped, so every newline is between tokens)
+    return text.replace('\n', '\n' + prefix)
+
+
+class QuestionWriter(object):
+    """
+    Writes finished questions to path in one of the layouts above (by default
+    jsonl for a .jsonl file and legacy otherwise). The file is only valid
+    JSON after close().
+    """
+
+    def __init__(self, path, info=None, format=None, chunk_size=1000, resume=None):
+        self.path = path
+        self.format = format if format is not None else output_format(path)
+        assert self.format in ('jsonl', 'json', 'legacy'), self.format
+        self.chunk_size = chunk_size
+        self.num_written = 0
+        self._chunk = []
+        if resume is not None:
+            # Continue a file from a position returned by position(),
+            # dropping whatever was written after it
+            offset, self.num_written = resume
+            self.f = open(path, 'r+')
+            self.f.seek(offset)
+            self.f.truncate()
+            return
+        self.f = open(path, 'w')
+        if self.format == 'legacy':
+            self.f.write('{\n  "info": %s,\n  "questions": [' %
+                         _indent(json.dumps(info, indent=2), '  '))
+        elif self.format == 'json':
+            self.f.write('[')
+
+    def write(self, q):
+        """
+        Finalize a question and queue it for writing; returns False if the
+        question is excluded.
+        """
+        q = finalize_question(q)
+        if q is None:
+            return False
+        self._chunk.append(q)
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+        return True
+
+    def _encode(self, q):
+        if self.format == 'jsonl':
+            return json.dumps(q) + '\n'
+        sep = ',' if self.num_written > 0 else ''
+        if self.format == 'legacy':
+            return sep + '\n    ' + _indent(json.dumps(q, indent=2), '    ')
+        return sep + '\n' + json.dumps(q)
+
+    def flush(self):
+        parts = []
+        for q in self._chunk:
+            parts.append(self._encode(q))
+            self.num_written += 1
+        self._chunk = []
+        self.f.write(''.join(parts))
+        self.f.flush()
+
+    def position(self):
+        """
+        Flush and return (offset in the file, number of questions written),
+        from which a later writer can resume.
+        """
+        self.flush()
+        return self.f.tell(), self.num_written
+
+    def close(self):
+        self.flush()
+        if self.format == 'legacy':
+            self.f.write('\n  ]\n}' if self.num_written > 0 else ']\n}')
+        elif self.format == 'json':
+            self.f.write('\n]\n' if self.num_written > 0 else ']\n')
+        self.f.close()
@@ -0,0 +1,274 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+"""
+Reference implementation of the question engine.
+
+These are the straightforward list-based handlers that question_engine.py was
+originally written with: sets of objects are sorted lists of object idxs and
+parts are "obj_part" strings. They are slow but easy to check by eye, so they
+are kept to test and benchmark the faster execution paths in question_engine.py
+against. Nothing is cached in the scene or in the program nodes.
+"""
+
+from question_engine import insert_scene_node
+
+
+# Handlers for answering questions. Each handler receives the scene structure
+# that was output from Blender, the node, and a list of values that were output
+# from each of the node's inputs; the handler should return the computed output
+# value from this node.
+
+
+def scene_handler(scene_struct, inputs, side_inputs):
+    # Just return all objects in the scene
+    return list(range(len(scene_struct['objects'])))
+
+
+def make_filter_handler(attribute, metadata=None, is_part=False):
+    def filter_handler(scene_struct, inputs, side_inputs):
+        assert len(inputs) == 1
+        assert len(side_inputs) == 1
+        value = side_inputs[0]
+        output = []
+        for idx in inputs[0]:
+            if is_part:
+                obj_idx, part_idx = [int(a) for a in idx.split('_')]
+                part = scene_struct['objects'][obj_idx]['_parts'][part_idx]
+                atr = part[attribute]
+            else:
+                atr = scene_struct['objects'][idx][attribute]
+            if value == atr or value in atr:
+                output.append(idx)
+            elif atr in metadata['_shape_hier']: # shape hier
+                if metadata['_shape_hier'][atr] == value:
+                    output.append(idx)
+        return output
+    return filter_handler
+
+
+def unique_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
+    if len(inputs[0]) != 1:
+        return '__INVALID__'
+    return inputs[0][0]
+
+
+def vg_relate_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
+    assert len(side_inputs) == 1
+    output = set()
+    for rel in scene_struct['relationships']:
+        if rel['predicate'] == side_inputs[0] and rel['subject_idx'] == inputs[0]:
+            output.add(rel['object_idx'])
+    return sorted(list(output))
+
+
+
+def relate_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
+    assert len(side_inputs) == 1
+    relation = side_inputs[0]
+    return scene_struct['relationships'][relation][inputs[0]]
+        
+
+def union_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 2
+    assert len(side_inputs) == 0
+    return sorted(list(set(inputs[0]) | set(inputs[1])))
+
+
+def intersect_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 2
+    assert len(side_inputs) == 0
+    return sorted(list(set(inputs[0]) & set(inputs[1])))
+
+
+def count_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
+    return len(inputs[0])
+
+
+def make_same_attr_handler(attribute):
+    def same_attr_handler(scene_struct, inputs, side_inputs):
+        assert len(inputs) == 1
+        assert len(side_inputs) == 0
+        obj1 = scene_struct['objects'][inputs[0]]
+        same = []
+        for j, obj2 in enumerate(scene_struct['objects']):
+            if j != inputs[0] and obj1[attribute] == obj2[attribute]:
+                same.append(j)
+        return same
+    return same_attr_handler
+
+
+def make_query_handler(attribute, is_part=None):
+    def query_handler(scene_struct, inputs, side_inputs):
+        assert len(inputs) == 1
+        assert len(side_inputs) == 0
+        idx = inputs[0]
+        if type(idx) == int:
+            is_part = False
+        else:
+            assert '_' in idx
+            is_part = True
+        if is_part:
+            obj_idx, part_idx = [int(a) for a in idx.split('_')]
+            part = scene_struct['objects'][obj_idx]['_parts'][part_idx] #part
+            obj = part
+        else:
+            obj = scene_struct['objects'][idx]
+        assert attribute in obj
+        val = obj[attribute]
+        if type(val) == list and len(val) != 1:
+            return '__INVALID__'
+        elif type(val) == list and len(val) == 1:
+            return val[0]
+        else:
+            return val
+    return query_handler
+
+
+def exist_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
+    assert len(side_inputs) == 0
+    return len(inputs[0]) > 0
+
+
+def equal_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 2
+    assert len(side_inputs) == 0
+    return inputs[0] == inputs[1]
+
+
+def less_than_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 2
+    assert len(side_inputs) == 0
+    return inputs[0] < inputs[1]
+
+
+def greater_than_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 2
+    assert len(side_inputs) == 0
+    return inputs[0] > inputs[1]
+
+
+def object2part_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
+    assert len(side_inputs) == 0
+    outputs = []
+    if type(inputs[0]) == list:
+        objs = inputs[0]
+    else:
+        assert type(inputs[0]) == int
+        objs = [inputs[0]]
+    for obj_idx in objs:
+        part_idxs = list(scene_struct['objects'][obj_idx]['_parts'].keys())
+        outputs.extend([str(obj_idx)+'_'+str(part_idx) for part_idx in part_idxs])
+    return outputs
+        
+
+def part2object_handler(scene_struct, inputs, side_inputs):
+    assert len(inputs) == 1
+    assert len(side_inputs) == 0
+    outputs = set()
+    if type(inputs[0]) == list:
+        parts = inputs[0]
+    else:
+        assert '_' in inputs[0]
+        parts = [inputs[0]]
+    for idx in parts:
+        obj_idx, part_idx = [int(a) for a in idx.split('_')]
+        outputs.add(obj_idx)
+    outputs = list(outputs)
+    return outputs
+
+
+def make_execute_handlers(metadata=None):
+    return {
+        'scene': scene_handler,
+        'filter_color': make_filter_handler('color', metadata=metadata),
+        'filter_shape': make_filter_handler('shape', metadata=metadata),
+        'filter_material': make_filter_handler('material', metadata=metadata),
+        'filter_size': make_filter_handler('size', metadata=metadata),
+        'filter_objectcategory': make_filter_handler('objectcategory', metadata=metadata),
+        'partfilter_color': make_filter_handler('color', metadata=metadata, is_part=True),
+        'partfilter_partname': make_filter_handler('partname', metadata=metadata, is_part=True),
+        'partfilter_material': make_filter_handler('material', metadata=metadata, is_part=True),
+        'partfilter_size': make_filter_handler('size', metadata=metadata, is_part=True),
+        'unique': unique_handler,
+        'relate': relate_handler,
+        'union': union_handler,
+        'intersect': intersect_handler,
+        'count': count_handler,
+        'query_color': make_query_handler('color', is_part=False),
+        'query_material': make_query_handler('material', is_part=False),
+        'query_size': make_query_handler('size', is_part=False),
+        'query_shape': make_query_handler('shape', is_part=False),
+        'partquery_color': make_query_handler('color', is_part=True),
+        'partquery_partname': make_query_handler('partname', is_part=True),
+        'partquery_material': make_query_handler('material', is_part=True),
+        'partquery_size': make_query_handler('size', is_part=True),
+        'exist': exist_handler,
+        'equal_color': equal_handler,
+        'equal_shape': equal_handler,
+        'equal_integer': equal_handler,
+        'equal_material': equal_handler,
+        'equal_size': equal_handler,
+        'equal_object': equal_handler,
+        'less_than': less_than_handler,
+        'greater_than': greater_than_handler,
+        'same_color': make_same_attr_handler('color'),
+        'same_shape': make_same_attr_handler('shape'),
+        'same_size': make_same_attr_handler('size'),
+        'same_material': make_same_attr_handler('material'),
+        'object2part': object2part_handler,
+        'part2object': part2object_handler
+    }
+
+
+def answer_question(question, metadata, scene_struct, all_outputs=False):
+    """
+    Answer a structured question node by node. Same return values as
+    question_engine.answer_question.
+    """
+    execute_handlers = make_execute_handlers(metadata)
+    node_outputs = []
+    for node in question['nodes']:
+        handler = execute_handlers[node['type']]
+        node_inputs = [node_outputs[idx] for idx in node['inputs']]
+        side_inputs = node.get('side_inputs', [])
+        node_output = handler(scene_struct, node_inputs, side_inputs)
+        node_outputs.append(node_output)
+        if node_output == '__INVALID__':
+            break
+
+    if all_outputs:
+        return node_outputs
+    else:
+        return node_outputs[-1]
+
+
+def is_degenerate(question, metadata, scene_struct, answer=None):
+    """
+    A question is degenerate if replacing any of its relate nodes with a scene
+    node results in a question with the same answer. Every truncated question
+    is built and answered from scratch.
+    """
+    if answer is None:
+        answer = answer_question(question, metadata, scene_struct)
+
+    for idx, node in enumerate(question['nodes']):
+        if node['type'] == 'relate':
+            new_question = {
+                'nodes': insert_scene_node(question['nodes'], idx)
+            }
+            new_answer = answer_question(new_question, metadata, scene_struct)
+            if new_answer == answer:
+                return True
+
+    return False
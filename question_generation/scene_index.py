@@ -0,0 +1,358 @@
+"""
+Per-scene inverted indexes used to answer questions and to enumerate filter
+options during question generation.
+
+A SceneIndex is built the first time a scene is queried and is then stashed in
+the scene structure (like the other '_'-prefixed caches), so it is only built
+once per scene. Everything in the index is expressed with the same bitmasks the
+engine uses: bit i of an object mask is object i, and parts are identified by
+the packed id obj_idx * part_stride + part_idx (see question_engine).
+"""
+
+
+def get_part_stride(metadata):
+    """
+    Number of part ids reserved for each object: the smallest power of two that
+    is at least the largest number of parts of any shape in metadata.
+    """
+    if metadata is None:
+        return 1
+    if '_part_stride' not in metadata:
+        partnames = metadata['types'].get('Partname')
+        max_parts = 1
+        if isinstance(partnames, dict):
+            max_parts = max([len(v) for v in partnames.values()] + [1])
+        stride = 1
+        while stride < max_parts:
+            stride *= 2
+        metadata['_part_stride'] = stride
+    return metadata['_part_stride']
+
+
+# Words dropped from a part name to get its super-partname, e.g. the
+# "door_left_s" and "door_right_s" of a car are both a "door"
+SPECIAL_PART_WORDS = ['right', 'left', 'front', 'back', 'center', 'mid', 's']
+
+
+def get_super_partname(partname):
+    return '_'.join([a for a in partname.split('_') if a not in SPECIAL_PART_WORDS])
+
+
+def _filter_matches(atr, value, shape_hier):
+    # The rule of the filter nodes: a filter on value keeps the attribute value
+    # atr if they are equal, if value is a substring (or element) of atr, or if
+    # value is the hypershape of atr
+    if value == atr or value in atr:
+        return True
+    return shape_hier.get(atr) == value # shape hier
+
+
+def get_attribute_tables(metadata):
+    """
+    Return the hierarchy-expanded attribute tables of metadata, building them
+    the first time. For each attribute with a known vocabulary the table is a
+    pair (vocab, matches): vocab is the set of values the attribute can take,
+    and matches maps every filter value (the values themselves, hypershapes
+    and super-partnames) to the frozenset of values in vocab it keeps.
+    """
+    if metadata is None:
+        return {}
+    if '_attribute_tables' not in metadata:
+        types = metadata['types']
+        shape_hier = metadata.get('_shape_hier', {})
+        vocabs, extra_values = {}, {}
+        for attribute, type_name in [('color', 'Color'), ('size', 'Size'),
+                                     ('material', 'Material')]:
+            if isinstance(types.get(type_name), list):
+                vocabs[attribute] = set(types[type_name])
+        if shape_hier:
+            vocabs['shape'] = set(shape_hier)
+            extra_values['shape'] = set(shape_hier.values())
+        elif isinstance(types.get('Shape'), list):
+            vocabs['shape'] = set(types['Shape'])
+        if isinstance(types.get('Partname'), dict):
+            vocabs['partname'] = set(p for names in types['Partname'].values()
+                                     for p in names)
+            extra_values['partname'] = set(get_super_partname(p)
+                                           for p in vocabs['partname'])
+
+        tables = {}
+        for attribute, vocab in vocabs.items():
+            matches = {}
+            for value in vocab | extra_values.get(attribute, set()):
+                matches[value] = frozenset(atr for atr in vocab
+                                           if _filter_matches(atr, value, shape_hier))
+            tables[attribute] = (vocab, matches)
+        metadata['_attribute_tables'] = tables
+    return metadata['_attribute_tables']
+
+
+def get_attribute_matches(metadata, attribute, value):
+    """
+    Return (vocab, matches) where matches is the frozenset of values in vocab
+    that a filter on attribute == value keeps. Attribute values outside vocab
+    have to be tested with the filter rule directly; without a table for
+    attribute both sets are empty.
+    """
+    table = get_attribute_tables(metadata).get(attribute)
+    if table is None:
+        return frozenset(), frozenset()
+    vocab, matches = table
+    if value not in matches:
+        # A value that is not in the metadata; it can still be a substring
+        shape_hier = metadata.get('_shape_hier', {})
+        matches[value] = frozenset(atr for atr in vocab
+                                   if _filter_matches(atr, value, shape_hier))
+    return vocab, matches[value]
+
+
+def _index_key(value):
+    # Attribute values are used as dict keys; lists are indexed as tuples
+    if type(value) == list:
+        return tuple(value)
+    return value
+
+
+class SceneIndex(object):
+    """
+    Inverted indexes over the objects, parts and relationships of one scene:
+
+    - for each object attribute, attribute value -> mask of objects
+    - for each part attribute, attribute value -> mask of parts
+    - for each relation, object idx -> mask of related objects (one bitmask
+      row of the adjacency matrix per object)
+    - for Visual-Genome style relationship records, (subject idx, predicate)
+      -> mask of objects
+    - a flat table of the parts (packed part id, object idx and one column
+      per part attribute) and, for each object, the mask of its parts
+    - for each object (or part) attribute, object idx (or part id) -> mask of
+      the other objects (parts) with the same value
+
+    Attribute indexes are built lazily, the first time an attribute is used.
+    filter_mask / part_filter_mask answer the filter_* / partfilter_* nodes
+    through the attribute tables of the metadata, so hierarchical values (e.g.
+    "car" for sedans and suvs, "door" for door_left_s) are simple lookups.
+    """
+
+    def __init__(self, scene_struct, metadata):
+        self.scene_struct = scene_struct
+        self.metadata = metadata
+        self.objects = scene_struct['objects']
+        self.num_objects = len(self.objects)
+        self.all_objects = (1 << self.num_objects) - 1
+        self.part_stride = get_part_stride(metadata)
+        self.shape_hier = {}
+        if metadata is not None:
+            self.shape_hier = metadata.get('_shape_hier', {})
+
+        # CLEVR scenes list, per relation, the related objects of every object;
+        # Visual-Genome style scenes have a list of relationship records
+        self.relate_masks = {}
+        self._vg_relate_masks = None
+        relationships = scene_struct.get('relationships', {})
+        if isinstance(relationships, dict):
+            for relation, related in relationships.items():
+                masks = []
+                for idxs in related:
+                    mask = 0
+                    for idx in idxs:
+                        mask |= 1 << idx
+                    masks.append(mask)
+                self.relate_masks[relation] = masks
+
+        self._object_values = {}
+        self._object_masks = {}
+        self._part_values = {}
+        self._part_masks = {}
+        self._filter_masks = {}
+        self._part_filter_masks = {}
+        self._same_masks = {}
+        self._part_same_masks = {}
+        self._parts = None
+
+    # Objects
+
+    def object_values(self, attribute):
+        """
+        List with the value of attribute for every object.
+        """
+        if attribute not in self._object_values:
+            self._object_values[attribute] = [obj[attribute] for obj in self.objects]
+        return self._object_values[attribute]
+
+    def object_masks(self, attribute):
+        """
+        Dict mapping each value of attribute in the scene to a mask of objects.
+        """
+        if attribute not in self._object_masks:
+            masks = {}
+            for idx, value in enumerate(self.object_values(attribute)):
+                key = _index_key(value)
+                masks[key] = masks.get(key, 0) | (1 << idx)
+            self._object_masks[attribute] = masks
+        return self._object_masks[attribute]
+
+    def _match_masks(self, masks, attribute, value):
+        vocab, matches = get_attribute_matches(self.metadata, attribute, value)
+        mask = 0
+        for atr, atr_mask in masks.items():
+            if atr in matches or (atr not in vocab and
+                                  _filter_matches(atr, value, self.shape_hier)):
+                mask |= atr_mask
+        return mask
+
+    def filter_mask(self, attribute, value):
+        """
+        Mask of objects that a filter_<attribute>[value] node keeps.
+        """
+        key = (attribute, value)
+        if key not in self._filter_masks:
+            self._filter_masks[key] = self._match_masks(
+                self.object_masks(attribute), attribute, value)
+        return self._filter_masks[key]
+
+    def same_masks(self, attribute):
+        """
+        List with, for every object, the mask of the other objects that have
+        the same value of attribute (answers same_<attribute> nodes).
+        """
+        if attribute not in self._same_masks:
+            masks = self.object_masks(attribute)
+            self._same_masks[attribute] = [
+                masks[_index_key(value)] & ~(1 << idx)
+                for idx, value in enumerate(self.object_values(attribute))]
+        return self._same_masks[attribute]
+
+    def vg_relate_mask(self, subject_idx, predicate):
+        """
+        Mask of the objects that are the object of a relationship record with
+        this subject and predicate (answers vg_relate nodes).
+        """
+        if self._vg_relate_masks is None:
+            masks = {}
+            for rel in self.scene_struct.get('relationships', []):
+                key = (rel['subject_idx'], rel['predicate'])
+                masks[key] = masks.get(key, 0) | (1 << rel['object_idx'])
+            self._vg_relate_masks = masks
+        return self._vg_relate_masks.get((subject_idx, predicate), 0)
+
+    # Parts
+
+    def _build_parts(self):
+        # Flat table with one row per part that is annotated in the scene: the
+        # parts of each object, numbered by their index in the part list of
+        # the object's shape (as in generate_questions.complete_parts), in
+        # order of packed part id. _parts is set last, so that an index shared
+        # by threads never looks built before it is.
+        partnames = self.metadata['types']['Partname']
+        part_ids, part_objects, parts, object_part_masks = [], [], {}, []
+        for obj_idx, obj in enumerate(self.objects):
+            obj_parts = 0
+            for part_idx, part_name in enumerate(partnames.get(obj['shape'], [])):
+                if part_name in obj.get('parts', {}):
+                    part = {'partname': part_name}
+                    for k in obj['parts'][part_name]:
+                        part[k] = obj['parts'][part_name][k]
+                    part_id = obj_idx * self.part_stride + part_idx
+                    part_ids.append(part_id)
+                    part_objects.append(obj_idx)
+                    parts[part_id] = part
+                    obj_parts |= 1 << part_id
+            object_part_masks.append(obj_parts)
+        self.part_ids = part_ids
+        self.part_objects = part_objects
+        self.object_part_masks = object_part_masks
+        self._part_columns = {}
+        self._parts = parts
+
+    @property
+    def parts(self):
+        """
+        Dict mapping packed part ids to part dicts (partname, color, ...).
+        """
+        if self._parts is None:
+            self._build_parts()
+        return self._parts
+
+    def part_column(self, attribute):
+        """
+        List with the value of a part attribute for every row of the part
+        table (aligned with part_ids).
+        """
+        if self._parts is None:
+            self._build_parts()
+        if attribute not in self._part_columns:
+            self._part_columns[attribute] = [self._parts[part_id][attribute]
+                                             for part_id in self.part_ids]
+        return self._part_columns[attribute]
+
+    def parts_of(self, object_mask):
+        """
+        Mask of all parts of the objects in object_mask.
+        """
+        if self._parts is None:
+            self._build_parts()
+        output = 0
+        while object_mask:
+            low = object_mask & -object_mask
+            object_mask ^= low
+            output |= self.object_part_masks[low.bit_length() - 1]
+        return output
+
+    def objects_of(self, part_mask):
+        """
+        Mask of the objects that have a part in part_mask; the parts of object
+        i are the part_stride bits starting at bit i * part_stride.
+        """
+        stride = self.part_stride
+        object_bits = (1 << stride) - 1
+        output, obj_idx = 0, 0
+        while part_mask:
+            if part_mask & object_bits:
+                output |= 1 << obj_idx
+            part_mask >>= stride
+            obj_idx += 1
+        return output
+
+    def part_masks(self, attribute):
+        """
+        Dict mapping each value of a part attribute to a mask of parts.
+        """
+        if attribute not in self._part_masks:
+            masks, column = {}, self.part_column(attribute)
+            for part_id, value in zip(self.part_ids, column):
+                key = _index_key(value)
+                masks[key] = masks.get(key, 0) | (1 << part_id)
+            self._part_masks[attribute] = masks
+        return self._part_masks[attribute]
+
+    def part_filter_mask(self, attribute, value):
+        """
+        Mask of parts that a partfilter_<attribute>[value] node keeps.
+        """
+        key = (attribute, value)
+        if key not in self._part_filter_masks:
+            self._part_filter_masks[key] = self._match_masks(
+                self.part_masks(attribute), attribute, value)
+        return self._part_filter_masks[key]
+
+    def part_same_masks(self, attribute):
+        """
+        Dict mapping each packed part id to the mask of the other parts that
+        have the same value of attribute.
+        """
+        if attribute not in self._part_same_masks:
+            masks, column = self.part_masks(attribute), self.part_column(attribute)
+            self._part_same_masks[attribute] = {
+                part_id: masks[_index_key(value)] & ~(1 << part_id)
+                for part_id, value in zip(self.part_ids, column)}
+        return self._part_same_masks[attribute]
+
+
+def get_scene_index(scene_struct, metadata):
+    """
+    Return the SceneIndex of scene_struct, building it on first use.
+    """
+    if '_index' not in scene_struct:
+        scene_struct['_index'] = SceneIndex(scene_struct, metadata)
+    return scene_struct['_index']
@@ -0,0 +1,372 @@
+"""
+Streaming access to large JSON scene files (as written by render_images.py or
+scripts/merge_scenes.py), one scene at a time, so that memory stays bounded by
+a single scene instead of the whole file.
+
+To start at a given scene without parsing the ones before it, a sidecar index
+is kept next to the scene file (<scene file>.index, written the first time it
+is needed). It holds a fingerprint of the scene file, its "info" and the
+byte offset and image_index of every scene:
+
+    magic, file size (uint64), mtime in ns (uint64), digest of the first and
+    last 64 KB of the file (16 bytes), length of info (uint32), info (JSON),
+    num_scenes (uint64), one offset (uint64) per scene, one image_index
+    (int64, -1 if the scene has none) per scene
+
+The index is rebuilt when the fingerprint of the scene file changes, so that
+a scene file that is regenerated with the same size is not read with stale
+offsets.
+
+scene_file = SceneFile('../output/superCLEVR_scenes.json')
+for scene in scene_file.scenes(25000, 25500):
+    ...
+
+scenes = SceneMap(scene_file)    # scenes by image_index, read on demand
+scene = scenes[25000]
+"""
+
+import hashlib, io, json, os, struct
+from collections import OrderedDict
+from collections.abc import Mapping
+
+
+class JSONReader(object):
+    """
+    Minimal incremental reader for walking a large JSON document: values are
+    decoded with raw_decode, reading more of the file whenever a value is cut
+    off at the end of the buffer. peek() returns the next non-blank character,
+    expect(chars) consumes one of chars and value() decodes the next value.
+    offset is the position in the file of the start of the buffer, so tell()
+    is the position of the next value (in characters, which are bytes for
+    UTF-8 files opened as latin-1 with latin1=True).
+    """
+
+    def __init__(self, f, chunk_size, offset=0, latin1=False):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.latin1 = latin1
+        self.decoder = json.JSONDecoder()
+        self.buf, self.pos, self.eof = '', 0, False
+        self.offset = offset
+
+    def _fill(self):
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.offset += self.pos
+        self.buf, self.pos = self.buf[self.pos:] + data, 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON file')
+
+    def tell(self):
+        # Position of the next value
+        self.peek()
+        return self.offset + self.pos
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError('Expected one of %r but found %r' % (chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                start = self.pos
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the very end of the buffer may be cut off
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    if self.latin1:
+                        text = self.buf[start:end]
+                        if not text.isascii():
+                            # Decode non-ASCII values again as UTF-8
+                            value = json.loads(text.encode('latin-1').decode('utf-8'))
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+MAGIC = b'SCLVIDX3'
+_HEADER = struct.Struct('<QQ16sI')
+_FINGERPRINT_BYTES = 1 << 16
+
+
+def file_fingerprint(path):
+    """
+    (size, mtime in ns, digest of the head and tail) of a file.
+    """
+    st = os.stat(path)
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        digest.update(f.read(_FINGERPRINT_BYTES))
+        if st.st_size > _FINGERPRINT_BYTES:
+            f.seek(max(st.st_size - _FINGERPRINT_BYTES, _FINGERPRINT_BYTES))
+            digest.update(f.read())
+    return st.st_size, st.st_mtime_ns, digest.digest()
+
+
+def _open(path, offset=0):
+    # Scene files are read as latin-1 so that positions in the text are byte
+    # offsets that can be seeked to
+    f = open(path, 'rb')
+    f.seek(offset)
+    return io.TextIOWrapper(f, encoding='latin-1')
+
+
+def _iter_top_level(reader):
+    # Yield the keys of the top-level object, with the reader at their value
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        yield key
+        if reader.expect(',}') == '}':
+            return
+
+
+def _iter_array(reader):
+    # Yield the positions of the elements of the array at the reader; the
+    # caller reads (or skips) each element before the next one
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.expect(']')
+        return
+    while True:
+        yield reader.tell()
+        if reader.expect(',]') == ']':
+            return
+
+
+class SceneFile(object):
+    """
+    A JSON scene file ({"info": ..., "scenes": [...]}) read one scene at a
+    time. The offset index is only loaded (or built) when it is needed: to
+    start after the first scene, or for len().
+    """
+
+    def __init__(self, path, index_path=None, chunk_size=1 << 20):
+        self.path = path
+        self.index_path = index_path if index_path is not None else path + '.index'
+        self.chunk_size = chunk_size
+        self._info = None
+        self._offsets = None
+        self._image_indices = None
+
+    @property
+    def info(self):
+        if self._info is None:
+            if not self._read_index():
+                reader = JSONReader(_open(self.path), self.chunk_size, latin1=True)
+                for key in _iter_top_level(reader):
+                    value = reader.value()
+                    if key == 'info':
+                        self._info = value
+                        break
+                reader.f.close()
+        return self._info
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def has_index(self):
+        """
+        Whether the offsets are loaded or an up-to-date index file exists.
+        """
+        return self._offsets is not None or self._read_index()
+
+    @property
+    def offsets(self):
+        """
+        Byte offset of every scene in the file.
+        """
+        if self._offsets is None and not self._read_index():
+            self.build_index()
+        return self._offsets
+
+    @property
+    def image_indices(self):
+        """
+        image_index of every scene in the file (-1 for scenes without one).
+        """
+        if self._image_indices is None and not self._read_index():
+            self.build_index()
+        return self._image_indices
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return False
+        with open(self.index_path, 'rb') as f:
+            header = f.read(len(MAGIC) + _HEADER.size)
+            if len(header) != len(MAGIC) + _HEADER.size or header[:len(MAGIC)] != MAGIC:
+                return False
+            size, mtime, digest, info_len = _HEADER.unpack(header[len(MAGIC):])
+            if (size, mtime, digest) != file_fingerprint(self.path):
+                return False
+            self._info = json.loads(f.read(info_len).decode('utf-8'))
+            num_scenes, = struct.unpack('<Q', f.read(8))
+            self._offsets = list(struct.unpack('<%dQ' % num_scenes, f.read(8 * num_scenes)))
+            self._image_indices = list(struct.unpack('<%dq' % num_scenes,
+                                                     f.read(8 * num_scenes)))
+        return True
+
+    def build_index(self):
+        """
+        Find the offsets and image_index of all scenes with one pass over the
+        file and write the index (if the directory of the index is writable).
+        """
+        info, offsets, image_indices = None, [], []
+        fingerprint = file_fingerprint(self.path)
+        with _open(self.path) as f:
+            reader = JSONReader(f, self.chunk_size, latin1=True)
+            for key in _iter_top_level(reader):
+                if key == 'scenes':
+                    for offset in _iter_array(reader):
+                        offsets.append(offset)
+                        image_indices.append(reader.value().get('image_index', -1))
+                else:
+                    value = reader.value()
+                    if key == 'info':
+                        info = value
+        self._info, self._offsets, self._image_indices = info, offsets, image_indices
+
+        data = json.dumps(info).encode('utf-8')
+        try:
+            with open(self.index_path, 'wb') as f:
+                f.write(MAGIC + _HEADER.pack(*(fingerprint + (len(data),))))
+                f.write(data)
+                f.write(struct.pack('<Q', len(offsets)))
+                f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+                f.write(struct.pack('<%dq' % len(offsets), *image_indices))
+        except (IOError, OSError) as e:
+            print('Could not write scene index "%s": %s' % (self.index_path, e))
+
+    def scenes(self, start=0, stop=None):
+        """
+        Yield the scenes [start, stop) one at a time; stop=None reads to the
+        end of the file.
+        """
+        if stop is not None and stop <= start:
+            return
+        if start == 0:
+            # Stream from the start of the file, no index needed
+            with _open(self.path) as f:
+                reader = JSONReader(f, self.chunk_size, latin1=True)
+                for key in _iter_top_level(reader):
+                    if key != 'scenes':
+                        reader.value()
+                        continue
+                    for i, _ in enumerate(_iter_array(reader)):
+                        yield reader.value()
+                        if stop is not None and i + 1 >= stop:
+                            return
+                    return
+            return
+
+        offsets = self.offsets
+        if start >= len(offsets):
+            return
+        with _open(self.path, offsets[start]) as f:
+            reader = JSONReader(f, self.chunk_size, offset=offsets[start],
+                                 latin1=True)
+            i = start
+            while True:
+                yield reader.value()
+                i += 1
+                if (stop is not None and i >= stop) or reader.expect(',]') == ']':
+                    return
+
+
+    def read_scene(self, i, f=None):
+        """
+        Read scene i through the offset index, reading only its bytes. f is an
+        open binary handle on the file to reuse, if any.
+        """
+        offsets = self.offsets
+        if f is None:
+            with open(self.path, 'rb') as f:
+                return self.read_scene(i, f)
+        f.seek(offsets[i])
+        # Up to the next scene, or to the end of the file for the last one;
+        # raw_decode ignores the separator after the scene
+        data = f.read(offsets[i + 1] - offsets[i] if i + 1 < len(offsets) else -1)
+        return json.JSONDecoder().raw_decode(data.decode('utf-8'))[0]
+
+
+class SceneMap(Mapping):
+    """
+    Read-only dict of the scenes of a SceneFile by image_index. Only the
+    position of every image_index is kept (from the offset index, so the file
+    is not parsed again once it has an index); scenes are read with
+    SceneFile.read_scene when they are looked up, and the max_cached most
+    recently used ones are kept, along with the caches that the engines stash
+    in them.
+    """
+
+    def __init__(self, scene_file, max_cached=256):
+        self.scene_file = scene_file
+        self.max_cached = max_cached
+        self._positions = {image_index: i for i, image_index
+                           in enumerate(scene_file.image_indices)}
+        self._positions.pop(-1, None)
+        self._cached = OrderedDict()
+        self._f, self._pid = None, None
+
+    def _file(self):
+        # One handle per process: maps created before forking workers (as in
+        # verify_questions.py) must not share the position of a handle
+        if self._pid != os.getpid():
+            self._f, self._pid = open(self.scene_file.path, 'rb'), os.getpid()
+        return self._f
+
+    def __getitem__(self, image_index):
+        scene = self._cached.get(image_index)
+        if scene is not None:
+            self._cached.move_to_end(image_index)
+            return scene
+        scene = self.scene_file.read_scene(self._positions[image_index], self._file())
+        self._cached[image_index] = scene
+        if len(self._cached) > self.max_cached:
+            self._cached.popitem(last=False)
+        return scene
+
+    def iter_scenes(self, image_idxs):
+        """
+        Yield (image_index, scene) for the scenes of image_idxs that exist, in
+        the order of the file, with one streaming pass over the part of the
+        file that holds them rather than a lookup per scene. The scenes are
+        not added to the cache.
+        """
+        positions = sorted(set(self._positions[i] for i in image_idxs
+                               if i in self._positions))
+        if not positions:
+            return
+        wanted = set(positions)
+        scenes = self.scene_file.scenes(positions[0], positions[-1] + 1)
+        for i, scene in enumerate(scenes, positions[0]):
+            if i in wanted:
+                yield scene['image_index'], scene
+
+    def __contains__(self, image_index):
+        return image_index in self._positions
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
@@ -0,0 +1,37 @@
+import glob, json, os, sys
+
+import pytest
+
+QG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENE_DIR = os.path.join(QG_DIR, '..', 'output', 'scenes')
+
+# The question generation modules are flat scripts that expect to be run from
+# the question_generation directory
+sys.path.insert(0, QG_DIR)
+
+
+@pytest.fixture(autouse=True)
+def in_question_generation_dir(monkeypatch):
+    monkeypatch.chdir(QG_DIR)
+
+
+@pytest.fixture(scope='session')
+def scene_file(tmp_path_factory):
+    """
+    The example scenes in output/scenes merged into one scene file, as
+    scripts/merge_scenes.py does.
+    """
+    scenes = []
+    for path in sorted(glob.glob(os.path.join(SCENE_DIR, '*.json'))):
+        with open(path, 'r') as f:
+            scenes.append(json.load(f))
+    path = str(tmp_path_factory.mktemp('scenes') / 'scenes.json')
+    with open(path, 'w') as f:
+        json.dump({'info': {'split': 'new', 'version': '1.0'}, 'scenes': scenes}, f)
+    return path
+
+
+@pytest.fixture
+def metadata(in_question_generation_dir):
+    import generate_questions as gen
+    return gen.load_metadata('metadata_part.json')
@@ -0,0 +1,237 @@
+"""
+End-to-end checks of the guarantees of the engines and of generate_questions.py
+on the example scenes in output/scenes. Run from the repository root or the
+question_generation directory:
+
+python -m pytest question_generation/tests
+"""
+
+import json, random
+
+import pytest
+
+import generate_questions as gen
+import fuzz_engines
+import question_engine
+import reference_engine
+import verify_questions
+import evaluate_programs
+
+
+def generate(scene_file, output_file, *extra):
+    args = gen.parser.parse_args([
+        '--input_scene_file', scene_file,
+        '--metadata_file', 'metadata_part.json',
+        '--template_dir', 'super_clevr_templates',
+        '--instances_per_template', '2',
+        '--reset_counts_every', '4',
+        '--output_questions_file', output_file,
+    ] + list(extra))
+    gen.main(args)
+    return args
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_engines_match_reference(metadata):
+    # Like fuzz_engines.py: every backend (compiled, cached, batched,
+    # executor) gives the outputs of reference_engine on every node
+    rng = random.Random(0)
+    signatures = fuzz_engines.get_signatures(metadata)
+    scenes = [fuzz_engines.random_scene(metadata, 6, rng) for _ in range(8)]
+    programs = []
+    for _ in range(150):
+        scene = rng.choice(scenes)
+        for _ in range(20):
+            nodes = fuzz_engines.random_program(signatures, metadata, scene, 4, rng)
+            if reference_engine.answer_question({'nodes': nodes}, metadata,
+                                                scene) != '__INVALID__':
+                break
+        programs.append(nodes)
+    results = fuzz_engines.run_backends(programs, scenes, metadata)
+    assert fuzz_engines.compare(programs, scenes, metadata, results) == []
+
+
+def test_legacy_layout_and_answers(scene_file, tmp_path):
+    out = str(tmp_path / 'questions.json')
+    generate(scene_file, out)
+    with open(out, 'r') as f:
+        data = json.load(f)
+    assert data['questions']
+    # The streamed legacy file is what json.dump with indent=2 writes
+    assert read(out).decode('utf-8') == json.dumps(data, indent=2)
+    for q in data['questions']:
+        if q['question_hash'] != 'ERROR':
+            assert all('value_inputs' in node for node in q['program'])
+
+    # and verify_questions.py finds the same answers
+    assert len(verify_questions.load_scenes(scene_file)) == 10
+    verify_questions.init_worker(scene_file, 'metadata_part.json')
+    num_questions, mismatched, invalid = 0, [], []
+    for task in verify_questions.iter_tasks(verify_questions.iter_questions(out), 100):
+        n, m, i = verify_questions.verify_task(task)
+        num_questions += n
+        mismatched += m
+        invalid += i
+    assert num_questions == len(data['questions'])
+    assert mismatched == [] and invalid == []
+
+
+def test_workers_match_one_worker(scene_file, tmp_path):
+    serial = str(tmp_path / 'serial.jsonl')
+    parallel = str(tmp_path / 'parallel.jsonl')
+    generate(scene_file, serial, '--output_traces_file', serial + '.traces')
+    generate(scene_file, parallel, '--output_traces_file', parallel + '.traces',
+             '--workers', '2')
+    assert read(serial) == read(parallel)
+    assert read(serial + '.traces') == read(parallel + '.traces')
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.mark.parametrize('extra', [[], ['--output_format', 'legacy'],
+                                   ['--workers', '2']])
+def test_resume_matches_uninterrupted(scene_file, tmp_path, monkeypatch, extra):
+    expected = str(tmp_path / 'expected.json')
+    generate(scene_file, expected, '--output_traces_file', expected + '.traces',
+             *extra)
+
+    # Stop the run after 7 scenes (2 shards of 4 with --workers), past the
+    # checkpoint taken after the 6th (8th) scene, and resume it
+    out = str(tmp_path / 'resumed.json')
+    run = ['--output_traces_file', out + '.traces', '--checkpoint_every', '3'] + extra
+    interrupt_after = 2 if '--workers' in extra else 7
+    iter_scenes = gen.iter_questions_for_scenes
+    generate_shard = gen.generate_shard
+
+    def interrupting(*args, **kwargs):
+        for i, questions in enumerate(iter_scenes(*args, **kwargs)):
+            if i == interrupt_after:
+                raise Interrupted()
+            yield questions
+
+    terminated = []
+
+    class InterruptingPool(object):
+        # Runs the shards in-process and stops after interrupt_after of them
+        def __init__(self, processes, initializer, initargs):
+            initializer(*initargs)
+
+        def imap(self, fn, shards):
+            for i, shard in enumerate(shards):
+                if i == interrupt_after:
+                    raise Interrupted()
+                yield generate_shard(shard)
+
+        def close(self):
+            pass
+
+        def terminate(self):
+            terminated.append(self)
+
+        def join(self):
+            pass
+
+    with monkeypatch.context() as m:
+        if '--workers' in extra:
+            m.setattr(gen.multiprocessing, 'Pool', InterruptingPool)
+        else:
+            m.setattr(gen, 'iter_questions_for_scenes', interrupting)
+        with pytest.raises(Interrupted):
+            generate(scene_file, out, *run)
+    # The workers are stopped rather than left running
+    assert len(terminated) == ('--workers' in extra)
+    with open(out + '.checkpoint', 'r') as f:
+        assert json.load(f)['next_scene'] in (6, 8)
+
+    generate(scene_file, out, '--resume', *run)
+    assert read(out) == read(expected)
+    assert read(out + '.traces') == read(expected + '.traces')
+
+
+def test_ill_typed_program_raises(metadata):
+    # A mask read as an object idx must not give an answer
+    scene_struct = fuzz_engines.random_scene(metadata, 6, random.Random(0))
+    nodes = [
+        {'type': 'scene', 'inputs': []},
+        {'type': 'filter_color', 'inputs': [0], 'side_inputs': ['red']},
+        {'type': 'relate', 'inputs': [1], 'side_inputs': ['left']},
+        {'type': 'count', 'inputs': [2]},
+    ]
+    for engine in [reference_engine, question_engine]:
+        with pytest.raises(TypeError):
+            engine.answer_question({'nodes': nodes}, metadata, scene_struct)
+
+
+def test_dropped_duplicates_are_not_counted(scene_file, metadata):
+    # Template and answer counts drive the balancing, so they only count the
+    # questions that are kept
+    args = gen.parser.parse_args([
+        '--input_scene_file', scene_file,
+        '--template_dir', 'CLEVR_1.0_templates',
+        '--instances_per_template', '5',
+        '--drop_duplicates', 'semantic',
+    ])
+    scene_file = gen.SceneFile(scene_file)
+    templates = gen.load_templates(args.template_dir)
+    with open(args.synonyms_json, 'r') as f:
+        synonyms = json.load(f)
+    progress = {}
+    questions = gen.generate_questions_for_scenes(
+        scene_file.scenes(0, 3), scene_file.info, templates, metadata, synonyms, args,
+        progress=progress)
+    for key in templates:
+        kept = [q for q in questions
+                if (q['template_filename'], q['question_family_index']) == key]
+        assert sum(progress['template_answer_counts'][key].values()) == len(kept)
+        assert progress['template_counts'][key] == len(set(q['image_index'] for q in kept))
+
+
+@pytest.mark.parametrize('backend', ['batch', 'compiled'])
+def test_evaluate_programs_answers_each_program(scene_file, metadata, backend):
+    # The canonical form trims the unique node that the answer does not depend
+    # on, but it makes the program invalid on a scene with several objects
+    scenes = verify_questions.load_scenes(scene_file)
+    count = [{'type': 'scene', 'inputs': []}, {'type': 'count', 'inputs': [0]}]
+    dead_unique = [{'type': 'scene', 'inputs': []}, {'type': 'unique', 'inputs': [0]},
+                   {'type': 'count', 'inputs': [0]}]
+    num_objects = len(scenes[0]['objects'])
+    assert num_objects > 1
+    for programs in [[count, dead_unique], [dead_unique, count]]:
+        questions = [{'image_index': 0, 'question_index': i, 'answer': num_objects,
+                      'program': program} for i, program in enumerate(programs)]
+        groups, failed = evaluate_programs.group_by_program(questions, metadata)
+        assert failed == [] and len(groups) == 2
+        evaluator = evaluate_programs.ProgramEvaluator(scenes, metadata, backend)
+        predicted = {info['question_index']: answer for info, answer, _ in
+                     evaluate_programs.evaluate(groups, evaluator)}
+        assert predicted[programs.index(count)] == num_objects
+        assert predicted[programs.index(dead_unique)] == '__INVALID__'
+
+
+@pytest.mark.parametrize('backend', ['batch', 'compiled'])
+def test_evaluate_programs_scores_ill_typed_programs_invalid(scene_file, metadata,
+                                                             backend):
+    scenes = verify_questions.load_scenes(scene_file)
+    ill_typed = [{'type': 'scene', 'inputs': []},
+                 {'type': 'relate', 'inputs': [0], 'value_inputs': ['left']},
+                 {'type': 'count', 'inputs': [1]}]
+    well_typed = [{'type': 'scene', 'inputs': []}, {'type': 'count', 'inputs': [0]}]
+    questions = [{'image_index': i, 'question_index': i, 'answer': len(scenes[i]['objects']),
+                  'program': well_typed} for i in range(4)]
+    predicted_programs = {0: ill_typed, 1: ill_typed, 2: well_typed, 3: well_typed}
+    assert verify_questions.check_program(
+        verify_questions.to_engine_nodes(ill_typed), metadata) is not None
+
+    groups, failed = evaluate_programs.group_by_program(questions, metadata,
+                                                        predicted_programs)
+    evaluator = evaluate_programs.ProgramEvaluator(scenes, metadata, backend)
+    predicted = {info['question_index']: answer for info, answer, _ in
+                 evaluate_programs.evaluate(groups, evaluator)}
+    assert sorted(info['question_index'] for info, _ in failed) == [0, 1]
+    assert predicted == {2: questions[2]['answer'], 3: questions[3]['answer']}
@@ -0,0 +1,273 @@
+"""
+Check that a question file still agrees with its scenes, by re-executing the
+program of every question with question_engine and comparing the result with
+the stored answer. Useful after merging, slicing or fixing question files.
+
+Questions are streamed from the file (a JSON file as written by
+generate_questions.py, or a JSON-lines file with one question per line), so
+files with millions of questions are never loaded whole; scenes are read from
+the scene file as they are needed (see load_scenes). Consecutive questions
+about the same image are grouped and the groups are answered in a pool of
+worker processes. Run it from the question_generation directory:
+
+python verify_questions.py --input_scene_file ../output/superCLEVR_scenes.json \
+    --input_questions_file ../output/superCLEVR_questions.json --workers 8
+"""
+
+from __future__ import print_function
+import argparse, collections, itertools, json, multiprocessing, time
+
+import question_engine as qeng
+import generate_questions as gen
+from scene_stream import JSONReader, SceneFile, SceneMap
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_scene_file', default='../output/superCLEVR_scenes.json',
+        help="JSON file containing ground-truth scene information for all images")
+parser.add_argument('--input_questions_file', default='../output/superCLEVR_questions.json',
+        help="Questions to verify; a JSON file with a 'questions' list or a " +
+                 "JSON-lines file with one question per line")
+parser.add_argument('--metadata_file', default='metadata_part.json',
+        help="JSON file containing metadata about functions")
+parser.add_argument('--workers', default=1, type=int,
+        help="Number of worker processes; 1 verifies in this process")
+parser.add_argument('--questions_per_task', default=2000, type=int,
+        help="Approximate number of questions sent to a worker at a time")
+parser.add_argument('--max_reported', default=20, type=int,
+        help="How many mismatched and invalid questions to print")
+parser.add_argument('--output_file', default=None,
+        help="If given, write a JSON report with all mismatched and invalid " +
+                 "questions to this file")
+
+
+def iter_questions(path, chunk_size=1 << 20):
+    """
+    Yield the questions of a question file one at a time.
+    """
+    with open(path, 'r') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        reader = JSONReader(f, chunk_size)
+        if reader.peek() == '[':
+            # A JSON array of questions
+            reader.expect('[')
+            if reader.peek() == ']':
+                return
+            while True:
+                yield reader.value()
+                if reader.expect(',]') == ']':
+                    return
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key != 'questions':
+                reader.value()
+            else:
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.expect(']')
+                else:
+                    while True:
+                        yield reader.value()
+                        if reader.expect(',]') == ']':
+                            break
+            if reader.expect(',}') == '}':
+                return
+
+
+def iter_tasks(questions, questions_per_task):
+    """
+    Group consecutive questions about the same image and pack the groups into
+    tasks of about questions_per_task questions. Only the fields needed for
+    verification are kept.
+    """
+    task, num_questions = [], 0
+    for image_index, group in itertools.groupby(questions, key=lambda q: q['image_index']):
+        group = [(q.get('question_index'), q['program'], q['answer']) for q in group]
+        task.append((image_index, group))
+        num_questions += len(group)
+        if num_questions >= questions_per_task:
+            yield task
+            task, num_questions = [], 0
+    if task:
+        yield task
+
+
+def to_engine_nodes(program):
+    """
+    Convert a program as written out ("value_inputs", or "function" in the
+    public CLEVR release) to the nodes used by question_engine.
+    """
+    nodes = []
+    for f in program:
+        node = {
+            'type': f['type'] if 'type' in f else f['function'],
+            'inputs': f['inputs'],
+        }
+        side_inputs = f.get('value_inputs', f.get('side_inputs', []))
+        if side_inputs:
+            node['side_inputs'] = side_inputs
+        nodes.append(node)
+    return nodes
+
+
+def check_program(nodes, metadata):
+    """
+    Return a description of what is wrong with the structure of a program, or
+    None if its functions exist and get the right inputs. The kinds of the
+    inputs are checked by compiling the program (see
+    question_engine.CompiledProgram): the engine would otherwise read e.g. a
+    set of objects given to relate as an object idx.
+    """
+    functions = metadata['_functions_by_name']
+    for i, node in enumerate(nodes):
+        f = functions.get(node['type'])
+        if f is None or f.get('template_only'):
+            return 'node %d: unknown function "%s"' % (i, node['type'])
+        if any(idx >= i for idx in node['inputs']):
+            return 'node %d (%s): inputs %s are not earlier nodes' % (
+                   i, node['type'], node['inputs'])
+        num_expected = len(f.get('side_inputs') or [])
+        num_given = len(node.get('side_inputs', []))
+        if num_given != num_expected:
+            return 'node %d (%s): %d value inputs, expected %d' % (
+                   i, node['type'], num_given, num_expected)
+    try:
+        qeng.compile_program(nodes, metadata)
+    except TypeError as e:
+        return str(e)
+    return None
+
+
+# Scenes and metadata of the worker processes; they are loaded before the pool
+# is started so forked workers share them
+_scenes = None
+_metadata = None
+
+
+def load_scenes(scene_file):
+    """
+    The scenes of a scene file by image_index, read from the file as they are
+    looked up (see scene_stream.SceneMap) rather than all held in memory.
+    """
+    return SceneMap(SceneFile(scene_file))
+
+
+def init_worker(scene_file, metadata_file):
+    global _scenes, _metadata
+    if _scenes is None:
+        _scenes = load_scenes(scene_file)
+        _metadata = gen.load_metadata(metadata_file)
+
+
+def verify_task(task):
+    """
+    Answer the questions of a task. Returns (num_questions, mismatched, invalid)
+    where mismatched and invalid are lists of dicts describing the questions.
+    """
+    num_questions, mismatched, invalid = 0, [], []
+    for image_index, group in task:
+        scene_struct = _scenes.get(image_index)
+        for question_index, program, answer in group:
+            num_questions += 1
+            info = {'image_index': image_index, 'question_index': question_index,
+                    'answer': answer}
+            if scene_struct is None:
+                info['error'] = 'no scene with this image_index'
+                invalid.append(info)
+                continue
+            nodes = to_engine_nodes(program)
+            error = check_program(nodes, _metadata)
+            if error is not None:
+                info['error'] = error
+                invalid.append(info)
+                continue
+            try:
+                predicted = qeng.answer_question(nodes, _metadata, scene_struct)
+            except Exception as e:
+                info['error'] = '%s: %s' % (type(e).__name__, e)
+                invalid.append(info)
+                continue
+            if predicted == '__INVALID__':
+                info['error'] = 'program is invalid on this scene'
+                invalid.append(info)
+                continue
+            predicted = gen.format_answer(predicted, _metadata)
+            if predicted != answer:
+                info['predicted'] = predicted
+                mismatched.append(info)
+    return num_questions, mismatched, invalid
+
+
+def main(args):
+    tic = time.time()
+    print('Loading scenes from "%s"' % args.input_scene_file)
+    init_worker(args.input_scene_file, args.metadata_file)
+    print('Loaded %d scenes in %.1fs' % (len(_scenes), time.time() - tic))
+
+    tasks = iter_tasks(iter_questions(args.input_questions_file),
+                       args.questions_per_task)
+    tic = time.time()
+    if args.workers <= 1:
+        results = map(verify_task, tasks)
+    else:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker,
+                                    initargs=(args.input_scene_file, args.metadata_file))
+        results = _bounded_imap(pool, verify_task, tasks, 2 * args.workers)
+
+    num_questions, mismatched, invalid = 0, [], []
+    for n, task_mismatched, task_invalid in results:
+        num_questions += n
+        mismatched.extend(task_mismatched)
+        invalid.extend(task_invalid)
+        elapsed = time.time() - tic
+        print('verified %d questions (%.0f questions/s), %d mismatched, %d invalid' % (
+              num_questions, num_questions / max(elapsed, 1e-6), len(mismatched),
+              len(invalid)), end='\r')
+    print()
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+
+    for name, infos in [('mismatched', mismatched), ('invalid', invalid)]:
+        for info in infos[:args.max_reported]:
+            print(name, info)
+        if len(infos) > args.max_reported:
+            print('... and %d more %s questions' % (len(infos) - args.max_reported, name))
+    elapsed = time.time() - tic
+    print('%d questions, %d mismatched, %d invalid, %.1fs (%.0f questions/s)' % (
+          num_questions, len(mismatched), len(invalid), elapsed,
+          num_questions / max(elapsed, 1e-6)))
+
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump({
+                'num_questions': num_questions,
+                'seconds': elapsed,
+                'mismatched': mismatched,
+                'invalid': invalid,
+            }, f, indent=2)
+
+
+def _bounded_imap(pool, fn, iterable, max_pending):
+    # Like pool.imap, but without reading ahead more than max_pending tasks
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(fn, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)